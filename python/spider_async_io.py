@@ -0,0 +1,218 @@
+# spider_async_io.py
+# Asynchronous region fetching for slides on network shares
+# Blocking OpenSlide reads run in a thread pool driven by asyncio, so many reads
+# are in flight at once (bounded by a semaphore) while regions that have already
+# arrived are handed to the inference stage through a bounded asyncio.Queue.
+#
+# Latency-hiding check with a local stand-in slide that delays every read:
+#   python spider_async_io.py [--delay 0.05] [--regions 64] [--concurrency 16]
+
+import time
+import queue
+import asyncio
+import itertools
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_QUEUE_SIZE = 8
+
+_DONE = object()
+
+
+class _Stopped(Exception):
+    """Raised in the pipeline when the consumer of iter_regions has gone away."""
+
+
+class SlideHandles:
+    """Thread-safe cache of open slide handles, one per path."""
+
+    def __init__(self, open_slide):
+        self.open_slide = open_slide
+        self._handles = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            if path not in self._handles:
+                self._handles[path] = self.open_slide(path)
+            return self._handles[path]
+
+    def close(self):
+        with self._lock:
+            for handle in self._handles.values():
+                handle.close()
+            self._handles = {}
+
+
+class AsyncRegionReader:
+    """Runs a blocking read function in a thread pool with at most `concurrency` reads in flight."""
+
+    def __init__(self, read_fn, concurrency=DEFAULT_CONCURRENCY):
+        self.read_fn = read_fn
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(concurrency)
+        self._semaphore = None
+
+    async def read(self, item):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self.read_fn, item)
+
+    def close(self):
+        self._executor.shutdown()
+
+
+async def _produce(reader, items, queue):
+    async def fetch(item):
+        image = await reader.read(item)
+        await queue.put((item, image))
+
+    # Items are pulled lazily (they may come from an incremental input reader):
+    # at most `concurrency` fetches exist at once
+    pending = set()
+    for item in items:
+        if len(pending) >= reader.concurrency:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        pending.add(asyncio.ensure_future(fetch(item)))
+    if pending:
+        await asyncio.gather(*pending)
+    await queue.put(_DONE)
+
+
+async def _consume(queue, handle, executor):
+    # Inference runs in its own thread so the event loop keeps issuing reads meanwhile
+    loop = asyncio.get_running_loop()
+    while True:
+        entry = await queue.get()
+        if entry is _DONE:
+            break
+        await loop.run_in_executor(executor, handle, *entry)
+
+
+async def _pipeline(items, read_fn, handle, concurrency, queue_size):
+    queue = asyncio.Queue(maxsize=queue_size)
+    reader = AsyncRegionReader(read_fn, concurrency)
+    inference = ThreadPoolExecutor(1)
+    try:
+        await asyncio.gather(_produce(reader, items, queue), _consume(queue, handle, inference))
+    finally:
+        reader.close()
+        inference.shutdown()
+
+
+def run_pipeline(items, read_fn, handle, concurrency=DEFAULT_CONCURRENCY, queue_size=DEFAULT_QUEUE_SIZE):
+    """Read every item with read_fn(item) concurrently and call handle(item, image) in arrival order.
+
+    read_fn is blocking (e.g. an OpenSlide read) and may return None on failure;
+    handle is called from a single thread, one region at a time. `items` may be
+    any iterable; it is consumed as reads complete.
+    """
+    asyncio.run(_pipeline(items, read_fn, handle, concurrency, queue_size))
+
+
+def iter_regions(items, read_fn, concurrency=DEFAULT_CONCURRENCY, queue_size=DEFAULT_QUEUE_SIZE):
+    """Generator form of run_pipeline: yields (item, image) in arrival order.
+
+    The pipeline runs in a background thread and the caller's loop is the
+    inference stage; errors raised by read_fn are re-raised here. When the
+    caller stops early (break, exception, close()), the pipeline stops pulling
+    items and this waits for the reads in flight, so slide handles can be closed.
+    """
+    handoff = queue.Queue(maxsize=queue_size)
+    errors = []
+    stop = threading.Event()
+
+    def put(entry):
+        # Wait for room, but give up once the consumer has gone away
+        while not stop.is_set():
+            try:
+                handoff.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def hand_off(item, image):
+        if not put((item, image)):
+            raise _Stopped()
+
+    def produce():
+        try:
+            remaining = itertools.takewhile(lambda item: not stop.is_set(), items)
+            run_pipeline(remaining, read_fn, hand_off, concurrency, queue_size)
+        except _Stopped:
+            pass
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(_DONE)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            entry = handoff.get()
+            if entry is _DONE:
+                break
+            yield entry
+    finally:
+        stop.set()
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+class DelayedSlide:
+    """Stand-in slide whose reads take `delay` seconds, like a slide on a slow share."""
+
+    def __init__(self, path, delay=0.05):
+        self.path = path
+        self.delay = delay
+        self.dimensions = (100000, 100000)
+
+    def read_region(self, location, level, size):
+        from PIL import Image
+        time.sleep(self.delay)
+        return Image.new('RGBA', size, (255, 255, 255, 255))
+
+    def close(self):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare synchronous and asynchronous reads on a delayed stand-in slide")
+    parser.add_argument('--delay', type=float, default=0.05, help="Seconds per read (default: 0.05)")
+    parser.add_argument('--regions', type=int, default=64, help="Regions to read (default: 64)")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"Reads in flight (default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument('--inference', type=float, default=0.005, help="Seconds of simulated inference per region")
+    args = parser.parse_args()
+
+    handles = SlideHandles(lambda path: DelayedSlide(path, args.delay))
+    items = [('slide.svs', (i * 1120, 0)) for i in range(args.regions)]
+    read = lambda item: handles.get(item[0]).read_region(item[1], 0, (224, 224))
+    processed = []
+
+    def infer(item, image):
+        time.sleep(args.inference)
+        processed.append(item)
+
+    start = time.time()
+    for item in items:
+        infer(item, read(item))
+    sync_time = time.time() - start
+
+    processed.clear()
+    start = time.time()
+    run_pipeline(items, read, infer, concurrency=args.concurrency)
+    async_time = time.time() - start
+
+    assert sorted(processed) == sorted(items), "Not every region was processed exactly once"
+    print(f"Synchronous: {sync_time:.2f}s, asynchronous ({args.concurrency} in flight): {async_time:.2f}s, "
+          f"speed-up {sync_time / async_time:.1f}x")
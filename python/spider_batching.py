@@ -0,0 +1,229 @@
+# spider_batching.py
+# Adaptive inference batch size with a memory-pressure guard
+# The largest safe batch is chosen at startup from the memory available now and
+# the model's activation footprint per sample (probed with one forward pass).
+# Before every batch the size is re-checked against the memory available at that
+# moment, an out-of-memory failure halves it and retries the same patches, and
+# it grows again after a run of good batches once there is headroom.
+
+import gc
+import os
+import sys
+
+import torch
+
+try:
+    import psutil
+    HAS_PSUTIL = True
+except ImportError:
+    HAS_PSUTIL = False
+
+try:
+    import resource
+    HAS_RESOURCE = True
+except ImportError:
+    HAS_RESOURCE = False
+
+# Largest automatic batch size
+MAX_AUTO_BATCH = 64
+
+# Share of the currently available memory one batch may use
+SAFETY_FRACTION = 0.5
+
+# Consecutive successful batches before trying a larger batch
+GROW_AFTER = 8
+
+# After an out-of-memory failure growth stops at this share of the failed size,
+# unless available memory has since risen by REGROW_HEADROOM over what it was then
+FAILED_SIZE_CAP = 0.75
+REGROW_HEADROOM = 1.25
+
+
+def available_memory_bytes(device=None):
+    """Memory a new allocation can use now: free GPU memory on CUDA, available RAM otherwise."""
+    if device is not None and device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    if HAS_PSUTIL:
+        return psutil.virtual_memory().available
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_bytes(children=False):
+    """Peak resident set size of this process (or of its largest child process)."""
+    if HAS_RESOURCE:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    if HAS_PSUTIL and not children:
+        info = psutil.Process(os.getpid()).memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    return None
+
+
+def memory_summary():
+    peak = peak_rss_bytes()
+    peak_children = peak_rss_bytes(children=True)
+    return {
+        'peak_rss_mb': round(peak / 1e6, 1) if peak else None,
+        'peak_worker_rss_mb': round(peak_children / 1e6, 1) if peak_children else None
+    }
+
+
+def probe_per_sample_bytes(model, input_shape, device):
+    """Activation memory of one sample in a forward pass.
+
+    On CUDA this is the measured peak allocation of a batch of two. On CPU the
+    outputs of every leaf module are summed, a conservative bound since
+    no_grad frees most of them before the pass ends.
+    """
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        with torch.no_grad():
+            model(pixel_values=torch.zeros((2, *input_shape), device=device))
+        torch.cuda.synchronize(device)
+        return max(1, (torch.cuda.max_memory_allocated(device) - base) // 2)
+
+    total = [0]
+
+    def count(module, inputs, output):
+        outputs = output if isinstance(output, (tuple, list)) else [output]
+        for tensor in outputs:
+            if isinstance(tensor, torch.Tensor):
+                total[0] += tensor.numel() * tensor.element_size()
+
+    leaves = [m for m in model.modules() if not list(m.children())]
+    hooks = [m.register_forward_hook(count) for m in leaves]
+    try:
+        with torch.no_grad():
+            model(pixel_values=torch.zeros((1, *input_shape), device=device))
+    finally:
+        for hook in hooks:
+            hook.remove()
+    input_bytes = 4 * int(torch.tensor(input_shape).prod())
+    return max(1, total[0] + input_bytes)
+
+
+def is_out_of_memory(error):
+    if isinstance(error, MemoryError):
+        return True
+    if hasattr(torch.cuda, 'OutOfMemoryError') and isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and ('out of memory' in message or "can't allocate memory" in message)
+
+
+class AdaptiveBatcher:
+    """Runs a batch function over items with a batch size that follows available memory."""
+
+    def __init__(self, per_sample_bytes, max_batch=MAX_AUTO_BATCH, min_batch=1, device=None):
+        self.per_sample_bytes = per_sample_bytes
+        self.max_batch = max(min_batch, max_batch)
+        self.min_batch = min_batch
+        self.device = device
+        self.size = self.safe_size()
+        self.initial_size = self.size
+        self.smallest = self.size
+        self.largest = self.size
+        self.batches = 0
+        self.oom_retries = 0
+        self.pressure_shrinks = 0
+        self.grows = 0
+        self._streak = 0
+        self._ceiling = None
+        self._available_at_failure = None
+
+    @classmethod
+    def for_model(cls, model, input_shape, device, max_batch=MAX_AUTO_BATCH):
+        per_sample = probe_per_sample_bytes(model, input_shape, device)
+        batcher = cls(per_sample, max_batch=max_batch, device=device)
+        available = available_memory_bytes(device)
+        print(f"Adaptive batching: {per_sample / 1e6:.0f} MB per sample, "
+              + (f"{available / 1e9:.1f} GB available, " if available else "")
+              + f"starting at batch size {batcher.size} (max {batcher.max_batch})")
+        return batcher
+
+    def safe_size(self):
+        """Largest batch that fits in the safe share of the memory available now."""
+        available = available_memory_bytes(self.device)
+        if available is None:
+            return self.min_batch
+        fits = int(available * SAFETY_FRACTION // self.per_sample_bytes)
+        return max(self.min_batch, min(self.max_batch, fits))
+
+    def _set_size(self, size):
+        self.size = size
+        self.smallest = min(self.smallest, size)
+        self.largest = max(self.largest, size)
+
+    def _maybe_grow(self):
+        self._streak += 1
+        if self._streak < GROW_AFTER or self.size >= self.max_batch:
+            return
+        self._streak = 0
+        target = min(self.size * 2, self.safe_size())
+        if self._ceiling is not None and target > self._ceiling:
+            available = available_memory_bytes(self.device)
+            if available is None or available < self._available_at_failure * REGROW_HEADROOM:
+                target = self._ceiling
+            else:
+                self._ceiling = None
+        if target > self.size:
+            self._set_size(target)
+            self.grows += 1
+
+    def run(self, items, batch_fn):
+        """Yield batch_fn(batch) for consecutive batches covering every item once."""
+        start = 0
+        while start < len(items):
+            # Memory-pressure guard: do not start a batch that does not fit now
+            limit = self.safe_size()
+            if limit < self.size:
+                self._set_size(limit)
+                self.pressure_shrinks += 1
+                self._streak = 0
+
+            batch = items[start:start + self.size]
+            try:
+                output = batch_fn(batch)
+            except Exception as e:
+                if not is_out_of_memory(e) or self.size <= self.min_batch:
+                    raise
+                print(f"Out of memory at batch size {self.size}; retrying with {max(self.min_batch, self.size // 2)}")
+                self._ceiling = max(self.min_batch, int(self.size * FAILED_SIZE_CAP))
+                self._available_at_failure = available_memory_bytes(self.device) or 0
+                self._set_size(max(self.min_batch, self.size // 2))
+                self.oom_retries += 1
+                self._streak = 0
+                gc.collect()
+                if self.device is not None and self.device.type == 'cuda':
+                    torch.cuda.empty_cache()
+                continue
+
+            start += len(batch)
+            self.batches += 1
+            self._maybe_grow()
+            yield output
+
+    def stats(self):
+        return {
+            'per_sample_mb': round(self.per_sample_bytes / 1e6, 1),
+            'initial_batch_size': self.initial_size,
+            'final_batch_size': self.size,
+            'smallest_batch_size': self.smallest,
+            'largest_batch_size': self.largest,
+            'max_batch_size': self.max_batch,
+            'batches': self.batches,
+            'oom_retries': self.oom_retries,
+            'pressure_shrinks': self.pressure_shrinks,
+            'grows': self.grows
+        }
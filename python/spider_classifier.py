@@ -0,0 +1,328 @@
+# spider_classifier.py
+# In-process classification API for SPIDER models
+# SpiderClassifier holds a loaded model (or ensemble) with its preprocessing,
+# optional stain normalization and test-time augmentation, and classifies NumPy
+# arrays, PIL images, slide regions or QuPath annotation specs directly, without
+# the annotations/predictions JSON round-trip. The annotation scripts are thin
+# command-line wrappers over it.
+#
+#   from spider_classifier import SpiderClassifier
+#   with SpiderClassifier('./SPIDER-colorectal-model') as classifier:
+#       probabilities = classifier.predict_proba(arrays)        # (N, n_classes)
+#       for annotation, result in classifier.classify_annotations(annotations):
+#           print(annotation['id'], result['prediction'] if result else None)
+
+import re
+from urllib.parse import unquote
+
+import numpy as np
+import torch
+from PIL import Image
+
+from spider_model_registry import get_registry
+from spider_preprocessing import FastPreprocessor, as_rgb_image
+from spider_ensemble import ModelEnsemble
+from spider_slide_io import read_region_at
+from spider_stain import StainNormalizers
+from spider_tta import TestTimeAugmenter
+from spider_async_io import SlideHandles, iter_regions
+from spider_tile_cache import get_tile_cache
+from spider_readers import open_reader
+
+# SPIDER classifies 1120 x 1120 regions; annotations are centred in a window this size
+CONTEXT_SIZE = 1120
+
+# Regions per forward pass in predict_proba
+DEFAULT_BATCH_SIZE = 8
+
+# QuPath image server prefixes in front of the slide URI
+SERVER_PREFIXES = ('BioFormatsImageServer:', 'OpenslideImageServer:', 'ImageIOImageServer:')
+
+# Keys of every result; anything else is TTA or ensemble detail
+RESULT_KEYS = ('prediction', 'probabilities', 'confidence')
+
+
+def parse_qupath_path(qupath_path):
+    """Local file path of a QuPath image server path, file URI or plain path."""
+    path = qupath_path.strip()
+    for prefix in SERVER_PREFIXES:
+        if prefix in path:
+            path = path.split(prefix, 1)[1].strip()
+            # Bio-Formats appends the series, e.g. "[--series, 0]"
+            if prefix.startswith('BioFormats') and '[' in path:
+                path = path.split('[')[0].strip()
+            break
+    if path.startswith('file:'):
+        # file:/x, file:///x -> /x; /C:/x -> C:/x on Windows
+        path = unquote(re.sub(r'^file:/*', '/', path))
+        if re.match(r'^/[A-Za-z]:', path):
+            path = path[1:]
+    return path
+
+
+def open_slide(path):
+    """Slide reader for a QuPath slide path (backend chosen by format)."""
+    return open_reader(parse_qupath_path(path))
+
+
+def read_region_with_context(slide, region, downsample=1.0, context_size=CONTEXT_SIZE):
+    """RGBA context window centred on a region ({'x', 'y', 'width', 'height'}, level 0).
+
+    The window covers context_size * downsample level-0 pixels, is shifted to
+    stay inside the slide, and is read from the closest pyramid level.
+    """
+    x = int(region['x'])
+    y = int(region['y'])
+    width = int(region['width'])
+    height = int(region['height'])
+
+    # Level-0 footprint of the context window at the requested resolution
+    context_extent = int(round(context_size * downsample))
+    context_x = max(0, x + width // 2 - context_extent // 2)
+    context_y = max(0, y + height // 2 - context_extent // 2)
+
+    slide_width, slide_height = slide.dimensions
+    if context_x + context_extent > slide_width:
+        context_x = max(0, slide_width - context_extent)
+    if context_y + context_extent > slide_height:
+        context_y = max(0, slide_height - context_extent)
+
+    return read_region_at(slide, (context_x, context_y), (context_size, context_size), downsample)
+
+
+def details(result):
+    """TTA and ensemble fields of a result (everything but prediction, probabilities, confidence)."""
+    return {k: v for k, v in result.items() if k not in RESULT_KEYS}
+
+
+def top_predictions(class_names, probabilities, n=3, min_probability=0.01):
+    """The n most likely classes above min_probability, most likely first."""
+    top = []
+    for idx in np.argsort(probabilities)[::-1][:n]:
+        if probabilities[idx] > min_probability:
+            top.append({'class': class_names[idx], 'probability': round(float(probabilities[idx]), 3)})
+    return top
+
+
+class SpiderClassifier:
+    """A SPIDER model (or ensemble) ready to classify regions in this process.
+
+    Models come from the process-wide registry, so several classifiers over
+    the same model share its weights.
+    """
+
+    def __init__(self, model_path, device=None, ensemble=(), ensemble_threads=1, augmenter=None,
+                 stain_cache_dir=None, batch_size=DEFAULT_BATCH_SIZE):
+        registry = get_registry(device)
+        self.device = registry.device
+        self.model_path = model_path
+        self._registry = registry
+        self._entry = entry = registry.acquire(model_path)
+        self.model = entry.model
+        self.processor = entry.processor
+        self.model_type = entry.model_type
+        self.class_names = entry.class_names
+        self.batch_size = batch_size
+
+        # Ensemble: the primary model plus `ensemble` models, predicting over the union of their classes
+        self.ensemble = None
+        if ensemble:
+            self.ensemble = ModelEnsemble([model_path] + list(ensemble), self.device, threads=ensemble_threads)
+            self.class_names = self.ensemble.class_names
+            self.model_type = "ensemble"
+
+        # Fast preprocessing straight from RGBA regions (falls back to AutoProcessor); its buffers
+        # grow to the largest batch actually classified rather than being sized for batch_size up front
+        try:
+            self.preprocessor = FastPreprocessor.from_pretrained(model_path, device=self.device)
+        except Exception as e:
+            print(f"Fast preprocessing unavailable, using AutoProcessor: {str(e)}")
+            self.preprocessor = None
+
+        # Optional test-time augmentation of low-confidence regions
+        self.augmenter = augmenter
+        if augmenter is not None and self.ensemble is not None:
+            print("TTA is not applied in ensemble mode")
+            self.augmenter = None
+        if self.augmenter is not None:
+            print(f"TTA enabled: {len(self.augmenter.views)} views below confidence "
+                  f"{self.augmenter.confidence_threshold} or margin {self.augmenter.margin_threshold}")
+
+        # Slide handles stay open for the classifier's lifetime
+        self.slides = SlideHandles(open_slide)
+
+        # Optional stain normalization; stain matrices are estimated once per slide
+        self.stains = StainNormalizers(stain_cache_dir, open_slide) if stain_cache_dir is not None else None
+
+    @classmethod
+    def from_args(cls, model_path, args, output_dir):
+        """Classifier configured from the classifiers' command-line options."""
+        return cls(model_path,
+                   ensemble=getattr(args, 'ensemble', []),
+                   ensemble_threads=getattr(args, 'ensemble_threads', 1),
+                   augmenter=TestTimeAugmenter.from_args(args),
+                   stain_cache_dir=output_dir if args.stain_normalize else None)
+
+    def stain_for(self, slide_path):
+        """Stain normalizer of a slide, or None when normalization is off or unavailable."""
+        if self.stains is None:
+            return None
+        return self.stains.get(slide_path, self.slides.get(slide_path))
+
+    def _inputs(self, images, stain=None):
+        if self.preprocessor is not None:
+            return self.preprocessor.inputs(images, stain)
+        images = [stain.apply_image(image) if stain is not None else as_rgb_image(image) for image in images]
+        inputs = self.processor(images=images, return_tensors="pt")
+        return {k: v.to(self.device) if isinstance(v, torch.Tensor) else v for k, v in inputs.items()}
+
+    def predict_proba(self, images, stain=None):
+        """Class probabilities, shape (N, len(class_names)), without TTA.
+
+        `images` is a list of PIL images or (H, W, 3|4) uint8 arrays, a single
+        one, or an (N, H, W, 3|4) array.
+        """
+        if isinstance(images, Image.Image) or (isinstance(images, np.ndarray) and images.ndim < 4):
+            images = [images]
+        images = list(images)
+
+        if self.ensemble is not None:
+            probabilities = [self.ensemble.predict(image, detailed=False, stain=stain)['probabilities']
+                             for image in images]
+            return np.stack(probabilities) if probabilities else np.zeros((0, len(self.class_names)))
+
+        batches = []
+        for start in range(0, len(images), self.batch_size):
+            inputs = self._inputs(images[start:start + self.batch_size], stain)
+            with torch.no_grad():
+                logits = self.model(**inputs).logits
+            batches.append(torch.softmax(logits, dim=1).cpu().numpy())
+        return np.concatenate(batches) if batches else np.zeros((0, len(self.class_names)), dtype=np.float32)
+
+    def _result(self, probabilities, extra=None):
+        prediction_idx = int(probabilities.argmax())
+        return {
+            'prediction': self.class_names[prediction_idx],
+            'probabilities': probabilities,
+            'confidence': float(probabilities[prediction_idx]),
+            **(extra or {})
+        }
+
+    def classify(self, image, stain=None, detailed=True):
+        """Classify one region.
+
+        Returns prediction, probabilities (array over class_names) and
+        confidence; TTA adds 'augmentations' and 'agreement', ensembles add
+        per-model 'models' and 'disagreement' (without the per-model
+        probabilities when detailed=False).
+        """
+        if self.ensemble is not None:
+            output = self.ensemble.predict(image, detailed=detailed, stain=stain)
+            return self._result(output['probabilities'],
+                                {'models': output['models'], 'disagreement': output['disagreement']})
+
+        inputs = self._inputs([image], stain)
+        with torch.no_grad():
+            logits = self.model(**inputs).logits
+        probabilities = torch.softmax(logits[0], dim=0)
+        extra = {}
+        if self.augmenter is not None:
+            probabilities, extra = self.augmenter(self.model, inputs['pixel_values'], probabilities)
+        return self._result(probabilities.cpu().numpy(), extra)
+
+    def classify_images(self, images, stain=None, detailed=True):
+        """Yield one classify() result per image, batched when there is no TTA or ensemble."""
+        if self.augmenter is not None or self.ensemble is not None:
+            for image in images:
+                yield self.classify(image, stain, detailed)
+            return
+        images = list(images)
+        for start in range(0, len(images), self.batch_size):
+            for probabilities in self.predict_proba(images[start:start + self.batch_size], stain):
+                yield self._result(probabilities)
+
+    def read_annotation(self, annotation):
+        """Context window of an annotation spec ({'slide_path', 'roi'[, 'downsample']})."""
+        slide = self.slides.get(annotation['slide_path'])
+        return read_region_with_context(slide, annotation['roi'], float(annotation.get('downsample', 1.0)))
+
+    def _classify_batch(self, batch, stain):
+        # One result per (annotation, region), None where the region could not be read. A failing
+        # batch is retried region by region so a single bad region does not lose the others.
+        regions = [region for _, region in batch if region is not None]
+        try:
+            results = iter(list(self.classify_images(regions, stain)))
+        except Exception as e:
+            if len(regions) > 1:
+                return [self._classify_batch([item], stain)[0] for item in batch]
+            annotation = next(annotation for annotation, region in batch if region is not None)
+            print(f"Error classifying annotation {annotation.get('id')}: {str(e)}")
+            results = iter([None])
+        return [next(results) if region is not None else None for _, region in batch]
+
+    def classify_annotations(self, annotations, io_concurrency=1):
+        """Yield (annotation, result) for every annotation spec.
+
+        result is None when the region cannot be read or classified (the error
+        is printed). Regions are classified batch_size at a time (one at a time
+        with TTA or an ensemble). With io_concurrency > 1 reads
+        overlap (slides on network shares) and results come in completion order.
+        """
+        def read(annotation):
+            try:
+                return self.read_annotation(annotation)
+            except Exception as e:
+                print(f"Error extracting region for annotation {annotation.get('id')}: {str(e)}")
+                return None
+
+        if io_concurrency > 1:
+            regions = iter_regions(annotations, read, concurrency=io_concurrency)
+        else:
+            regions = ((annotation, read(annotation)) for annotation in annotations)
+
+        # Unreadable annotations wait in the batch so results keep the order of the reads
+        batch_size = self.batch_size if self.augmenter is None and self.ensemble is None else 1
+        batch, batch_stain, batch_regions = [], None, 0
+        for annotation, region in regions:
+            if region is not None:
+                # A batch shares one stain normalizer, so a change of normalizer starts a new batch
+                stain = self.stain_for(annotation['slide_path'])
+                if batch_regions and stain is not batch_stain:
+                    yield from zip([a for a, _ in batch], self._classify_batch(batch, batch_stain))
+                    batch, batch_regions = [], 0
+                batch_stain = stain
+                batch_regions += 1
+            batch.append((annotation, region))
+            if batch_regions >= batch_size:
+                yield from zip([a for a, _ in batch], self._classify_batch(batch, batch_stain))
+                batch, batch_regions = [], 0
+        if batch:
+            yield from zip([a for a, _ in batch], self._classify_batch(batch, batch_stain))
+
+    def probability_dict(self, probabilities, decimals=None):
+        """{class name: probability}, optionally rounded."""
+        return {name: round(float(p), decimals) if decimals is not None else float(p)
+                for name, p in zip(self.class_names, probabilities)}
+
+    def stats(self):
+        """Tile cache, stain normalization and TTA counters of this process."""
+        stats = {'tile_cache': get_tile_cache().stats()}
+        if self.stains is not None:
+            stats['stain_normalization'] = self.stains.stats()
+        if self.augmenter is not None:
+            stats['tta'] = self.augmenter.stats()
+        return stats
+
+    def close(self):
+        self.slides.close()
+        if self.ensemble is not None:
+            self.ensemble.close()
+        if self._entry is not None:
+            self._registry.release(self._entry)
+            self._entry = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
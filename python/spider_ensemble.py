@@ -0,0 +1,140 @@
+# spider_ensemble.py
+# Multi-model ensemble sharing one slide read and preprocessing pass
+# Each region is read once and preprocessed once per distinct preprocessing
+# configuration (normally once: the SPIDER models share theirs), then fed to every
+# model, sequentially or from a thread pool. Per-model predictions are kept next
+# to the aggregated prediction over the union of the models' classes.
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from spider_model_registry import get_registry
+from spider_preprocessing import FastPreprocessor, as_rgb_image
+
+# Preprocessor config keys that do not affect the pixel values
+IGNORED_PREPROCESSING_KEYS = ('processor_class', 'image_processor_type', 'auto_map', 'feature_extractor_type')
+
+
+def preprocessing_signature(model_path):
+    """Identity of a model's preprocessing, so models with equal settings share inputs."""
+    config_path = os.path.join(model_path, 'preprocessor_config.json')
+    if not os.path.exists(config_path):
+        return model_path
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    for key in IGNORED_PREPROCESSING_KEYS:
+        config.pop(key, None)
+    return json.dumps(config, sort_keys=True)
+
+
+class ModelEnsemble:
+    """Several SPIDER models evaluated on the same preprocessed regions."""
+
+    def __init__(self, model_paths, device=None, threads=1):
+        registry = get_registry(device)
+        self.device = registry.device
+        self._registry = registry
+        self.entries = [registry.acquire(path) for path in model_paths]
+
+        # Member names: model type, disambiguated when two models share a type
+        self.names = []
+        for entry in self.entries:
+            name = entry.model_type
+            if name in self.names:
+                name = f"{entry.model_type}_{entry.key[:6]}"
+            self.names.append(name)
+
+        # Union of class names in first-seen order, and each model's indices into it
+        self.class_names = []
+        for entry in self.entries:
+            self.class_names.extend(c for c in entry.class_names if c not in self.class_names)
+        self._class_index = [np.array([self.class_names.index(c) for c in entry.class_names])
+                             for entry in self.entries]
+
+        # One preprocessor per distinct preprocessing configuration
+        self._groups = {}
+        self._member_group = []
+        for entry in self.entries:
+            signature = preprocessing_signature(entry.model_path)
+            if signature not in self._groups:
+                try:
+                    fast = FastPreprocessor.from_pretrained(entry.model_path, device=self.device)
+                except Exception as e:
+                    print(f"Fast preprocessing unavailable for {entry.model_path}, using AutoProcessor: {str(e)}")
+                    fast = None
+                self._groups[signature] = (fast, entry.processor)
+            self._member_group.append(signature)
+
+        self.threads = threads
+        self._executor = None
+        self._executor_pid = None
+        print(f"Ensemble of {len(self.entries)} models ({', '.join(self.names)}), "
+              f"{len(self._groups)} preprocessing pass(es) per region, {len(self.class_names)} classes")
+
+    def _inputs(self, signature, image, stain=None):
+        fast, processor = self._groups[signature]
+        if fast is not None:
+            inputs = fast.inputs(image, stain)
+        else:
+            image = stain.apply_image(image) if stain is not None else as_rgb_image(image)
+            inputs = processor(images=image, return_tensors="pt")
+        return {k: v.to(self.device) if isinstance(v, torch.Tensor) else v for k, v in inputs.items()}
+
+    def _run(self, member, inputs):
+        with torch.no_grad():
+            logits = self.entries[member].model(**inputs).logits
+        return torch.softmax(logits[0], dim=0).cpu().numpy()
+
+    def predict(self, image, detailed=True, stain=None):
+        """Predict one region with every model.
+
+        Returns the aggregated prediction (the mean of the models' distributions
+        over the union of classes), each model's prediction, and the
+        disagreement: the fraction of models not voting for the most common class.
+        With detailed=False per-model probabilities are omitted. An optional
+        spider_stain.StainNormalizer is applied in the shared preprocessing.
+        """
+        # Shared read and preprocessing
+        inputs = {signature: self._inputs(signature, image, stain) for signature in self._groups}
+        jobs = [(i, inputs[self._member_group[i]]) for i in range(len(self.entries))]
+        if self.threads > 1:
+            # Thread pools do not survive fork; forked workers create their own
+            if self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(self.threads)
+                self._executor_pid = os.getpid()
+            member_probs = list(self._executor.map(lambda job: self._run(*job), jobs))
+        else:
+            member_probs = [self._run(*job) for job in jobs]
+
+        aggregated = np.zeros(len(self.class_names), dtype=np.float64)
+        models = {}
+        votes = {}
+        for name, entry, index, probs in zip(self.names, self.entries, self._class_index, member_probs):
+            np.add.at(aggregated, index, probs)
+            top = int(probs.argmax())
+            prediction = entry.class_names[top]
+            votes[prediction] = votes.get(prediction, 0) + 1
+            models[name] = {'prediction': prediction, 'confidence': round(float(probs[top]), 3)}
+            if detailed:
+                models[name]['probabilities'] = {c: round(float(p), 3) for c, p in zip(entry.class_names, probs)}
+        aggregated /= len(self.entries)
+
+        prediction_idx = int(aggregated.argmax())
+        return {
+            'prediction': self.class_names[prediction_idx],
+            'probabilities': aggregated,
+            'confidence': float(aggregated[prediction_idx]),
+            'models': models,
+            'disagreement': round(1.0 - max(votes.values()) / len(self.entries), 3)
+        }
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        for entry in self.entries:
+            self._registry.release(entry)
+        self.entries = []
@@ -0,0 +1,296 @@
+# spider_execution.py
+# Execution planning for CPU/GPU inference
+# Chooses the number of inference worker processes and the torch threads per worker
+# from the core count, NUMA layout, memory and batch size, so that workers do not
+# each try to use every core. Workers can be pinned to the cores of one NUMA node.
+# A tuned configuration per machine can be stored with the autotune subcommand:
+#   python spider_execution.py autotune <model_path> <slide_path> [--sample 32]
+
+import os
+import sys
+import json
+import glob
+import time
+import platform
+import argparse
+
+# Tuned configurations, keyed by machine fingerprint
+PROFILE_PATH = os.path.join(os.path.expanduser('~'), '.spider', 'execution_profiles.json')
+
+# Working memory of one in-flight patch (activations, buffers), beyond the model weights
+PATCH_WORKING_BYTES = 512 * 1024 * 1024
+
+# Fraction of physical memory the workers may use
+MEMORY_FRACTION = 0.7
+
+# Threads per worker for automatic CPU plans; beyond a few threads a single
+# forward pass scales poorly, so more workers with fewer threads win
+TARGET_THREADS_PER_WORKER = 4
+
+
+def available_cpus():
+    """CPUs this process may run on (respects taskset/cgroup affinity where available)."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _parse_cpulist(text):
+    cpus = []
+    for part in text.strip().split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_nodes():
+    """CPUs of each NUMA node (Linux sysfs); a single node elsewhere."""
+    allowed = set(available_cpus())
+    nodes = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')):
+        with open(path, 'r') as f:
+            cpus = [cpu for cpu in _parse_cpulist(f.read()) if cpu in allowed]
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [sorted(allowed)]
+
+
+def total_memory_bytes():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def machine_fingerprint():
+    """Identity of the machine a tuned configuration applies to."""
+    import torch
+    memory = total_memory_bytes()
+    return '|'.join([
+        platform.node(),
+        platform.machine(),
+        str(len(available_cpus())),
+        str(memory // (1024 ** 3) if memory else 0),
+        torch.__version__,
+        'cuda' if torch.cuda.is_available() else 'cpu'
+    ])
+
+
+def _assign_cpus(workers, threads, nodes):
+    """CPU set of each worker: workers go round-robin over NUMA nodes, each taking `threads` CPUs of its node."""
+    free = [list(cpus) for cpus in nodes]
+    cpu_sets = []
+    for w in range(workers):
+        node = free[w % len(free)]
+        if len(node) < threads:
+            node = max(free, key=len)
+        cpus = node[:threads]
+        del node[:threads]
+        cpu_sets.append(cpus)
+    return cpu_sets
+
+
+def plan_execution(requested_workers=0, model_nbytes=0, batch_size=1, device_type='cpu', pin=True,
+                   shared_weights=False):
+    """Choose workers and threads per worker.
+
+    requested_workers > 0 fixes the worker count (threads are still divided
+    among workers); 0 picks it automatically, preferring a stored autotuned
+    configuration for this machine. With shared_weights the workers map one
+    copy of the model (spider_shared_weights), so it counts against memory once.
+    """
+    cpus = available_cpus()
+    nodes = numa_nodes()
+    memory = total_memory_bytes()
+    source = 'requested' if requested_workers > 0 else 'planned'
+
+    if requested_workers > 0:
+        workers = requested_workers
+    else:
+        tuned = load_tuned_plan()
+        if tuned is not None:
+            workers = tuned['workers']
+            source = 'autotuned'
+        elif device_type == 'cuda':
+            # One process drives the GPU; CPU threads only feed it
+            workers = 1
+        else:
+            # At least one worker per NUMA node
+            workers = max(len(nodes), len(cpus) // TARGET_THREADS_PER_WORKER)
+
+    # Every worker holds its in-flight patches, and the model unless the weights are shared
+    if memory and requested_workers <= 0:
+        budget = memory * MEMORY_FRACTION
+        per_worker = batch_size * PATCH_WORKING_BYTES
+        if shared_weights:
+            budget -= model_nbytes
+        else:
+            per_worker += model_nbytes
+        workers = min(workers, max(1, int(budget // max(per_worker, 1))))
+    workers = max(1, min(workers, len(cpus)))
+
+    threads = max(1, len(cpus) // workers)
+    plan = {
+        'workers': workers,
+        'threads_per_worker': threads,
+        'interop_threads': 1,
+        'cpus': len(cpus),
+        'numa_nodes': len(nodes),
+        'memory_gb': round(memory / 1024 ** 3, 1) if memory else None,
+        'batch_size': batch_size,
+        'source': source,
+        'shared_weights': shared_weights,
+        'cpu_sets': _assign_cpus(workers, threads, nodes) if pin and workers > 1 else None
+    }
+    return plan
+
+
+def apply_worker_settings(plan, worker_index=0):
+    """Apply a plan's thread counts and CPU pinning to the current process."""
+    import torch
+    torch.set_num_threads(plan['threads_per_worker'])
+    try:
+        torch.set_num_interop_threads(plan['interop_threads'])
+    except RuntimeError:
+        # Inter-op threads can only be set before the first parallel operation
+        pass
+
+    cpu_sets = plan.get('cpu_sets')
+    if cpu_sets and hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, cpu_sets[worker_index % len(cpu_sets)])
+        except OSError as e:
+            print(f"Could not pin worker {worker_index}: {str(e)}")
+
+
+def describe(plan):
+    pinned = "pinned per NUMA node" if plan.get('cpu_sets') else "unpinned"
+    shared = ", shared weights" if plan.get('shared_weights') else ""
+    return (f"{plan['workers']} worker(s) x {plan['threads_per_worker']} thread(s) "
+            f"on {plan['cpus']} CPUs / {plan['numa_nodes']} NUMA node(s), {pinned}{shared} ({plan['source']})")
+
+
+def load_tuned_plan(path=PROFILE_PATH):
+    """Stored autotuned configuration for this machine, or None."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            profiles = json.load(f)
+        return profiles.get(machine_fingerprint())
+    except (OSError, ValueError, ImportError):
+        return None
+
+
+def save_tuned_plan(result, path=PROFILE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    profiles = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            profiles = json.load(f)
+    profiles[machine_fingerprint()] = result
+    with open(path, 'w') as f:
+        json.dump(profiles, f, indent=2)
+
+
+# Autotuning: each candidate runs the same sample of patches in a fresh pool
+
+_worker_state = {}
+
+
+def _autotune_init(plan, counter, model_path, slide_path, patch_size):
+    with counter.get_lock():
+        worker_index = counter.value
+        counter.value += 1
+    apply_worker_settings(plan, worker_index)
+
+    from spider_readers import open_reader
+    from spider_model_registry import get_registry
+    from spider_preprocessing import FastPreprocessor
+    _worker_state['slide'] = open_reader(slide_path)
+    _worker_state['model'] = get_registry().get(model_path).model
+    _worker_state['preprocessor'] = FastPreprocessor.from_pretrained(model_path)
+    _worker_state['patch_size'] = patch_size
+
+
+def _autotune_patch(location):
+    import torch
+    size = _worker_state['patch_size']
+    patch = _worker_state['slide'].read_region(location, 0, (size, size))
+    with torch.no_grad():
+        _worker_state['model'](**_worker_state['preprocessor'].inputs(patch))
+    return 1
+
+
+def candidate_plans(model_nbytes, batch_size=1):
+    cpus = len(available_cpus())
+    plans = []
+    workers = 1
+    while workers <= cpus:
+        plan = plan_execution(workers, model_nbytes, batch_size)
+        memory = total_memory_bytes()
+        per_worker = model_nbytes + batch_size * PATCH_WORKING_BYTES
+        if not memory or workers * per_worker <= memory * MEMORY_FRACTION:
+            plans.append(plan)
+        workers *= 2
+    return plans
+
+
+def autotune(model_path, slide_path, sample=32, patch_size=1120):
+    """Time each candidate configuration on the same patches; store and return the best."""
+    import multiprocessing as mp
+    import numpy as np
+    from spider_readers import open_reader
+    from spider_model_registry import estimate_nbytes
+
+    slide = open_reader(slide_path)
+    width, height = slide.dimensions
+    slide.close()
+    rng = np.random.default_rng(0)
+    locations = [(int(x), int(y)) for x, y in zip(rng.integers(0, max(1, width - patch_size), sample),
+                                                  rng.integers(0, max(1, height - patch_size), sample))]
+
+    measurements = []
+    for plan in candidate_plans(estimate_nbytes(model_path)):
+        counter = mp.Value('i', 0)
+        with mp.Pool(plan['workers'], initializer=_autotune_init,
+                     initargs=(plan, counter, model_path, slide_path, patch_size)) as pool:
+            # Warm-up: load the model and touch the code paths in every worker
+            pool.map(_autotune_patch, locations[:plan['workers']], chunksize=1)
+            start = time.time()
+            pool.map(_autotune_patch, locations, chunksize=1)
+            elapsed = time.time() - start
+        rate = len(locations) / elapsed
+        print(f"{describe(plan)}: {rate:.2f} patches/s")
+        measurements.append((rate, plan))
+
+    rate, best = max(measurements, key=lambda m: m[0])
+    result = {**best, 'source': 'autotuned', 'patches_per_second': round(rate, 3),
+              'tuned_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    save_tuned_plan(result)
+    print(f"Best: {describe(result)} at {rate:.2f} patches/s (saved to {PROFILE_PATH})")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SPIDER execution planning")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('show', help="Print the plan for this machine")
+    tune = subparsers.add_parser('autotune', help="Sweep worker/thread configurations and store the best")
+    tune.add_argument('model_path')
+    tune.add_argument('slide_path')
+    tune.add_argument('--sample', type=int, default=32, help="Patches per configuration (default: 32)")
+    args = parser.parse_args()
+
+    if args.command == 'autotune':
+        autotune(args.model_path, args.slide_path, args.sample)
+    elif args.command == 'show':
+        plan = plan_execution()
+        print(describe(plan))
+        print(json.dumps(plan, indent=2))
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,158 @@
+# spider_geojson.py
+# Bulk export of whole-slide patch predictions as QuPath-importable GeoJSON
+# Each patch becomes a detection with its class and per-class probability
+# measurements; optionally, adjacent tiles of the same class are merged into
+# polygons first. Import with scripts/spider_import_detections.groovy or
+# QuPath's File > Import objects.
+
+import json
+
+DETECTIONS_FILENAME = 'detections.geojson'
+
+try:
+    from shapely.geometry import box, mapping
+    from shapely.ops import unary_union
+    HAS_SHAPELY = True
+except ImportError:
+    HAS_SHAPELY = False
+
+
+def hex_to_rgb(color_hex):
+    return [int(color_hex[i:i + 2], 16) for i in (1, 3, 5)]
+
+
+def tile_bounds(result, patch_extent, cell_extent):
+    """Level-0 bounds of the cell a patch represents.
+
+    With overlapping patches (stride < patch size) each patch is reduced to the
+    stride-sized cell at its centre, so tiles cover the slide without overlap.
+    """
+    size = min(patch_extent, cell_extent)
+    offset = (patch_extent - size) // 2
+    x0 = result['x'] + offset
+    y0 = result['y'] + offset
+    return x0, y0, x0 + size, y0 + size
+
+
+def _rectangle(x0, y0, x1, y1):
+    return {
+        'type': 'Polygon',
+        'coordinates': [[[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]]
+    }
+
+
+def _feature(geometry, class_name, color, measurements):
+    return {
+        'type': 'Feature',
+        'geometry': geometry,
+        'properties': {
+            'objectType': 'detection',
+            'classification': {'name': class_name, 'color': color},
+            'measurements': measurements
+        }
+    }
+
+
+def tile_features(results, class_names, colors, patch_extent, cell_extent):
+    """One detection per patch with its confidence and class probabilities."""
+    features = []
+    for result in results:
+        class_name = result['prediction']
+        measurements = {'SPIDER: Confidence': round(result['confidence'] * 100.0, 2)}
+        for name, prob in zip(class_names, result['probabilities']):
+            measurements[f"SPIDER: {name}"] = round(prob * 100.0, 2)
+        features.append(_feature(
+            _rectangle(*tile_bounds(result, patch_extent, cell_extent)),
+            class_name,
+            hex_to_rgb(colors.get(class_name, '#808080')),
+            measurements
+        ))
+    return features
+
+
+def _merge_runs(bounds):
+    """Merge horizontally adjacent cells of one row into rectangles (no shapely)."""
+    rows = {}
+    for x0, y0, x1, y1 in sorted(bounds, key=lambda b: (b[1], b[0])):
+        row = rows.setdefault((y0, y1), [])
+        if row and row[-1][1] == x0:
+            row[-1][1] = x1
+        else:
+            row.append([x0, x1])
+    return [(x0, y0, x1, y1) for (y0, y1), runs in rows.items() for x0, x1 in runs]
+
+
+def _components(cells):
+    """Group grid cells into 4-connected components (iterative flood fill)."""
+    remaining = set(cells)
+    components = []
+    while remaining:
+        stack = [remaining.pop()]
+        component = []
+        while stack:
+            gx, gy = stack.pop()
+            component.append((gx, gy))
+            for neighbour in ((gx + 1, gy), (gx - 1, gy), (gx, gy + 1), (gx, gy - 1)):
+                if neighbour in remaining:
+                    remaining.remove(neighbour)
+                    stack.append(neighbour)
+        components.append(component)
+    return components
+
+
+def merged_features(results, class_names, colors, patch_extent, cell_extent):
+    """One detection per connected same-class region, with tile count and mean probabilities.
+
+    The outline is the shapely union of the region's tiles when shapely is
+    installed; otherwise it is a MultiPolygon of the row runs of the region.
+    """
+    by_class = {}
+    for result in results:
+        cell = (result['x'] // cell_extent, result['y'] // cell_extent)
+        by_class.setdefault(result['prediction'], {})[cell] = result
+
+    features = []
+    for class_name, cells in by_class.items():
+        color = hex_to_rgb(colors.get(class_name, '#808080'))
+        for component in _components(cells):
+            members = [cells[cell] for cell in component]
+            bounds = [tile_bounds(r, patch_extent, cell_extent) for r in members]
+            if HAS_SHAPELY:
+                geometry = mapping(unary_union([box(*b) for b in bounds]))
+            else:
+                runs = _merge_runs(bounds)
+                geometry = {
+                    'type': 'MultiPolygon',
+                    'coordinates': [_rectangle(*run)['coordinates'] for run in runs]
+                }
+
+            n = len(members)
+            measurements = {
+                'SPIDER: Tiles': n,
+                'SPIDER: Confidence': round(sum(r['confidence'] for r in members) / n * 100.0, 2)
+            }
+            for i, name in enumerate(class_names):
+                measurements[f"SPIDER: {name}"] = round(sum(r['probabilities'][i] for r in members) / n * 100.0, 2)
+            features.append(_feature(geometry, class_name, color, measurements))
+    return features
+
+
+def write_detections(path, results, class_names, colors, patch_extent, cell_extent, merge=False):
+    """Write a FeatureCollection of detections; returns the number of features.
+
+    Features are written one per line without indentation, which keeps 50k-tile
+    files compact and fast to produce and parse.
+    """
+    if merge:
+        features = merged_features(results, class_names, colors, patch_extent, cell_extent)
+    else:
+        features = tile_features(results, class_names, colors, patch_extent, cell_extent)
+
+    with open(path, 'w') as f:
+        f.write('{"type": "FeatureCollection", "features": [\n')
+        for i, feature in enumerate(features):
+            if i:
+                f.write(',\n')
+            f.write(json.dumps(feature, separators=(',', ':')))
+        f.write('\n]}\n')
+    return len(features)
@@ -0,0 +1,269 @@
+# spider_history.py
+# Prediction history store: SQLite in WAL mode with buffered batch writes
+# Replaces the append-only prediction_history*.jsonl files (one open/close per
+# region, unbounded and unqueryable). Records are indexed by annotation ID,
+# image name, model type and timestamp; the latest prediction per annotation is
+# one indexed lookup, and compaction drops superseded predictions. Existing
+# JSONL history files in the same folder are imported once, on first open.
+#
+#   python spider_history.py <output_dir> latest [--annotation ID] [--image NAME] [--model-type TYPE]
+#   python spider_history.py <output_dir> query --image NAME --since 2026-01-01
+#   python spider_history.py <output_dir> compact
+#   python spider_history.py <output_dir> stats
+
+import os
+import glob
+import json
+import sqlite3
+import argparse
+from datetime import datetime
+
+HISTORY_FILENAME = 'prediction_history.db'
+
+# Legacy JSONL histories imported on first open
+LEGACY_PATTERN = 'prediction_history*.jsonl'
+
+# Records buffered before one batched insert
+DEFAULT_BUFFER_SIZE = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    annotation_id TEXT,
+    image_name TEXT,
+    model_type TEXT,
+    timestamp TEXT,
+    prediction TEXT,
+    confidence REAL,
+    record TEXT NOT NULL,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS predictions_annotation ON predictions (annotation_id, model_type, seq);
+CREATE INDEX IF NOT EXISTS predictions_image ON predictions (image_name, seq);
+CREATE INDEX IF NOT EXISTS predictions_model_type ON predictions (model_type, seq);
+CREATE INDEX IF NOT EXISTS predictions_timestamp ON predictions (timestamp);
+CREATE TABLE IF NOT EXISTS imported_files (
+    name TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime INTEGER,
+    records INTEGER
+);
+"""
+
+COLUMNS = ('annotation_id', 'image_name', 'model_type', 'timestamp', 'prediction', 'confidence', 'record', 'source')
+
+
+class PredictionHistory:
+    """Buffered, indexed prediction history in one SQLite file."""
+
+    def __init__(self, path, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.path = path
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self.connection = sqlite3.connect(path)
+        # WAL: readers (e.g. a query while a run is writing) never block the writer
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        # Databases from before rows recorded the JSONL file they were imported from
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(predictions)")]
+        if 'source' not in columns:
+            self.connection.execute("ALTER TABLE predictions ADD COLUMN source TEXT")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS predictions_source ON predictions (source)")
+
+    @classmethod
+    def open(cls, output_dir, buffer_size=DEFAULT_BUFFER_SIZE, import_legacy=True):
+        """History of an output folder, importing its JSONL histories not imported before."""
+        history = cls(os.path.join(output_dir, HISTORY_FILENAME), buffer_size)
+        if import_legacy:
+            for jsonl_path in sorted(glob.glob(os.path.join(output_dir, LEGACY_PATTERN))):
+                history.import_jsonl(jsonl_path)
+        return history
+
+    def _row(self, record, model_type=None, source=None):
+        confidence = record.get('confidence')
+        if confidence is None and record.get('probabilities') and record.get('prediction') is not None:
+            confidence = record['probabilities'].get(record['prediction'])
+        return (
+            None if record.get('id') is None else str(record['id']),
+            record.get('image_name'),
+            record.get('model_type', model_type),
+            record.get('timestamp') or datetime.now().isoformat(),
+            record.get('prediction'),
+            confidence,
+            json.dumps(record),
+            source
+        )
+
+    def add(self, record, model_type=None):
+        """Queue one result record; written with the next batch."""
+        self._buffer.append(self._row(record, model_type))
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT INTO predictions ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                self._buffer)
+        self._buffer = []
+
+    def import_jsonl(self, jsonl_path, model_type=None):
+        """Import a JSONL history once (keyed by name, size and modification time)."""
+        stat = os.stat(jsonl_path)
+        name = os.path.basename(jsonl_path)
+        row = self.connection.execute("SELECT size, mtime, records FROM imported_files WHERE name = ?",
+                                       (name,)).fetchone()
+        if row is not None and row[:2] == (stat.st_size, int(stat.st_mtime)):
+            return 0
+        # A file that only grew since its import (still being appended to) is imported from where it ended
+        offset = row[0] if row is not None and stat.st_size > row[0] else 0
+        if row is not None and offset == 0:
+            # Replace what the earlier import of this file added rather than adding it twice
+            self.flush()
+            with self.connection:
+                removed = self.connection.execute("DELETE FROM predictions WHERE source = ?", (name,)).rowcount
+            print(f"{name} was rewritten since it was imported; replacing its {removed} imported records")
+
+        # prediction_history_<model type>.jsonl carries its model type in the name
+        if model_type is None and name.startswith('prediction_history_'):
+            model_type = name[len('prediction_history_'):-len('.jsonl')]
+
+        self.flush()
+        count = 0
+        with open(jsonl_path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    self._buffer.append(self._row(json.loads(line), model_type, source=name))
+                except ValueError:
+                    continue
+                count += 1
+                if len(self._buffer) >= 10 * self.buffer_size:
+                    self.flush()
+        self.flush()
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO imported_files VALUES (?, ?, ?, ?)",
+                                    (name, stat.st_size, int(stat.st_mtime), count + (row[2] if offset else 0)))
+        print(f"Imported {count} records from {name} into {os.path.basename(self.path)}")
+        return count
+
+    def _where(self, annotation_id=None, image_name=None, model_type=None, since=None, until=None):
+        clauses, params = [], []
+        for column, value in (('annotation_id', annotation_id), ('image_name', image_name),
+                              ('model_type', model_type)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(str(value))
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("timestamp < ?")
+            params.append(until)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def query(self, annotation_id=None, image_name=None, model_type=None, since=None, until=None, limit=None):
+        """Yield records matching every given filter, oldest first (timestamps are ISO strings)."""
+        self.flush()
+        where, params = self._where(annotation_id, image_name, model_type, since, until)
+        sql = f"SELECT record FROM predictions{where} ORDER BY seq"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        for (record,) in self.connection.execute(sql, params):
+            yield json.loads(record)
+
+    def latest(self, annotation_id, model_type=None):
+        """Most recent record of one annotation, or None."""
+        self.flush()
+        where, params = self._where(annotation_id=annotation_id, model_type=model_type)
+        row = self.connection.execute(
+            f"SELECT record FROM predictions{where} ORDER BY seq DESC LIMIT 1", params).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def latest_per_annotation(self, image_name=None, model_type=None):
+        """{annotation ID: latest record} (per model type, the latest model type wins)."""
+        self.flush()
+        where, params = self._where(image_name=image_name, model_type=model_type)
+        rows = self.connection.execute(
+            f"SELECT annotation_id, record FROM predictions WHERE seq IN "
+            f"(SELECT MAX(seq) FROM predictions{where} GROUP BY annotation_id, model_type) ORDER BY seq", params)
+        return {annotation_id: json.loads(record) for annotation_id, record in rows}
+
+    def compact(self, keep_latest=1):
+        """Keep only the newest `keep_latest` records per (annotation, model type) and reclaim space."""
+        self.flush()
+        with self.connection:
+            removed = self.connection.execute(
+                "DELETE FROM predictions WHERE seq IN (SELECT seq FROM (SELECT seq, ROW_NUMBER() OVER "
+                "(PARTITION BY annotation_id, model_type ORDER BY seq DESC) AS rank FROM predictions) "
+                "WHERE rank > ?)", (keep_latest,)).rowcount
+        self.connection.execute('VACUUM')
+        self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return removed
+
+    def stats(self):
+        self.flush()
+        records, annotations, images = self.connection.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT annotation_id), COUNT(DISTINCT image_name) FROM predictions").fetchone()
+        model_types = dict(self.connection.execute(
+            "SELECT model_type, COUNT(*) FROM predictions GROUP BY model_type").fetchall())
+        return {
+            'records': records,
+            'annotations': annotations,
+            'images': images,
+            'model_types': model_types,
+            'size_mb': round(sum(os.path.getsize(path) for path in (self.path, self.path + '-wal')
+                                 if os.path.exists(path)) / 1e6, 2)
+        }
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query and maintain a SPIDER prediction history")
+    parser.add_argument('output_dir', help=f"Folder holding {HISTORY_FILENAME} (and any JSONL histories to import)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name in ('latest', 'query'):
+        command = commands.add_parser(name)
+        command.add_argument('--annotation', help="Annotation ID")
+        command.add_argument('--image', help="Image name")
+        command.add_argument('--model-type', help="Model type")
+        if name == 'query':
+            command.add_argument('--since', help="ISO timestamp (inclusive)")
+            command.add_argument('--until', help="ISO timestamp (exclusive)")
+            command.add_argument('--limit', type=int)
+    compact = commands.add_parser('compact')
+    compact.add_argument('--keep', type=int, default=1, help="Records kept per annotation and model type (default: 1)")
+    commands.add_parser('stats')
+    args = parser.parse_args()
+
+    with PredictionHistory.open(args.output_dir) as history:
+        if args.command == 'latest':
+            if args.annotation is not None:
+                print(json.dumps(history.latest(args.annotation, args.model_type), indent=2))
+            else:
+                print(json.dumps(history.latest_per_annotation(args.image, args.model_type), indent=2))
+        elif args.command == 'query':
+            for record in history.query(args.annotation, args.image, args.model_type, args.since, args.until,
+                                        args.limit):
+                print(json.dumps(record))
+        elif args.command == 'compact':
+            before = history.stats()['size_mb']
+            removed = history.compact(args.keep)
+            print(f"Removed {removed} superseded records; {before} MB -> {history.stats()['size_mb']} MB")
+        else:
+            print(json.dumps(history.stats(), indent=2))
@@ -0,0 +1,163 @@
+# spider_input.py
+# Incremental reader for annotation and tile inputs
+# Records are parsed one at a time, from a JSON array (the format the Groovy
+# scripts have always written) or from NDJSON (one record per line), so the
+# first region can be classified before the rest of a slide-wide export has
+# been read, and memory holds only the records in flight.
+#
+# Check against json.load on a generated export:
+#   python spider_input.py [--records 200000]
+
+import os
+import json
+import argparse
+
+# Characters read per chunk of a JSON array
+CHUNK_SIZE = 1 << 20
+
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl')
+
+_decoder = json.JSONDecoder()
+
+
+def is_ndjson(path):
+    """NDJSON by extension, or when the first non-blank character opens an object."""
+    if path.lower().endswith(NDJSON_EXTENSIONS):
+        return True
+    with open(path, 'r', encoding='utf-8') as f:
+        while True:
+            chunk = f.read(4096)
+            if not chunk:
+                return False
+            stripped = chunk.lstrip()
+            if stripped:
+                return stripped[0] == '{'
+
+
+def iter_json_array(f, chunk_size=CHUNK_SIZE):
+    """Yield the elements of a top-level JSON array from a text file, one at a time."""
+    buffer = ''
+    while not buffer:
+        more = f.read(chunk_size)
+        if not more:
+            break
+        buffer = more.lstrip()
+    if not buffer.startswith('['):
+        raise ValueError("Expected a JSON array")
+    position = 1
+    eof = False
+
+    def refill():
+        # Drop what has been consumed and append the next chunk
+        nonlocal buffer, position, eof
+        more = f.read(chunk_size)
+        eof = not more
+        buffer = buffer[position:] + more
+        position = 0
+
+    while True:
+        # Skip separators between elements
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) or eof:
+                break
+            refill()
+        if position >= len(buffer):
+            raise ValueError("Unterminated JSON array")
+        if buffer[position] == ']':
+            return
+
+        # Decode one element, reading more until it is complete; a value ending
+        # exactly at the end of the buffer (a number) may continue in the next chunk
+        while True:
+            try:
+                element, end = _decoder.raw_decode(buffer, position)
+            except ValueError:
+                if eof:
+                    raise
+                refill()
+                continue
+            if end == len(buffer) and not eof:
+                refill()
+                continue
+            break
+        yield element
+        position = end
+
+
+def iter_ndjson(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_records(path):
+    """Yield the records of a JSON array or NDJSON file lazily."""
+    with open(path, 'r', encoding='utf-8') as f:
+        if is_ndjson(path):
+            yield from iter_ndjson(f)
+        else:
+            yield from iter_json_array(f)
+
+
+def count_records(path):
+    """Number of records of an NDJSON file (a byte scan), or None for a JSON array."""
+    if not is_ndjson(path):
+        return None
+    count = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                count += 1
+    return count
+
+
+def open_records(path):
+    """Lazy records of an input file and their count (None when unknown until read)."""
+    total = count_records(path)
+    print(f"Reading {os.path.basename(path)} incrementally"
+          + (f" ({total} records)" if total is not None else ""))
+    return iter_records(path), total
+
+
+if __name__ == "__main__":
+    import time
+    import tempfile
+    import tracemalloc
+
+    parser = argparse.ArgumentParser(description="Compare the incremental reader with json.load")
+    parser.add_argument('--records', type=int, default=200000, help="Tile records to generate (default: 200000)")
+    args = parser.parse_args()
+
+    tiles = ({'id': f"tile_a_{i % 1000}_{i // 1000}", 'slide_path': '/slides/slide.svs', 'image_name': 'slide',
+              'parent_annotation_id': 'a', 'gridX': i % 1000, 'gridY': i // 1000,
+              'roi': {'x': 1120 * (i % 1000), 'y': 1120 * (i // 1000), 'width': 1120, 'height': 1120}}
+             for i in range(args.records))
+    folder = tempfile.mkdtemp()
+    array_path = os.path.join(folder, 'tiles_to_predict.json')
+    with open(array_path, 'w') as f:
+        json.dump(list(tiles), f, indent=2)
+    ndjson_path = os.path.join(folder, 'tiles_to_predict.ndjson')
+    with open(array_path, 'r') as src, open(ndjson_path, 'w') as dst:
+        for record in json.load(src):
+            dst.write(json.dumps(record) + '\n')
+    print(f"{args.records} records, {os.path.getsize(array_path) / 1e6:.0f} MB as a JSON array")
+
+    for name, read in (('json.load', lambda: json.load(open(array_path))),
+                       ('incremental array', lambda: iter_records(array_path)),
+                       ('incremental NDJSON', lambda: iter_records(ndjson_path))):
+        tracemalloc.start()
+        start = time.time()
+        records = iter(read())
+        first = next(records)
+        first_time = time.time() - start
+        count = 1 + sum(1 for _ in records)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{name}: first record after {1000 * first_time:.1f} ms, {count} records in "
+              f"{time.time() - start:.2f}s, peak {peak / 1e6:.1f} MB")
+
+    assert list(iter_records(array_path)) == json.load(open(array_path))
+    assert count_records(ndjson_path) == args.records and count_records(array_path) is None
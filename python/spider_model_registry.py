@@ -0,0 +1,249 @@
+# spider_model_registry.py
+# Warm registry of SPIDER models shared by the annotation classifiers and the whole-slide analyzer
+# Keeps several models resident under a RAM budget with LRU eviction. Models are keyed
+# by a hash of their configuration files and the size and modification time of their
+# weight files (so fine-tuned checkpoints of one architecture stay distinct), not by
+# substrings of their path. Models held by a classifier or ensemble are pinned and never
+# evicted, since dropping them from the registry would not free their memory.
+
+import os
+import glob
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+from transformers import AutoModel, AutoProcessor
+
+# Default RAM budget for resident models, overridable with SPIDER_MODEL_CACHE_MB
+DEFAULT_BUDGET_MB = 8192
+
+# Configuration files that identify a model
+CONFIG_FILES = ('config.json', 'preprocessor_config.json')
+
+# Weight files (single or sharded), identified by size and modification time
+WEIGHT_PATTERNS = ('*.safetensors', '*.bin', '*.pt', '*.pth')
+
+# Class names that identify each SPIDER model type
+MODEL_TYPE_MARKERS = {
+    "colorectal": ("Adenocarcinoma high grade", "Adenoma low grade", "Sessile serrated lesion"),
+    "skin": ("Basal Cell Carcinoma", "Melanoma invasive", "Squamous Cell Carcinoma"),
+    "thorax": ("Small cell carcinoma", "Non-small cell carcinoma", "Alveoli")
+}
+
+
+# Model directory -> key; directories are not expected to change during a run
+_key_cache = {}
+
+
+def config_hash(model_path):
+    """Stable identity of a model directory: SHA-1 of its configuration files and weight file stats."""
+    cache_key = os.path.abspath(model_path)
+    key = _key_cache.get(cache_key)
+    if key is not None:
+        return key
+    digest = hashlib.sha1()
+    for name in CONFIG_FILES:
+        path = os.path.join(model_path, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                digest.update(name.encode())
+                digest.update(f.read())
+    weight_paths = sorted({path for pattern in WEIGHT_PATTERNS
+                           for path in glob.glob(os.path.join(model_path, pattern))})
+    for path in weight_paths:
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    key = digest.hexdigest()[:16]
+    _key_cache[cache_key] = key
+    return key
+
+
+def detect_model_type(class_names, model_path=""):
+    """Model type from the class names in config.json, falling back to the path."""
+    class_set = set(class_names)
+    best_type, best_hits = "unknown", 0
+    for model_type, markers in MODEL_TYPE_MARKERS.items():
+        hits = sum(1 for marker in markers if marker in class_set)
+        if hits > best_hits:
+            best_type, best_hits = model_type, hits
+    if best_hits > 0:
+        return best_type
+
+    path_lower = model_path.lower()
+    for model_type in MODEL_TYPE_MARKERS:
+        if model_type in path_lower:
+            return model_type
+    return "unknown"
+
+
+def estimate_nbytes(model_path):
+    """Approximate resident size of a model before loading it (the size of its weight shards)."""
+    # Safetensors are preferred by from_pretrained, so .bin files next to them are not loaded
+    for pattern in ('*.safetensors', 'pytorch_model*.bin'):
+        paths = glob.glob(os.path.join(model_path, pattern))
+        if paths:
+            return sum(os.path.getsize(path) for path in paths)
+    return 0
+
+
+def model_nbytes(model):
+    """Resident size of a model's parameters and buffers."""
+    total = sum(p.numel() * p.element_size() for p in model.parameters())
+    total += sum(b.numel() * b.element_size() for b in model.buffers())
+    return total
+
+
+class RegisteredModel:
+    """A loaded model with its processor, class names and identity."""
+
+    def __init__(self, key, model_path, model, processor, class_names, model_type):
+        self.key = key
+        self.model_path = model_path
+        self.model = model
+        self.processor = processor
+        self.class_names = class_names
+        self.model_type = model_type
+        self.nbytes = model_nbytes(model)
+        # Holders that keep a reference to the model (see ModelRegistry.acquire)
+        self.pins = 0
+
+
+class ModelRegistry:
+    """LRU cache of loaded SPIDER models under a RAM budget."""
+
+    def __init__(self, budget_bytes=None, device=None):
+        if budget_bytes is None:
+            budget_bytes = int(os.environ.get('SPIDER_MODEL_CACHE_MB', DEFAULT_BUDGET_MB)) * 1024 * 1024
+        self.budget_bytes = budget_bytes
+        self.device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    @property
+    def resident_bytes(self):
+        return sum(entry.nbytes for entry in self._models.values())
+
+    def _load(self, key, model_path):
+        print(f"Loading SPIDER model from: {model_path}")
+
+        # Safetensors weights are memory-mapped by from_pretrained; low_cpu_mem_usage
+        # avoids a second full copy, so reloading an evicted model is mostly page-cache reads
+        model = AutoModel.from_pretrained(
+            model_path,
+            trust_remote_code=True,
+            local_files_only=True,
+            use_safetensors=os.path.exists(os.path.join(model_path, 'model.safetensors')) or None,
+            low_cpu_mem_usage=True
+        )
+        processor = AutoProcessor.from_pretrained(
+            model_path,
+            trust_remote_code=True,
+            local_files_only=True
+        )
+        model.to(self.device)
+        model.eval()
+
+        with open(os.path.join(model_path, "config.json"), 'r') as f:
+            config = json.load(f)
+        class_names = config.get('class_names', [])
+        model_type = detect_model_type(class_names, model_path)
+
+        self.loads += 1
+        return RegisteredModel(key, model_path, model, processor, class_names, model_type)
+
+    def _evict_for(self, nbytes):
+        # Evict unpinned models, oldest first, until the new one fits. Pinned models stay
+        # resident (and counted), so the budget can be exceeded while they are in use.
+        for key in list(self._models):
+            if self.resident_bytes + nbytes <= self.budget_bytes:
+                break
+            entry = self._models[key]
+            if entry.pins:
+                continue
+            del self._models[key]
+            print(f"Evicting {entry.model_type} model ({entry.nbytes / 1e6:.0f} MB) from registry")
+            self.evictions += 1
+        if self.resident_bytes + nbytes > self.budget_bytes:
+            print(f"Warning: models in use ({self.resident_bytes / 1e6:.0f} MB) leave no room for "
+                  f"{nbytes / 1e6:.0f} MB under the {self.budget_bytes / 1e6:.0f} MB model budget")
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    def _get(self, model_path):
+        key = config_hash(model_path)
+        entry = self._models.get(key)
+        if entry is not None:
+            self._models.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        # Make room before loading so two large models are never resident over budget
+        self._evict_for(estimate_nbytes(model_path))
+        entry = self._load(key, model_path)
+        self._models[key] = entry
+        return entry
+
+    def get(self, model_path):
+        """Return the RegisteredModel for a model directory, loading it if needed."""
+        with self._lock:
+            return self._get(model_path)
+
+    def acquire(self, model_path):
+        """Like get(), but pins the model so it is not evicted until release()."""
+        with self._lock:
+            entry = self._get(model_path)
+            entry.pins += 1
+            return entry
+
+    def release(self, entry):
+        with self._lock:
+            entry.pins = max(entry.pins - 1, 0)
+
+    def evict(self, model_path):
+        key = config_hash(model_path)
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is None:
+                return
+            if entry.pins:
+                print(f"Not evicting {entry.model_type} model: in use by {entry.pins} classifier(s)")
+                return
+            del self._models[key]
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'resident_models': [entry.model_type for entry in self._models.values()],
+            'resident_mb': round(self.resident_bytes / 1e6, 1),
+            'pinned_models': [entry.model_type for entry in self._models.values() if entry.pins],
+            'budget_mb': round(self.budget_bytes / 1e6, 1),
+            'hits': self.hits,
+            'loads': self.loads,
+            'evictions': self.evictions
+        }
+
+
+_registry = None
+
+
+def get_registry(device=None):
+    """Process-wide registry shared by every script in this process.
+
+    The first call fixes the registry's device; later calls asking for another device
+    get a warning and the existing registry.
+    """
+    global _registry
+    if _registry is None:
+        _registry = ModelRegistry(device=device)
+    elif device is not None:
+        requested = torch.device(device)
+        current = _registry.device
+        if requested.type != current.type or (requested.index is not None and current.index is not None
+                                              and requested.index != current.index):
+            print(f"Warning: model registry already uses {current}, ignoring requested device {requested}")
+    return _registry
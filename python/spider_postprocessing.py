@@ -0,0 +1,231 @@
+# spider_postprocessing.py
+# Spatial post-processing of whole-slide patch predictions
+# Patches are classified independently; these filters smooth the
+# (grid_h, grid_w, n_classes) probability grid so that isolated, uncertain
+# patches follow their neighbours. Unprocessed cells (background, failed
+# patches) neither contribute nor receive probabilities.
+
+import numpy as np
+
+SMOOTHING_METHODS = ('none', 'average', 'potts')
+DEFAULT_RADIUS = 1
+DEFAULT_POTTS_WEIGHT = 1.0
+DEFAULT_POTTS_ITERATIONS = 5
+
+
+def results_to_grid(results, cell_extent, grid_shape, n_classes):
+    """Probability grid and processed-cell mask from patch results."""
+    probabilities = np.zeros((*grid_shape, n_classes), dtype=np.float32)
+    processed = np.zeros(grid_shape, dtype=bool)
+    if results:
+        gx = np.array([r['x'] for r in results]) // cell_extent
+        gy = np.array([r['y'] for r in results]) // cell_extent
+        probabilities[gy, gx] = np.array([r['probabilities'] for r in results], dtype=np.float32)
+        processed[gy, gx] = True
+    return probabilities, processed
+
+
+def _box_sum(grid, radius):
+    """Sum over the (2r+1) x (2r+1) window around every cell (integral image, zero padded)."""
+    k = 2 * radius + 1
+    padded = np.pad(grid, ((radius + 1, radius), (radius + 1, radius)) + ((0, 0),) * (grid.ndim - 2))
+    integral = padded.cumsum(axis=0).cumsum(axis=1)
+    return integral[k:, k:] - integral[:-k, k:] - integral[k:, :-k] + integral[:-k, :-k]
+
+
+def neighbourhood_average(probabilities, processed, radius=DEFAULT_RADIUS):
+    """Mean probabilities over the processed cells of each cell's neighbourhood."""
+    weights = processed.astype(np.float32)
+    sums = _box_sum(probabilities * weights[..., None], radius)
+    counts = _box_sum(weights, radius)
+    smoothed = sums / np.maximum(counts, 1.0)[..., None]
+    return np.where(processed[..., None], smoothed, 0.0).astype(np.float32)
+
+
+def _neighbour_sum(q):
+    """Sum of the 4-connected neighbours of every cell."""
+    total = np.zeros_like(q)
+    total[1:] += q[:-1]
+    total[:-1] += q[1:]
+    total[:, 1:] += q[:, :-1]
+    total[:, :-1] += q[:, 1:]
+    return total
+
+
+def potts_mean_field(probabilities, processed, weight=DEFAULT_POTTS_WEIGHT,
+                     iterations=DEFAULT_POTTS_ITERATIONS):
+    """Mean-field inference for a Potts model with the patch probabilities as unaries.
+
+    Each iteration sets Q = softmax(log p + weight * sum of neighbouring Q),
+    rewarding labels that agree with the 4-connected neighbours.
+    """
+    mask = processed[..., None].astype(np.float32)
+    unary = np.log(np.clip(probabilities, 1e-6, 1.0))
+    q = probabilities * mask
+    for _ in range(iterations):
+        energy = unary + weight * _neighbour_sum(q)
+        energy -= energy.max(axis=2, keepdims=True)
+        q = np.exp(energy)
+        q /= q.sum(axis=2, keepdims=True)
+        q *= mask
+    return q.astype(np.float32)
+
+
+def smooth_grid(probabilities, processed, method, radius=DEFAULT_RADIUS, weight=DEFAULT_POTTS_WEIGHT,
+                iterations=DEFAULT_POTTS_ITERATIONS):
+    if method == 'average':
+        return neighbourhood_average(probabilities, processed, radius)
+    if method == 'potts':
+        return potts_mean_field(probabilities, processed, weight, iterations)
+    return probabilities
+
+
+def apply_to_results(results, smoothed, cell_extent, class_names):
+    """Patch results carrying the smoothed probabilities; the original class is kept as raw_prediction."""
+    smoothed_results = []
+    for result in results:
+        probs = smoothed[result['y'] // cell_extent, result['x'] // cell_extent]
+        prediction_idx = int(probs.argmax())
+        smoothed_results.append({
+            **result,
+            'prediction': class_names[prediction_idx],
+            'probabilities': probs.tolist(),
+            'confidence': float(probs[prediction_idx]),
+            'raw_prediction': result['prediction']
+        })
+    return smoothed_results
+
+
+# High-confidence region extraction
+
+try:
+    from scipy import ndimage
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
+
+DEFAULT_REGION_CONFIDENCE = 0.8
+DEFAULT_MAX_REGIONS = 50
+
+
+def _label_same_class(class_grid):
+    """Label 4-connected components of equal, non-negative class values.
+
+    Returns a label grid (0 = background) and the number of components. Uses
+    scipy.ndimage per class when available, otherwise a union-find over the
+    grid edges.
+    """
+    labels = np.zeros(class_grid.shape, dtype=np.int64)
+    if HAS_SCIPY:
+        n_labels = 0
+        for class_idx in np.unique(class_grid[class_grid >= 0]):
+            class_labels, n = ndimage.label(class_grid == class_idx)
+            labels[class_labels > 0] = class_labels[class_labels > 0] + n_labels
+            n_labels += n
+        return labels, n_labels
+
+    h, w = class_grid.shape
+    index = np.arange(h * w).reshape(h, w)
+    parent = np.arange(h * w)
+
+    def find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    # Edges between equal-class horizontal and vertical neighbours
+    horizontal = (class_grid[:, 1:] == class_grid[:, :-1]) & (class_grid[:, 1:] >= 0)
+    vertical = (class_grid[1:] == class_grid[:-1]) & (class_grid[1:] >= 0)
+    edges = np.concatenate([
+        np.stack([index[:, :-1][horizontal], index[:, 1:][horizontal]], axis=1),
+        np.stack([index[:-1][vertical], index[1:][vertical]], axis=1)
+    ])
+    for a, b in edges.tolist():
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    roots = np.array([find(i) for i in range(h * w)])
+    foreground = class_grid.ravel() >= 0
+    unique_roots, compact = np.unique(roots[foreground], return_inverse=True)
+    labels.ravel()[foreground] = compact + 1
+    return labels, len(unique_roots)
+
+
+def high_confidence_regions(results, class_names, cell_extent, patch_extent, grid_shape,
+                            min_confidence=DEFAULT_REGION_CONFIDENCE, max_regions=DEFAULT_MAX_REGIONS,
+                            microns_per_pixel=None):
+    """Connected regions of same-class patches above a confidence threshold.
+
+    Regions are reported largest first with patch count, area, level-0 bounding
+    box, centroid, mean confidence and the most confident patch (a point inside
+    the region to navigate to, unlike the centroid of a curved region).
+    """
+    class_index = {name: i for i, name in enumerate(class_names)}
+    class_grid = np.full(grid_shape, -1, dtype=np.int64)
+    confidence = np.zeros(grid_shape, dtype=np.float64)
+    for result in results:
+        if result['confidence'] > min_confidence:
+            gy, gx = result['y'] // cell_extent, result['x'] // cell_extent
+            class_grid[gy, gx] = class_index[result['prediction']]
+            confidence[gy, gx] = result['confidence']
+
+    labels, n_labels = _label_same_class(class_grid)
+    if n_labels == 0:
+        return []
+
+    # Per-component statistics in one bincount pass each
+    ys, xs = np.nonzero(labels)
+    component = labels[ys, xs] - 1
+    counts = np.bincount(component, minlength=n_labels)
+    conf_sum = np.bincount(component, weights=confidence[ys, xs], minlength=n_labels)
+    x_sum = np.bincount(component, weights=xs, minlength=n_labels)
+    y_sum = np.bincount(component, weights=ys, minlength=n_labels)
+    x_min = np.full(n_labels, np.iinfo(np.int64).max)
+    y_min = np.full(n_labels, np.iinfo(np.int64).max)
+    x_max = np.full(n_labels, -1)
+    y_max = np.full(n_labels, -1)
+    np.minimum.at(x_min, component, xs)
+    np.minimum.at(y_min, component, ys)
+    np.maximum.at(x_max, component, xs)
+    np.maximum.at(y_max, component, ys)
+
+    # Most confident patch of each component
+    order = np.lexsort((-confidence[ys, xs], component))
+    first = np.r_[True, component[order][1:] != component[order][:-1]]
+    peak_x = np.empty(n_labels, dtype=np.int64)
+    peak_y = np.empty(n_labels, dtype=np.int64)
+    peak_x[component[order][first]] = xs[order][first]
+    peak_y[component[order][first]] = ys[order][first]
+    component_class = np.empty(n_labels, dtype=np.int64)
+    component_class[component] = class_grid[ys, xs]
+
+    half = patch_extent // 2
+    cell_area = float(min(cell_extent, patch_extent)) ** 2
+    regions = []
+    for i in np.argsort(-counts, kind='stable')[:max_regions]:
+        area_pixels = counts[i] * cell_area
+        region = {
+            "class": class_names[component_class[i]],
+            "patch_count": int(counts[i]),
+            "area_pixels": int(area_pixels),
+            "bounding_box": {
+                "x": int(x_min[i] * cell_extent),
+                "y": int(y_min[i] * cell_extent),
+                "width": int((x_max[i] - x_min[i]) * cell_extent + patch_extent),
+                "height": int((y_max[i] - y_min[i]) * cell_extent + patch_extent)
+            },
+            "centroid": {
+                "x": int(x_sum[i] / counts[i] * cell_extent + half),
+                "y": int(y_sum[i] / counts[i] * cell_extent + half)
+            },
+            "peak": {"x": int(peak_x[i] * cell_extent + half), "y": int(peak_y[i] * cell_extent + half)},
+            "average_confidence": round(float(conf_sum[i] / counts[i]), 3)
+        }
+        if microns_per_pixel:
+            region["area_mm2"] = round(float(area_pixels) * microns_per_pixel ** 2 / 1e6, 4)
+        regions.append(region)
+    return regions
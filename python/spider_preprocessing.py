@@ -0,0 +1,219 @@
+# spider_preprocessing.py
+# Fast preprocessing path for SPIDER models
+# Goes from OpenSlide's RGBA regions straight to a normalized batch tensor, using the
+# mean/std/size from the model's preprocessor_config.json so the output matches
+# AutoProcessor without the intermediate PIL conversions.
+#
+# Parity check against AutoProcessor:
+#   python spider_preprocessing.py <model_path> [slide_path]
+
+import os
+import sys
+import json
+import numpy as np
+from PIL import Image
+
+try:
+    import torch
+    HAS_TORCH = True
+except ImportError:
+    HAS_TORCH = False
+
+
+def as_rgb_image(image):
+    """RGB PIL image of a PIL image or an (H, W[, 3|4]) uint8 array."""
+    if isinstance(image, Image.Image):
+        return image.convert('RGB')
+    array = np.asarray(image)
+    if array.ndim == 3:
+        array = array[..., :3]
+    return Image.fromarray(np.ascontiguousarray(array)).convert('RGB')
+
+
+class FastPreprocessor:
+    """Normalize RGBA/RGB regions into a preallocated (optionally pinned) batch tensor.
+
+    The buffers are allocated on the first call, for `batch_size` samples or
+    that call's batch if larger, and grow when a later batch is larger still.
+    Every region of one batch must come out at the same size.
+    """
+
+    def __init__(self, config, batch_size=1, device=None):
+        # Without torch only stage() is available (resizing and cropping into the uint8 buffer)
+        self.device = device or (torch.device('cpu') if HAS_TORCH else None)
+        self.batch_size = batch_size
+
+        self.do_resize = config.get('do_resize', True)
+        self.size = config.get('size', {'height': 224, 'width': 224})
+        self.resample = config.get('resample', Image.BICUBIC)
+        self.do_center_crop = config.get('do_center_crop', False)
+        self.crop_size = config.get('crop_size')
+        self.do_rescale = config.get('do_rescale', True)
+        self.rescale_factor = config.get('rescale_factor', 1 / 255)
+        self.do_normalize = config.get('do_normalize', True)
+
+        mean = np.asarray(config.get('image_mean', [0.0, 0.0, 0.0]), dtype=np.float32)
+        std = np.asarray(config.get('image_std', [1.0, 1.0, 1.0]), dtype=np.float32)
+        if not self.do_normalize:
+            mean, std = np.zeros(3, np.float32), np.ones(3, np.float32)
+        scale = self.rescale_factor if self.do_rescale else 1.0
+
+        # (x * scale - mean) / std folded into one multiply-add per pixel
+        self._mul = self._add = None
+        if HAS_TORCH:
+            self._mul = torch.from_numpy(scale / std).view(1, 3, 1, 1)
+            self._add = torch.from_numpy(-mean / std).view(1, 3, 1, 1)
+
+        self.output_size = None
+        self._staging = None
+        self._batch = None
+
+    @classmethod
+    def from_pretrained(cls, model_path, batch_size=1, device=None):
+        config_path = os.path.join(model_path, 'preprocessor_config.json')
+        with open(config_path, 'r') as f:
+            config = json.load(f)
+        return cls(config, batch_size=batch_size, device=device)
+
+    def _resize_shape(self, height, width):
+        size = self.size
+        if isinstance(size, int):
+            size = {'shortest_edge': size}
+        if 'height' in size and 'width' in size:
+            return size['height'], size['width']
+        # Shortest-edge resize keeps the aspect ratio
+        short, long = (height, width) if height <= width else (width, height)
+        new_short = size['shortest_edge']
+        new_long = int(new_short * long / short)
+        if 'longest_edge' in size and new_long > size['longest_edge']:
+            new_short = int(size['longest_edge'] * new_short / new_long)
+            new_long = size['longest_edge']
+        return (new_short, new_long) if height <= width else (new_long, new_short)
+
+    def _crop_shape(self, height, width):
+        if not self.do_center_crop or not self.crop_size:
+            return height, width
+        crop = self.crop_size
+        if isinstance(crop, int):
+            return crop, crop
+        return crop['height'], crop['width']
+
+    def output_shape(self, height, width):
+        """(3, H, W) of the tensor a height x width region becomes."""
+        if self.do_resize:
+            height, width = self._resize_shape(height, width)
+        return (3, *self._crop_shape(height, width))
+
+    def _allocate(self, height, width, n):
+        self.output_size = (height, width)
+        self.batch_size = n
+        self._staging = np.empty((n, height, width, 3), dtype=np.uint8)
+        if not HAS_TORCH:
+            return
+        self._batch = torch.empty(
+            (n, 3, height, width),
+            dtype=torch.float32,
+            pin_memory=(self.device.type == 'cuda')
+        )
+
+    def _to_rgb(self, image):
+        """RGB uint8 view of a region: drops alpha without converting through PIL."""
+        array = np.asarray(image)
+        if array.ndim == 2:
+            array = np.repeat(array[..., None], 3, axis=2)
+        rgb = array[..., :3]
+
+        height, width = rgb.shape[:2]
+        if self.do_resize:
+            target = self._resize_shape(height, width)
+            if target != (height, width):
+                # Resampling goes through PIL so it matches AutoProcessor exactly
+                resized = Image.fromarray(np.ascontiguousarray(rgb)).resize(
+                    (target[1], target[0]), resample=self.resample)
+                rgb = np.asarray(resized)
+                height, width = target
+
+        crop_h, crop_w = self._crop_shape(height, width)
+        if (crop_h, crop_w) != (height, width):
+            top = (height - crop_h) // 2
+            left = (width - crop_w) // 2
+            rgb = rgb[top:top + crop_h, left:left + crop_w]
+        return rgb
+
+    def stage(self, images):
+        """Resize and crop regions into the uint8 staging buffer; returns how many were staged.
+
+        Raises ValueError when the regions of one batch come out at different
+        sizes (e.g. shortest-edge resizing of regions with different aspect ratios).
+        """
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+        rgbs = [self._to_rgb(image) for image in images]
+        shapes = sorted({rgb.shape[:2] for rgb in rgbs})
+        if len(shapes) > 1:
+            raise ValueError(f"Regions of one batch preprocess to different sizes: {shapes}")
+
+        n = len(rgbs)
+        if n and (self._staging is None or shapes[0] != self.output_size or n > self.batch_size):
+            self._allocate(*shapes[0], max(n, self.batch_size))
+        for i, rgb in enumerate(rgbs):
+            np.copyto(self._staging[i], rgb)
+        return n
+
+    def __call__(self, images, stain=None):
+        """Return a normalized (N, 3, H, W) tensor on the target device.
+
+        The tensor shares the preallocated buffer on CPU, so it is only valid
+        until the next call. An optional spider_stain.StainNormalizer is applied
+        to the whole resized batch before the mean/std normalization.
+        """
+        if not HAS_TORCH:
+            raise ImportError("torch is required to build batch tensors")
+        n = self.stage(images)
+        batch = self._batch[:n]
+        batch.copy_(torch.from_numpy(self._staging[:n]).permute(0, 3, 1, 2))
+        if stain is not None:
+            stain.apply_tensor(batch)
+        batch.mul_(self._mul).add_(self._add)
+        return batch.to(self.device, non_blocking=True)
+
+    def inputs(self, images, stain=None):
+        """Model keyword arguments, as returned by AutoProcessor."""
+        return {'pixel_values': self(images, stain)}
+
+
+def check_parity(processor, fast, images, atol=1e-4):
+    """Compare FastPreprocessor output with AutoProcessor output on the same images."""
+    expected = processor(images=[img.convert('RGB') for img in images], return_tensors='pt')['pixel_values']
+    actual = fast(images).cpu()
+    if expected.shape != actual.shape:
+        print(f"Shape mismatch: AutoProcessor {tuple(expected.shape)} vs fast {tuple(actual.shape)}")
+        return False
+    max_diff = (expected - actual).abs().max().item()
+    print(f"Max absolute difference: {max_diff:.2e} (tolerance {atol:.0e})")
+    return max_diff <= atol
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python spider_preprocessing.py <model_path> [slide_path]")
+        sys.exit(1)
+
+    from transformers import AutoProcessor
+
+    model_path = sys.argv[1]
+    processor = AutoProcessor.from_pretrained(model_path, trust_remote_code=True, local_files_only=True)
+
+    if len(sys.argv) > 2:
+        from spider_readers import open_reader
+        slide = open_reader(sys.argv[2])
+        width, height = slide.dimensions
+        images = [slide.read_region((width // 2 + i * 1120, height // 2), 0, (1120, 1120)) for i in range(4)]
+    else:
+        rng = np.random.default_rng(0)
+        images = [Image.fromarray(rng.integers(0, 256, (1120, 1120, 4), dtype=np.uint8), 'RGBA') for _ in range(4)]
+
+    fast = FastPreprocessor.from_pretrained(model_path, batch_size=len(images))
+    ok = check_parity(processor, fast, images)
+    print("Parity check passed" if ok else "Parity check FAILED")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,238 @@
+# spider_priority.py
+# Budgeted, priority-ordered whole-slide analysis
+# Instead of scoring patches in raster order until max_patches, cells of the patch
+# grid are visited coarse to fine (a quadtree: every 2^k-th cell of a level before
+# the level below), so any prefix of the run covers the whole slide. Once the
+# coarse spread is done, neighbours of low-confidence or focus-class patches jump
+# the queue. Each finished patch paints its quadtree block of a label map, which
+# gives a progressively refined slide-level class distribution; the run stops on
+# a patch or time budget, or when that distribution stops changing.
+
+import time
+import heapq
+import queue
+
+import numpy as np
+
+# Share of the patch budget spent on the even coarse-to-fine spread before refinement
+SPREAD_FRACTION = 0.25
+
+# Patches below this confidence get their neighbours scheduled early
+DEFAULT_LOW_CONFIDENCE = 0.6
+
+# Convergence: the estimated distribution may move at most `tolerance` (largest
+# per-class change in fraction) over `patience` consecutive checks
+DEFAULT_TOLERANCE = 0.01
+DEFAULT_CHECK_INTERVAL = 50
+DEFAULT_PATIENCE = 3
+
+# Priority tiers
+SPREAD, FOCUS, FILL = 0, 1, 2
+
+
+def cell_spacing(grid_shape):
+    """Quadtree spacing of every cell: the largest power of two dividing both coordinates (capped)."""
+    h, w = grid_shape
+    top = 1
+    while top < max(h, w):
+        top *= 2
+    ys, xs = np.mgrid[0:h, 0:w]
+    both = ys | xs
+    # Lowest set bit of (y | x); cell (0, 0) has the top spacing
+    spacing = np.where(both == 0, top, both & -both)
+    return np.minimum(spacing, top)
+
+
+class PatchScheduler:
+    """Priority queue over the cells of a patch grid.
+
+    Cells come out in three tiers: the coarse spread (levels whose cells fit in
+    SPREAD_FRACTION of the patch budget, coarsest first), focus cells next to
+    suspicious results (lowest confidence first), then every remaining cell
+    coarse to fine. Within a level the order is shuffled with a fixed seed so an
+    unfinished level is not biased towards the top of the slide.
+    """
+
+    def __init__(self, grid_shape, patch_budget, low_confidence=DEFAULT_LOW_CONFIDENCE, focus_classes=(),
+                 radius=1, seed=0):
+        self.grid_shape = grid_shape
+        self.patch_budget = patch_budget
+        self.low_confidence = low_confidence
+        self.focus_classes = set(focus_classes)
+        self.radius = radius
+        self.spacing = cell_spacing(grid_shape)
+        self.scheduled = np.zeros(grid_shape, dtype=bool)
+        self.issued = 0
+
+        # Coarsest spacing whose cumulative cell count exceeds the spread share of the budget
+        levels = sorted(np.unique(self.spacing), reverse=True)
+        spread_cells = 0
+        self.spread_spacing = levels[0] if levels else 1
+        for s in levels:
+            spread_cells += int((self.spacing == s).sum())
+            if spread_cells > max(1, int(patch_budget * SPREAD_FRACTION)):
+                break
+            self.spread_spacing = s
+
+        rng = np.random.default_rng(seed)
+        order = rng.permutation(self.spacing.size)
+        shuffle_rank = np.empty(self.spacing.size, dtype=np.int64)
+        shuffle_rank[order] = np.arange(self.spacing.size)
+
+        self._best = {}
+        self._heap = []
+        for (gy, gx), s in np.ndenumerate(self.spacing):
+            tier = SPREAD if s >= self.spread_spacing else FILL
+            key = (tier, -int(s), int(shuffle_rank[gy * grid_shape[1] + gx]))
+            self._best[(gy, gx)] = key
+            self._heap.append((key, gy, gx))
+        heapq.heapify(self._heap)
+        self._spread_left = sum(1 for key in self._best.values() if key[0] == SPREAD)
+
+    @property
+    def spread_done(self):
+        return self._spread_left == 0 or self.issued >= max(1, int(self.patch_budget * SPREAD_FRACTION))
+
+    def next(self):
+        """Next (gy, gx) to score, or None when every cell has been issued."""
+        while self._heap:
+            key, gy, gx = heapq.heappop(self._heap)
+            if self.scheduled[gy, gx] or self._best[(gy, gx)] != key:
+                continue
+            self.scheduled[gy, gx] = True
+            self.issued += 1
+            if key[0] == SPREAD:
+                self._spread_left -= 1
+            return gy, gx
+        return None
+
+    def feedback(self, gy, gx, prediction, confidence):
+        """Move the unscored neighbours of a suspicious result into the focus tier."""
+        if confidence >= self.low_confidence and prediction not in self.focus_classes:
+            return
+        h, w = self.grid_shape
+        r = self.radius
+        for ny in range(max(0, gy - r), min(h, gy + r + 1)):
+            for nx in range(max(0, gx - r), min(w, gx + r + 1)):
+                if self.scheduled[ny, nx]:
+                    continue
+                key = self._best[(ny, nx)]
+                focus_key = (FOCUS, round(float(confidence), 4), key[2])
+                if key[0] == FILL or (key[0] == FOCUS and focus_key < key):
+                    self._best[(ny, nx)] = focus_key
+                    heapq.heappush(self._heap, (focus_key, ny, nx))
+
+
+class DistributionEstimate:
+    """Slide-level class distribution from a quadtree label map.
+
+    A scored cell with spacing s labels its s x s block, except where a finer
+    scored cell already did; unscored blocks inherit from coarser ancestors.
+    """
+
+    def __init__(self, grid_shape, spacing, class_names):
+        self.spacing = spacing
+        self.class_index = {name: i for i, name in enumerate(class_names)}
+        self.class_names = class_names
+        self.labels = np.full(grid_shape, -1, dtype=np.int64)
+        self.owner = np.full(grid_shape, np.iinfo(np.int64).max, dtype=np.int64)
+
+    def add(self, gy, gx, prediction):
+        s = int(self.spacing[gy, gx])
+        block = (slice(gy, gy + s), slice(gx, gx + s))
+        finer = self.owner[block] > s
+        self.labels[block][finer] = self.class_index[prediction]
+        self.owner[block][finer] = s
+
+    def distribution(self):
+        labelled = self.labels[self.labels >= 0]
+        if labelled.size == 0:
+            return np.zeros(len(self.class_names))
+        return np.bincount(labelled, minlength=len(self.class_names)) / labelled.size
+
+    def as_dict(self):
+        return {name: round(float(p), 4) for name, p in zip(self.class_names, self.distribution())}
+
+
+class ConvergenceMonitor:
+    """Stops a run once the estimated distribution is stable over consecutive checks."""
+
+    def __init__(self, estimate, tolerance=DEFAULT_TOLERANCE, check_interval=DEFAULT_CHECK_INTERVAL,
+                 patience=DEFAULT_PATIENCE):
+        self.estimate = estimate
+        self.tolerance = tolerance
+        self.check_interval = check_interval
+        self.patience = patience
+        self.seen = 0
+        self.stable_checks = 0
+        self.last_change = None
+        self._previous = None
+
+    def add(self, gy, gx, prediction, ready=True):
+        """Count one result; returns True when converged. Checks only start once `ready`."""
+        self.estimate.add(gy, gx, prediction)
+        self.seen += 1
+        if self.tolerance <= 0 or self.seen % self.check_interval != 0:
+            return False
+        current = self.estimate.distribution()
+        if self._previous is not None:
+            self.last_change = float(np.abs(current - self._previous).max())
+            if ready and self.last_change <= self.tolerance:
+                self.stable_checks += 1
+            else:
+                self.stable_checks = 0
+        self._previous = current
+        return self.stable_checks >= self.patience
+
+    def report(self):
+        return {
+            "estimated_class_distribution": self.estimate.as_dict(),
+            "last_change": self.last_change
+        }
+
+
+def run_prioritized(scheduler, submit, on_result, time_budget=None, monitor=None, in_flight=1):
+    """Drive a scheduler until the patch budget, time budget or convergence stops it.
+
+    submit(gy, gx, callback) starts scoring a cell and calls callback(result)
+    when done (result may be None); with in_flight=1 it may simply call it
+    inline. on_result(gy, gx, result) sees every result in completion order.
+    The monitor's add(gy, gx, prediction, ready) returns True once the run may
+    stop; `ready` tells it whether the scheduler's initial spread is done.
+    In-flight patches are always drained, so the run stops cleanly. Returns the
+    stop reason.
+    """
+    start = time.time()
+    done = queue.Queue()
+    pending = 0
+    stop_reason = None
+
+    while True:
+        # Keep `in_flight` cells running until a stop condition is reached
+        while stop_reason is None and pending < in_flight:
+            if scheduler.issued >= scheduler.patch_budget:
+                stop_reason = 'patch_budget'
+                break
+            if time_budget and time.time() - start >= time_budget:
+                stop_reason = 'time_budget'
+                break
+            cell = scheduler.next()
+            if cell is None:
+                stop_reason = 'complete'
+                break
+            pending += 1
+            submit(cell[0], cell[1], lambda result, cell=cell: done.put((cell, result)))
+
+        if pending == 0:
+            break
+
+        (gy, gx), result = done.get()
+        pending -= 1
+        on_result(gy, gx, result)
+        if result is not None:
+            scheduler.feedback(gy, gx, result['prediction'], result['confidence'])
+            if monitor is not None:
+                if monitor.add(gy, gx, result['prediction'], ready=scheduler.spread_done) and stop_reason is None:
+                    stop_reason = 'converged'
+
+    return stop_reason
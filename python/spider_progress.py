@@ -0,0 +1,89 @@
+# spider_progress.py
+# Machine-readable progress and partial results for QuPath scripts
+# Events are newline-delimited JSON, printed to stdout with a fixed prefix and
+# appended to a growing predictions.ndjson file so results survive a late failure.
+
+import os
+import sys
+import json
+import time
+
+# Prefix that marks a stdout line as an event (everything else is plain log output)
+EVENT_PREFIX = "SPIDER_EVENT "
+
+# Name of the growing results file written next to predictions.json
+STREAM_FILENAME = "predictions.ndjson"
+
+
+class ProgressReporter:
+    """Emit start/results/finish events with throughput and ETA."""
+
+    def __init__(self, total, output_dir=None, stream=None):
+        self.total = total
+        self.done = 0
+        self.stream = stream or sys.stdout
+        self.start_time = time.time()
+        self.stream_path = None
+        self._file = None
+
+        if output_dir is not None:
+            self.stream_path = os.path.join(output_dir, STREAM_FILENAME)
+            # Line-buffered so each record hits the disk as soon as it is written
+            self._file = open(self.stream_path, 'w', buffering=1)
+
+    def _emit(self, event):
+        line = json.dumps(event, separators=(',', ':'))
+        self.stream.write(EVENT_PREFIX + line + '\n')
+        self.stream.flush()
+        if self._file is not None:
+            self._file.write(line + '\n')
+
+    def _timing(self):
+        elapsed = time.time() - self.start_time
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        # The total is None while an incrementally read input has not been counted
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = max(0, self.total - self.done) / rate
+        return {
+            'done': self.done,
+            'total': self.total,
+            'elapsed': round(elapsed, 2),
+            'rate': round(rate, 3),
+            'eta': round(eta, 1) if eta is not None else None
+        }
+
+    def start(self, **info):
+        self.start_time = time.time()
+        event = {'type': 'start', 'total': self.total}
+        event.update(info)
+        self._emit(event)
+
+    def tiles(self, tiles):
+        """Report tiles generated on the Python side before any results."""
+        self._emit({'type': 'tiles', 'tiles': tiles})
+
+    def results(self, records):
+        """Report a batch of finished records (successful or failed)."""
+        self.done += len(records)
+        event = {'type': 'results', 'records': records}
+        event.update(self._timing())
+        self._emit(event)
+
+    def error(self, message, **info):
+        event = {'type': 'error', 'message': message}
+        event.update(info)
+        event.update(self._timing())
+        self._emit(event)
+
+    def finish(self, **summary):
+        event = {'type': 'finish'}
+        event.update(summary)
+        event.update(self._timing())
+        self._emit(event)
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,181 @@
+# spider_pyramid.py
+# Tiled multi-resolution heatmap output (Deep Zoom / DZI tile directories)
+# Per-class probability maps and the argmax map are kept as arrays at patch-grid
+# resolution and written as tile pyramids incrementally as patches finish, so any
+# DZI-capable viewer only loads the visible tiles. Lower levels average the area each
+# pixel covers, and a flush only rewrites tiles whose pixels changed.
+
+import os
+import json
+import math
+import hashlib
+import numpy as np
+from PIL import Image
+
+TILE_SIZE = 256
+CELL_PIXELS = 8  # Pixels per grid cell at the highest pyramid level
+
+
+def hex_to_rgb(color_hex):
+    return tuple(int(color_hex[i:i + 2], 16) for i in (1, 3, 5))
+
+
+def block_sum(values, k, shape):
+    """Sums of values over k x k blocks, zero-padded to shape * k; trailing axes are kept."""
+    h, w = shape
+    padded = np.zeros((h * k, w * k) + values.shape[2:], dtype=np.float32)
+    padded[:values.shape[0], :values.shape[1]] = values
+    return padded.reshape(h, k, w, k, *values.shape[2:]).sum(axis=(1, 3))
+
+
+class HeatmapPyramid:
+    """Grid-resolution probability maps written as DZI tile pyramids."""
+
+    def __init__(self, output_dir, grid_shape, class_names, colors, origin_offset, cell_extent,
+                 tile_size=TILE_SIZE, cell_pixels=CELL_PIXELS):
+        self.output_dir = output_dir
+        self.grid_h, self.grid_w = grid_shape
+        self.class_names = class_names
+        self.tile_size = tile_size
+        self.cell_pixels = cell_pixels
+
+        self.probabilities = np.zeros((self.grid_h, self.grid_w, len(class_names)), dtype=np.float32)
+        self.processed = np.zeros((self.grid_h, self.grid_w), dtype=bool)
+        self._dirty = []
+        # Digest of every tile written, so unchanged tiles are not encoded again
+        self._digests = {}
+
+        # Color lookup table: one RGB row per class
+        self.palette = np.array([hex_to_rgb(colors.get(name, '#808080')) for name in class_names], dtype=np.uint8)
+
+        self.width = self.grid_w * cell_pixels
+        self.height = self.grid_h * cell_pixels
+        self.max_level = int(math.ceil(math.log2(max(self.width, self.height, 1))))
+
+        # Pyramid names: one per class plus the argmax classification map
+        self.layers = ['classification'] + [f"class_{i:02d}" for i in range(len(class_names))]
+
+        os.makedirs(output_dir, exist_ok=True)
+        for layer in self.layers:
+            self._write_descriptor(layer)
+        self._write_manifest(origin_offset, cell_extent)
+
+    def _write_descriptor(self, layer):
+        descriptor = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{self.tile_size}" '
+            f'Overlap="0" Format="png"><Size Width="{self.width}" Height="{self.height}"/></Image>\n'
+        )
+        with open(os.path.join(self.output_dir, f"{layer}.dzi"), 'w') as f:
+            f.write(descriptor)
+
+    def _write_manifest(self, origin_offset, cell_extent):
+        manifest = {
+            'format': 'dzi',
+            'grid': {'width': self.grid_w, 'height': self.grid_h},
+            # Cell (i, j) covers level-0 pixels starting at origin + (i, j) * cell_extent
+            'level0_origin': {'x': origin_offset, 'y': origin_offset},
+            'level0_cell_extent': cell_extent,
+            'cell_pixels': self.cell_pixels,
+            'layers': {
+                'classification': {'file': 'classification.dzi', 'type': 'argmax'},
+                **{f"class_{i:02d}": {'file': f"class_{i:02d}.dzi", 'class': name,
+                                      'color': '#%02X%02X%02X' % tuple(self.palette[i])}
+                   for i, name in enumerate(self.class_names)}
+            }
+        }
+        with open(os.path.join(self.output_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def add(self, grid_x, grid_y, probabilities):
+        """Record one finished patch."""
+        if 0 <= grid_x < self.grid_w and 0 <= grid_y < self.grid_h:
+            self.probabilities[grid_y, grid_x] = probabilities
+            self.processed[grid_y, grid_x] = True
+            self._dirty.append((grid_y, grid_x))
+
+    def set_grid(self, probabilities, processed):
+        """Replace the whole grid (e.g. after post-processing) and rewrite every tile."""
+        self.probabilities[...] = probabilities
+        self.processed[...] = processed
+        ys, xs = np.nonzero(np.ones_like(processed))
+        self._dirty = list(zip(ys.tolist(), xs.tolist()))
+        self.flush()
+
+    def _render(self, level, col, row):
+        """Render one tile of every layer.
+
+        While a pixel is no larger than a grid cell it shows the cell under it;
+        below that each pixel is the area average (a box filter) of the cells
+        it covers, with colours weighted by how much of it is classified.
+        """
+        scale = 2 ** (self.max_level - level)
+        level_w = int(math.ceil(self.width / scale))
+        level_h = int(math.ceil(self.height / scale))
+        x0, y0 = col * self.tile_size, row * self.tile_size
+        w = min(self.tile_size, level_w - x0)
+        h = min(self.tile_size, level_h - y0)
+        if w <= 0 or h <= 0:
+            return None
+
+        if scale <= self.cell_pixels:
+            # Grid cell under each output pixel
+            k = 1
+            cell_x = np.minimum(((x0 + np.arange(w)) * scale) // self.cell_pixels, self.grid_w - 1)
+            cell_y = np.minimum(((y0 + np.arange(h)) * scale) // self.cell_pixels, self.grid_h - 1)
+            cells = (cell_y[:, None], cell_x[None, :])
+        else:
+            # Each output pixel covers k x k cells
+            k = scale // self.cell_pixels
+            cells = (slice(y0 * k, (y0 + h) * k), slice(x0 * k, (x0 + w) * k))
+
+        # Coverage (1 for classified cells), and probabilities and argmax colour premultiplied by it
+        coverage = self.processed[cells].astype(np.float32)
+        probs = self.probabilities[cells] * coverage[..., None]
+        colors = self.palette[self.probabilities[cells].argmax(axis=2)] * coverage[..., None]
+        if k > 1:
+            # Average over the cells of each block that lie inside the grid
+            area = block_sum(np.ones_like(coverage), k, (h, w))
+            coverage = block_sum(coverage, k, (h, w)) / area
+            probs = block_sum(probs, k, (h, w)) / area[..., None]
+            colors = block_sum(colors, k, (h, w)) / area[..., None]
+
+        tiles = {}
+        rgba = np.empty((h, w, 4), dtype=np.uint8)
+        rgba[..., :3] = np.rint(colors / np.maximum(coverage, 1e-6)[..., None]).clip(0, 255)
+        rgba[..., 3] = (coverage * 255).astype(np.uint8)
+        tiles['classification'] = rgba.copy()
+        for i in range(len(self.class_names)):
+            rgba[..., :3] = self.palette[i]
+            rgba[..., 3] = (probs[..., i] * 255).astype(np.uint8)
+            tiles[f"class_{i:02d}"] = rgba.copy()
+        return tiles
+
+    def flush(self):
+        """Write the tiles that changed since the last flush; returns the number written."""
+        if not self._dirty:
+            return 0
+        cells = np.array(self._dirty)
+        self._dirty = []
+
+        written = 0
+        for level in range(self.max_level, -1, -1):
+            scale = 2 ** (self.max_level - level)
+            span = self.tile_size * scale  # Highest-level pixels covered by one tile
+            tile_rows = (cells[:, 0] * self.cell_pixels) // span
+            tile_cols = (cells[:, 1] * self.cell_pixels) // span
+            for row, col in set(zip(tile_rows.tolist(), tile_cols.tolist())):
+                tiles = self._render(level, col, row)
+                if tiles is None:
+                    continue
+                for layer, pixels in tiles.items():
+                    # e.g. a class layer where the new patches have near-zero probability
+                    digest = hashlib.blake2b(pixels.tobytes(), digest_size=16).digest()
+                    if self._digests.get((layer, level, col, row)) == digest:
+                        continue
+                    self._digests[(layer, level, col, row)] = digest
+                    level_dir = os.path.join(self.output_dir, f"{layer}_files", str(level))
+                    os.makedirs(level_dir, exist_ok=True)
+                    Image.fromarray(pixels, 'RGBA').save(os.path.join(level_dir, f"{col}_{row}.png"))
+                    written += 1
+        return written
@@ -1,33 +1,32 @@
 # spider_qupath_classifier_universal.py
 # Universal Python script to classify annotations in QuPath using any SPIDER model
 # Works with Colorectal, Skin, and Thorax models
+# Command-line wrapper over spider_classifier.SpiderClassifier, which can also be used in-process.
 
 import os
 import sys
+import argparse
 import json
-import torch
-import numpy as np
-from PIL import Image
-import openslide
-from transformers import AutoModel, AutoProcessor
-from pathlib import Path
 from datetime import datetime
+from spider_classifier import SpiderClassifier, details, top_predictions
+from spider_history import PredictionHistory
+from spider_tile_cache import describe_stats
+from spider_tta import add_tta_arguments
+from spider_stain import add_stain_arguments, describe_stats as describe_stain_stats
+from spider_progress import ProgressReporter
+from spider_input import open_records
 
 # Parse command line arguments
-if len(sys.argv) < 4:
-    print("Usage: python spider_qupath_classifier_universal.py <annotations_json> <model_path> <output_dir>")
-    sys.exit(1)
-
-annotations_path = sys.argv[1]
-model_path = sys.argv[2]
-output_dir = sys.argv[3]
-
-# Create output directory if it doesn't exist
-os.makedirs(output_dir, exist_ok=True)
-
-# Configure device
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-print(f"Using device: {device}")
+parser = argparse.ArgumentParser(usage="python spider_qupath_classifier_universal.py <annotations_json> <model_path> <output_dir> [--tta]")
+parser.add_argument('annotations_json')
+parser.add_argument('model_path')
+parser.add_argument('output_dir')
+add_tta_arguments(parser)
+add_stain_arguments(parser)
+parser.add_argument('--ensemble', nargs='+', metavar='MODEL_PATH', default=[],
+                    help="Additional models; every region is read and preprocessed once and classified by all models")
+parser.add_argument('--ensemble-threads', type=int, default=1,
+                    help="Run ensemble models in parallel threads (default: 1, sequential)")
 
 # Model-specific color schemes for better visualization
 MODEL_COLOR_SCHEMES = {
@@ -66,139 +65,35 @@ MODEL_COLOR_SCHEMES = {
     }
 }
 
-# Load SPIDER model with automatic model type detection
-def load_spider_model(model_path):
-    print(f"Loading SPIDER model from: {model_path}")
-    
-    # Detect model type from path
-    model_type = "unknown"
-    if "colorectal" in model_path.lower():
-        model_type = "colorectal"
-    elif "skin" in model_path.lower():
-        model_type = "skin"
-    elif "thorax" in model_path.lower():
-        model_type = "thorax"
+# Color scheme of a classifier's model, or of every ensemble member's model
+def color_scheme_for(classifier):
+    if classifier.ensemble is None:
+        return MODEL_COLOR_SCHEMES.get(classifier.model_type, {})
+    color_scheme = {}
+    for entry in classifier.ensemble.entries:
+        color_scheme = {**MODEL_COLOR_SCHEMES.get(entry.model_type, {}), **color_scheme}
+    return color_scheme
+
+# Main classification function
+def classify_annotations(args):
+    output_dir = args.output_dir
     
-    print(f"Detected model type: {model_type}")
+    # Create output directory if it doesn't exist
+    os.makedirs(output_dir, exist_ok=True)
     
+    # Load model (cached in a process-wide registry keyed by config hash); the
+    # model type is detected from the class names in config.json
     try:
-        # Load model and processor
-        model = AutoModel.from_pretrained(
-            model_path,
-            trust_remote_code=True,
-            local_files_only=True
-        )
-        
-        processor = AutoProcessor.from_pretrained(
-            model_path,
-            trust_remote_code=True,
-            local_files_only=True
-        )
-        
-        # Move model to device
-        model.to(device)
-        model.eval()
-        
-        # Load class names from config
-        config_path = os.path.join(model_path, "config.json")
-        with open(config_path, 'r') as f:
-            config = json.load(f)
-        
-        class_names = config.get('class_names', [])
-        print(f"Model has {len(class_names)} classes: {class_names}")
-        
-        # Get color scheme for this model type
-        color_scheme = MODEL_COLOR_SCHEMES.get(model_type, {})
-        
-        return model, processor, class_names, model_type, color_scheme
-    
+        classifier = SpiderClassifier.from_args(args.model_path, args, output_dir)
     except Exception as e:
         print(f"Error loading model: {str(e)}")
         sys.exit(1)
-
-# Parse QuPath path format (handles various QuPath server types)
-def parse_qupath_path(qupath_path):
-    # Handle BioFormatsImageServer paths
-    if qupath_path.startswith("BioFormatsImageServer:"):
-        path = qupath_path.replace("BioFormatsImageServer:", "").strip()
-        if path.startswith("file:/"):
-            path = path[6:]
-        if "[" in path:
-            path = path.split("[")[0]
-        return path
-    
-    # Handle file:// URLs
-    elif qupath_path.startswith("file:///"):
-        return qupath_path[8:]  # Remove file:///
-    elif qupath_path.startswith("file://"):
-        return qupath_path[7:]  # Remove file://
-    elif qupath_path.startswith("file:/"):
-        return qupath_path[6:]  # Remove file:/
-    
-    # Handle OpenslideImageServer paths
-    elif "OpenslideImageServer:" in qupath_path:
-        path = qupath_path.replace("qupath.lib.images.servers.openslide.OpenslideImageServer:", "").strip()
-        if path.startswith("file:/"):
-            path = path[6:]
-        return path
-    
-    # Handle ImageIOImageServer paths
-    elif "ImageIOImageServer:" in qupath_path:
-        path = qupath_path.replace("qupath.lib.images.servers.imageio.ImageIOImageServer:", "").strip()
-        if path.startswith("file:/"):
-            path = path[6:]
-        return path
-        
-    return qupath_path
-
-# Extract region from slide with context padding
-def extract_region_with_context(slide_path, region):
-    try:
-        # Parse path
-        parsed_path = parse_qupath_path(slide_path)
-        print(f"Opening slide: {parsed_path}")
-        
-        # Open slide
-        slide = openslide.OpenSlide(parsed_path)
-        
-        # Extract region coordinates
-        x = int(region['x'])
-        y = int(region['y'])
-        width = int(region['width'])
-        height = int(region['height'])
-        
-        # SPIDER uses 1120×1120 regions, so add context padding if necessary
-        context_size = 1120
-        
-        # Calculate center of region
-        center_x = x + width // 2
-        center_y = y + height // 2
-        
-        # Calculate coordinates for context region
-        context_x = max(0, center_x - context_size // 2)
-        context_y = max(0, center_y - context_size // 2)
-        
-        # Make sure we don't go outside slide boundaries
-        slide_width, slide_height = slide.dimensions
-        if context_x + context_size > slide_width:
-            context_x = max(0, slide_width - context_size)
-        if context_y + context_size > slide_height:
-            context_y = max(0, slide_height - context_size)
-        
-        # Extract the region with context
-        region_img = slide.read_region((context_x, context_y), 0, (context_size, context_size)).convert('RGB')
-        
-        print(f"Extracted region with context at ({context_x}, {context_y}), size {context_size}x{context_size}")
-        return region_img
-    
-    except Exception as e:
-        print(f"Error extracting region: {str(e)}")
-        return None
-
-# Main classification function
-def classify_annotations():
-    # Load model
-    model, processor, class_names, model_type, color_scheme = load_spider_model(model_path)
+    class_names = classifier.class_names
+    model_type = classifier.model_type
+    color_scheme = color_scheme_for(classifier)
+    print(f"Using device: {classifier.device}")
+    print(f"Detected model type: {model_type}")
+    print(f"Model has {len(class_names)} classes: {class_names}")
     
     # Save model information to output directory
     model_info = {
@@ -215,109 +110,68 @@ def classify_annotations():
     with open(os.path.join(output_dir, 'classes.json'), 'w') as f:
         json.dump(class_names, f)
     
-    # Load annotations
-    with open(annotations_path, 'r') as f:
-        annotations = json.load(f)
+    # Read annotations incrementally (JSON array or NDJSON); the count is known up front only for NDJSON
+    annotations, total = open_records(args.annotations_json)
     
-    print(f"Loaded {len(annotations)} annotations for classification")
+    # Stream progress and per-annotation results so QuPath can apply them as they arrive
+    reporter = ProgressReporter(total, output_dir)
+    reporter.start(model_type=model_type, class_names=class_names)
     
     # Initialize results
     results = []
     
-    # History file for tracking all predictions
-    history_file = os.path.join(output_dir, f'prediction_history_{model_type}.jsonl')
+    # Indexed history of all predictions (every model type), written in batches
+    history = PredictionHistory.open(output_dir)
     
-    for idx, annotation in enumerate(annotations):
-        print(f"\nProcessing annotation {idx+1}/{len(annotations)}...")
-        
-        # Extract information
-        slide_path = annotation['slide_path']
-        region = annotation['roi']
+    for annotation, output in classifier.classify_annotations(annotations):
+        print(f"\nProcessing annotation {len(results)+1}" + (f"/{total}..." if total is not None else "..."))
         annotation_id = annotation['id']
-        image_name = annotation.get('image_name', 'unknown')
-        
-        # Extract region with context
-        region_img = extract_region_with_context(slide_path, region)
         
-        if region_img is None:
-            print(f"Could not extract region for annotation {annotation_id}")
+        if output is None:
+            print(f"Could not classify annotation {annotation_id}")
             results.append({
                 'id': annotation_id,
                 'prediction': None,
                 'probabilities': None,
                 'top_predictions': None
             })
+            reporter.results(results[-1:])
             continue
         
-        # Process with SPIDER model
-        try:
-            # Prepare inputs
-            inputs = processor(images=region_img, return_tensors="pt")
-            
-            # Move inputs to device
-            for k, v in inputs.items():
-                if isinstance(v, torch.Tensor):
-                    inputs[k] = v.to(device)
-            
-            # Run inference
-            with torch.no_grad():
-                outputs = model(**inputs)
-            
-            # Get predicted class and probabilities
-            logits = outputs.logits
-            probabilities = torch.softmax(logits[0], dim=0).cpu().numpy()
-            prediction_idx = probabilities.argmax().item()
-            prediction = class_names[prediction_idx]
-            
-            # Create class probabilities dictionary (rounded to 3 decimal places)
-            class_probabilities = {class_name: round(float(probabilities[i]), 3) 
-                                 for i, class_name in enumerate(class_names)}
-            
-            # Get top 3 predictions for display
-            sorted_indices = np.argsort(probabilities)[::-1]
-            top_predictions = []
-            for i in range(min(3, len(class_names))):
-                idx = sorted_indices[i]
-                if probabilities[idx] > 0.01:  # Only include if probability > 1%
-                    top_predictions.append({
-                        'class': class_names[idx],
-                        'probability': round(float(probabilities[idx]), 3),
-                        'color': color_scheme.get(class_names[idx], '#808080')
-                    })
-            
-            # Display results
-            print(f"Prediction: {prediction} ({probabilities[prediction_idx]:.1%})")
-            if len(top_predictions) > 1:
-                print("Alternative predictions:")
-                for i, pred in enumerate(top_predictions[1:], 1):
-                    print(f"  {i}. {pred['class']}: {pred['probability']:.1%}")
-            
-            # Store result
-            result = {
-                'id': annotation_id,
-                'prediction': prediction,
-                'probabilities': class_probabilities,
-                'top_predictions': top_predictions,
-                'timestamp': datetime.now().isoformat(),
-                'image_name': image_name,
-                'model_type': model_type,
-                'confidence': float(probabilities[prediction_idx])
-            }
-            
-            # Append to history file
-            with open(history_file, 'a') as f:
-                f.write(json.dumps(result) + '\n')
-            
-            results.append(result)
-            
-        except Exception as e:
-            print(f"Error classifying annotation {annotation_id}: {str(e)}")
-            results.append({
-                'id': annotation_id,
-                'prediction': None,
-                'probabilities': None,
-                'top_predictions': None
-            })
+        probabilities = output['probabilities']
+        
+        # Top 3 predictions for display, with their class colors
+        top = top_predictions(class_names, probabilities, 3)
+        for pred in top:
+            pred['color'] = color_scheme.get(pred['class'], '#808080')
+        
+        # Display results
+        print(f"Prediction: {output['prediction']} ({output['confidence']:.1%})")
+        for name, member in output.get('models', {}).items():
+            print(f"  {name}: {member['prediction']} ({member['confidence']:.1%})")
+        if len(top) > 1:
+            print("Alternative predictions:")
+            for i, pred in enumerate(top[1:], 1):
+                print(f"  {i}. {pred['class']}: {pred['probability']:.1%}")
+        
+        # Store result
+        result = {
+            'id': annotation_id,
+            'prediction': output['prediction'],
+            'probabilities': classifier.probability_dict(probabilities, decimals=3),
+            'top_predictions': top,
+            'timestamp': datetime.now().isoformat(),
+            'image_name': annotation.get('image_name', 'unknown'),
+            'model_type': model_type,
+            'confidence': output['confidence'],
+            **details(output)
+        }
+        
+        # Record in the history
+        history.add(result)
+        
+        results.append(result)
+        reporter.results(results[-1:])
     
     # Save results
     results_path = os.path.join(output_dir, 'predictions.json')
@@ -329,8 +183,16 @@ def classify_annotations():
         'total_annotations': len(results),
         'successful_classifications': sum(1 for r in results if r['prediction'] is not None),
         'model_type': model_type,
-        'timestamp': datetime.now().isoformat()
+        'timestamp': datetime.now().isoformat(),
+        **classifier.stats()
     }
+    if classifier.ensemble is not None:
+        summary['ensemble_models'] = classifier.ensemble.names
+        disagreements = [r['disagreement'] for r in results if r.get('disagreement') is not None]
+        if disagreements:
+            summary['mean_disagreement'] = round(sum(disagreements) / len(disagreements), 3)
+    classifier.close()
+    history.close()
     
     if summary['successful_classifications'] > 0:
         # Count predictions by class
@@ -349,13 +211,23 @@ def classify_annotations():
     with open(os.path.join(output_dir, 'classification_summary.json'), 'w') as f:
         json.dump(summary, f, indent=2)
     
+    reporter.finish(predictions_path=results_path,
+                    successful=summary['successful_classifications'],
+                    tile_cache=summary['tile_cache'],
+                    stain_normalization=summary.get('stain_normalization'))
+    
     print(f"\nClassification completed!")
     print(f"Successfully classified {summary['successful_classifications']}/{len(results)} annotations")
     print(f"Results saved to {results_path}")
     print(f"Summary saved to classification_summary.json")
+    print(describe_stats(summary['tile_cache']))
+    if 'stain_normalization' in summary:
+        print(describe_stain_stats(summary['stain_normalization']))
+    if 'tta' in summary:
+        print(f"TTA: augmented {summary['tta']['augmented_regions']}/{summary['tta']['total_regions']} regions")
     
     return results
 
 # Run classification
 if __name__ == "__main__":
-    classify_annotations()
\ No newline at end of file
+    classify_annotations(parser.parse_args())
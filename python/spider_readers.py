@@ -0,0 +1,356 @@
+# spider_readers.py
+# Pluggable slide reader backends, selected by format
+# Every backend offers the part of the OpenSlide interface the scripts use
+# (dimensions, level_count, level_dimensions, level_downsamples,
+# get_best_level_for_downsample, read_region -> RGBA image, get_thumbnail,
+# properties, close) plus read_array -> RGBA NumPy array, so the tile cache,
+# pyramid-aware reads and stain estimation work with any of them.
+#   - OpenSlideReader: anything OpenSlide opens (SVS, NDPI, MRXS, SCN, ...)
+#   - TiffReader: tiled or stripped (OME-)TIFF pyramids read chunk by chunk
+#     with tifffile; the chunks covering a window are fetched with positional
+#     reads and decoded in parallel threads. Opens OME-TIFFs OpenSlide rejects
+#     (pyramids in SubIFDs) without converting them. Vendor formats stored as
+#     TIFF (Aperio, Philips, Ventana, ...) are left to OpenSlide, which knows
+#     their pyramids and properties: TiffReader only claims OME-TIFFs and files
+#     OpenSlide detects as generic TIFF or not at all.
+# open_reader() tries the backends that claim the file's format first, then the
+# catch-all ones, then the rest; SPIDER_SLIDE_READER=<name> forces a backend.
+#
+# Compare decode threads on a slide:
+#   python spider_readers.py <slide> [--threads 8] [--reads 50]
+
+import os
+import re
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+try:
+    import openslide
+    HAS_OPENSLIDE = True
+except ImportError:
+    HAS_OPENSLIDE = False
+
+try:
+    import tifffile
+    HAS_TIFFFILE = True
+except ImportError:
+    HAS_TIFFFILE = False
+
+# Level-0 microns per pixel, under OpenSlide's property names
+MPP_X_PROPERTY = 'openslide.mpp-x'
+MPP_Y_PROPERTY = 'openslide.mpp-y'
+
+# Backend that opened a slide
+READER_PROPERTY = 'spider.reader'
+
+# Decode threads per TiffReader, overridable with SPIDER_DECODE_THREADS
+MAX_DECODE_THREADS = 8
+
+# Rows read at a time when a thumbnail has to come from a large level
+THUMBNAIL_BAND_ROWS = 2048
+
+TIFF_EXTENSIONS = ('.ome.tif', '.ome.tiff', '.ome.btf', '.tif', '.tiff', '.btf')
+
+
+class OpenSlideReader:
+    """An OpenSlide handle with read_array."""
+
+    name = 'openslide'
+    extensions = None  # Tried for any file
+
+    def __init__(self, path):
+        if not HAS_OPENSLIDE:
+            raise ImportError("openslide is not installed")
+        self._slide = openslide.OpenSlide(path)
+        self._filename = path
+
+    def __getattr__(self, name):
+        # Everything else (dimensions, levels, properties, read_region, ...) is OpenSlide's
+        return getattr(self._slide, name)
+
+    @property
+    def properties(self):
+        return {**self._slide.properties, READER_PROPERTY: self.name}
+
+    def read_array(self, location, level, size):
+        return np.asarray(self._slide.read_region(location, level, size))
+
+    def close(self):
+        self._slide.close()
+
+
+def _decode_threads():
+    if os.environ.get('SPIDER_DECODE_THREADS'):
+        return max(1, int(os.environ['SPIDER_DECODE_THREADS']))
+    # Pinned pool workers get the CPUs of their plan
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    return max(1, min(MAX_DECODE_THREADS, cpus))
+
+
+class _TiffLevel:
+    """Chunk geometry of one pyramid level (one TIFF page)."""
+
+    def __init__(self, page):
+        if page.dtype != np.uint8 or page.samplesperpixel not in (1, 3, 4) or page.planarconfig != 1:
+            raise ValueError(f"Unsupported TIFF layout: {page.dtype}, {page.samplesperpixel} samples, "
+                             f"planar configuration {page.planarconfig}")
+        self.page = page
+        self.width = page.imagewidth
+        self.height = page.imagelength
+        self.samples = page.samplesperpixel
+        if page.is_tiled:
+            self.chunk_width, self.chunk_height = page.tilewidth, page.tilelength
+        else:
+            self.chunk_width, self.chunk_height = page.imagewidth, page.rowsperstrip or page.imagelength
+        self.chunks_across = math.ceil(self.width / self.chunk_width)
+        self.offsets = page.dataoffsets
+        self.bytecounts = page.databytecounts
+
+    def chunks(self, left, top, width, height):
+        """Indices of the chunks overlapping a window (level pixels), clipped to the level."""
+        cx0, cy0 = max(0, left) // self.chunk_width, max(0, top) // self.chunk_height
+        cx1 = (min(left + width, self.width) - 1) // self.chunk_width
+        cy1 = (min(top + height, self.height) - 1) // self.chunk_height
+        return [cy * self.chunks_across + cx for cy in range(cy0, cy1 + 1) for cx in range(cx0, cx1 + 1)]
+
+
+class TiffReader:
+    """Tiled or stripped RGB (OME-)TIFF pyramid read chunk by chunk with parallel decoding."""
+
+    name = 'tifffile'
+    extensions = TIFF_EXTENSIONS
+
+    @classmethod
+    def claims(cls, path):
+        """OME-TIFFs, and TIFFs that are not a vendor format OpenSlide reads with its own metadata."""
+        if '.ome.' in os.path.basename(path).lower() or not HAS_OPENSLIDE:
+            return True
+        try:
+            return openslide.OpenSlide.detect_format(path) in (None, 'generic-tiff')
+        except Exception:
+            return True
+
+    def __init__(self, path, threads=None):
+        if not HAS_TIFFFILE:
+            raise ImportError("tifffile is not installed")
+        self._filename = path
+        self._tif = tifffile.TiffFile(path)
+        self._fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        self._read_lock = threading.Lock()
+        try:
+            series = self._tif.series[0]
+            self._levels = [_TiffLevel(level.keyframe) for level in series.levels]
+            # Decode one chunk now, so a missing codec shows up here and another backend is tried
+            self._decode(self._levels[0], 0)
+        except Exception:
+            os.close(self._fd)
+            self._tif.close()
+            raise
+        self.threads = threads or _decode_threads()
+        self._executor = None
+
+        width, height = self._levels[0].width, self._levels[0].height
+        self.dimensions = (width, height)
+        self.level_count = len(self._levels)
+        self.level_dimensions = tuple((level.width, level.height) for level in self._levels)
+        # As OpenSlide computes them: the mean of the width and height ratios
+        self.level_downsamples = tuple((width / w + height / h) / 2 for w, h in self.level_dimensions)
+        self.properties = {READER_PROPERTY: self.name, 'openslide.level-count': str(self.level_count)}
+        mpp = self._microns_per_pixel()
+        if mpp is not None:
+            self.properties[MPP_X_PROPERTY], self.properties[MPP_Y_PROPERTY] = (str(v) for v in mpp)
+
+    def _microns_per_pixel(self):
+        """Level-0 pixel size from OME metadata, an Aperio description or the TIFF resolution tags."""
+        ome = self._tif.ome_metadata
+        if ome:
+            sizes = [re.search(rf'PhysicalSize{axis}="([0-9.eE+-]+)"', ome) for axis in 'XY']
+            units = [re.search(rf'PhysicalSize{axis}Unit="([^"]+)"', ome) for axis in 'XY']
+            if all(sizes):
+                scale = [{'nm': 1e-3, 'mm': 1e3, 'cm': 1e4}.get(u.group(1) if u else 'µm', 1.0) for u in units]
+                return tuple(float(s.group(1)) * f for s, f in zip(sizes, scale))
+        page = self._levels[0].page
+        match = re.search(r'MPP\s*=\s*([0-9.]+)', page.description or '')
+        if match:
+            return float(match.group(1)), float(match.group(1))
+        x_resolution = page.tags.get('XResolution')
+        y_resolution = page.tags.get('YResolution')
+        unit = page.tags.get('ResolutionUnit')
+        if x_resolution is not None and y_resolution is not None and unit is not None and int(unit.value) in (2, 3):
+            per_unit = 25400.0 if int(unit.value) == 2 else 10000.0  # Microns per inch or per centimetre
+            mpp = []
+            for tag in (x_resolution, y_resolution):
+                numerator, denominator = tag.value
+                if not numerator:
+                    return None
+                mpp.append(per_unit * denominator / numerator)
+            return tuple(mpp)
+        return None
+
+    def _read_bytes(self, offset, count):
+        if hasattr(os, 'pread'):
+            return os.pread(self._fd, count, offset)
+        with self._read_lock:
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            return os.read(self._fd, count)
+
+    def _decode(self, level, index):
+        """One chunk as (y, x, RGBA array) in level pixels, or None for a chunk not in the file."""
+        if not level.bytecounts[index]:
+            return None
+        data = self._read_bytes(level.offsets[index], level.bytecounts[index])
+        page = level.page
+        chunk, indices, _ = page.decode(data, index, jpegtables=page.jpegtables, jpegheader=page.jpegheader)
+        if chunk is None:
+            return None
+        chunk = chunk.reshape(chunk.shape[-3:])
+        if level.samples == 1:
+            chunk = np.repeat(chunk, 3, axis=2)
+        if chunk.shape[2] == 3:
+            chunk = np.concatenate([chunk, np.full(chunk.shape[:2] + (1,), 255, np.uint8)], axis=2)
+        return indices[-3], indices[-2], chunk
+
+    def read_array(self, location, level, size):
+        """RGBA array of `size` pixels of `level` at level-0 `location`; outside the slide is transparent."""
+        width, height = size
+        downsample = self.level_downsamples[level]
+        left, top = int(location[0] / downsample), int(location[1] / downsample)
+        tiff_level = self._levels[level]
+        region = np.zeros((height, width, 4), dtype=np.uint8)
+        if left >= tiff_level.width or top >= tiff_level.height or left + width <= 0 or top + height <= 0:
+            return region
+
+        def place(index):
+            decoded = self._decode(tiff_level, index)
+            if decoded is None:
+                return
+            y, x, chunk = decoded
+            # Overlap of the chunk with the window, clipped to the level (edge chunks are padded)
+            x0, y0 = max(left, x), max(top, y)
+            x1 = min(left + width, x + chunk.shape[1], tiff_level.width)
+            y1 = min(top + height, y + chunk.shape[0], tiff_level.height)
+            if x1 > x0 and y1 > y0:
+                region[y0 - top:y1 - top, x0 - left:x1 - left] = chunk[y0 - y:y1 - y, x0 - x:x1 - x]
+
+        chunks = tiff_level.chunks(left, top, width, height)
+        if self.threads > 1 and len(chunks) > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='spider-decode')
+            # Each chunk fills its own part of the region; list() re-raises decoding errors
+            list(self._executor.map(place, chunks))
+        else:
+            for index in chunks:
+                place(index)
+        return region
+
+    def read_region(self, location, level, size):
+        return Image.fromarray(self.read_array(location, level, size), 'RGBA')
+
+    def get_best_level_for_downsample(self, downsample):
+        """Largest level whose downsample does not exceed the requested one, as in OpenSlide."""
+        best = 0
+        for level, level_downsample in enumerate(self.level_downsamples):
+            if level_downsample <= downsample * 1.01:
+                best = level
+        return best
+
+    def get_thumbnail(self, size):
+        """RGB image of the whole slide fitting in `size`, read from the closest level in bands of rows."""
+        width, height = self.dimensions
+        scale = min(size[0] / width, size[1] / height)
+        thumbnail_size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+        level = self.get_best_level_for_downsample(1 / scale)
+        level_width, level_height = self.level_dimensions[level]
+        downsample = self.level_downsamples[level]
+
+        thumbnail = Image.new('RGB', thumbnail_size, (255, 255, 255))
+        for top in range(0, level_height, THUMBNAIL_BAND_ROWS):
+            rows = min(THUMBNAIL_BAND_ROWS, level_height - top)
+            band = self.read_region((0, int(top * downsample)), level, (level_width, rows))
+            y0 = int(round(top * thumbnail_size[1] / level_height))
+            y1 = max(y0 + 1, int(round((top + rows) * thumbnail_size[1] / level_height)))
+            band = band.resize((thumbnail_size[0], y1 - y0), Image.BILINEAR)
+            thumbnail.paste(band, (0, y0), mask=band.split()[3])
+        return thumbnail
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._tif.close()
+
+
+# Registered backends, in the order they are tried
+READERS = OrderedDict([(TiffReader.name, TiffReader), (OpenSlideReader.name, OpenSlideReader)])
+
+
+def register_reader(reader_class, first=False):
+    """Add a backend: a class with `name`, `extensions` (None for any file), optionally a
+    `claims(path)` classmethod narrowing the files it is preferred for, and the reader interface."""
+    READERS[reader_class.name] = reader_class
+    if first:
+        READERS.move_to_end(reader_class.name, last=False)
+
+
+def candidate_readers(path):
+    """Backends to try for a file: those claiming its format, then the catch-all ones, then the
+    remaining ones registered for its extension (e.g. when OpenSlide cannot open it after all)."""
+    forced = os.environ.get('SPIDER_SLIDE_READER')
+    if forced:
+        return [READERS[forced]]
+    lower = path.lower()
+    by_extension = [r for r in READERS.values() if r.extensions and lower.endswith(tuple(r.extensions))]
+    claimed = [r for r in by_extension if not hasattr(r, 'claims') or r.claims(path)]
+    return (claimed + [r for r in READERS.values() if not r.extensions]
+            + [r for r in by_extension if r not in claimed])
+
+
+def open_reader(path):
+    """Open a slide with the first backend that can read it."""
+    errors = []
+    for reader_class in candidate_readers(path):
+        try:
+            return reader_class(path)
+        except Exception as e:
+            errors.append(f"{reader_class.name}: {str(e)}")
+    raise IOError(f"No reader backend could open {path} ({'; '.join(errors) or 'no backends'})")
+
+
+if __name__ == "__main__":
+    import time
+    import random
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Time windowed reads with one and several decode threads")
+    parser.add_argument('slide_path')
+    parser.add_argument('--threads', type=int, default=MAX_DECODE_THREADS, help="Decode threads to compare with one")
+    parser.add_argument('--reads', type=int, default=50, help="Random 1120 x 1120 level-0 windows (default: 50)")
+    args = parser.parse_args()
+
+    slide = open_reader(args.slide_path)
+    print(f"{args.slide_path}: {slide.properties[READER_PROPERTY]} backend, {slide.dimensions[0]} x "
+          f"{slide.dimensions[1]}, {slide.level_count} level(s), {slide.properties.get(MPP_X_PROPERTY)} µm/pixel")
+    width, height = slide.dimensions
+    rng = random.Random(0)
+    windows = [(rng.randrange(max(1, width - 1120)), rng.randrange(max(1, height - 1120))) for _ in range(args.reads)]
+    reference = None
+    for threads in (1, args.threads):
+        if hasattr(slide, 'threads'):
+            slide.threads = threads
+        start = time.time()
+        arrays = [slide.read_array(window, 0, (1120, 1120)) for window in windows]
+        elapsed = time.time() - start
+        print(f"{threads} decode thread(s): {1000 * elapsed / len(windows):.1f} ms per window")
+        if reference is None:
+            reference = arrays
+        elif not all(np.array_equal(a, b) for a, b in zip(arrays, reference)):
+            print("Warning: reads differ between thread counts")
+    slide.close()
@@ -0,0 +1,320 @@
+# spider_shards.py
+# Deterministic sharding of whole-slide and cohort runs across nodes
+# A shard is one of --shard-count disjoint parts of the work, chosen by
+# --shard-index alone, so shards run independently on separate machines with
+# nothing shared but the inputs:
+#   - a slide's raster patch set is cut into runs of consecutive patches dealt
+#     round-robin to the shards (neighbouring patches share slide tiles, and
+#     every shard gets a part of each tissue region);
+#   - a cohort's slide list is sorted and dealt round-robin, one slide per turn.
+# Each whole-slide shard writes its patch_predictions.json and a
+# shard_manifest.json; `whole_slide_analysis_spider_universal.py merge` checks
+# that every shard of the same run is present and writes the usual heatmaps,
+# detections, analysis_summary.json and report.html without re-running inference.
+#
+# Several local processes can stand in for nodes:
+#   python spider_shards.py local 4 <model_path> <svs_path> <output_folder> [-- <analysis options>]
+# Cohorts (one slide path per line), one command per node, then a combined summary:
+#   python spider_shards.py cohort <slide_list> <model_path> <output_root> --shard-index I --shard-count N
+#   python spider_shards.py cohort-merge <output_root>
+
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import subprocess
+from datetime import datetime
+
+from spider_tile_cache import merge_stats
+
+SHARD_MANIFEST = 'shard_manifest.json'
+
+# Consecutive raster patches dealt to one shard at a time
+SHARD_CHUNK = 32
+
+# Options that may differ between shards of one run (each node plans its own execution)
+EXECUTION_OPTIONS = ('shard_index', 'output_folder', 'num_workers', 'pipeline', 'readers', 'batch_size',
+                     'ensemble_threads')
+
+WHOLE_SLIDE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'whole_slide_analysis_spider_universal.py')
+
+COHORT_SHARD_PATTERN = 'cohort_shard_*.json'
+COHORT_SUMMARY = 'cohort_summary.json'
+
+
+def add_shard_arguments(parser):
+    parser.add_argument('--shard-index', type=int, default=0,
+                        help="Shard of the work (a slide's patch set or a cohort's slides) this run covers, from 0 (default: 0)")
+    parser.add_argument('--shard-count', type=int, default=1,
+                        help="Number of disjoint shards the work is split into; whole-slide shard outputs are "
+                             "combined with the merge subcommand (default: 1, no sharding)")
+
+
+def check_shard(shard_index, shard_count):
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(f"Shard index {shard_index} is not in 0..{shard_count - 1}")
+
+
+def shard_items(items, shard_index, shard_count, chunk_size=SHARD_CHUNK):
+    """Items of one shard: runs of chunk_size consecutive items, dealt round-robin."""
+    check_shard(shard_index, shard_count)
+    items = list(items)
+    selected = []
+    for start in range(shard_index * chunk_size, len(items), shard_count * chunk_size):
+        selected.extend(items[start:start + chunk_size])
+    return selected
+
+
+def shard_slides(slide_paths, shard_index, shard_count):
+    """Slides of one shard: the sorted list dealt round-robin, independent of the input order."""
+    check_shard(shard_index, shard_count)
+    return sorted(slide_paths)[shard_index::shard_count]
+
+
+def write_manifest(output_folder, manifest):
+    path = os.path.join(output_folder, SHARD_MANIFEST)
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return path
+
+
+def load_shards(shard_folders):
+    """Manifests (by shard index) and combined raster-ordered results of a complete set of shards.
+
+    Raises ValueError when a shard is missing or duplicated, the shards were
+    run with different analysis options, or two shards classified the same patch.
+    """
+    manifests = []
+    for folder in shard_folders:
+        path = os.path.join(folder, SHARD_MANIFEST)
+        if not os.path.exists(path):
+            raise ValueError(f"{folder} has no {SHARD_MANIFEST}; was it run with --shard-count?")
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        manifest['folder'] = folder
+        manifests.append(manifest)
+    manifests.sort(key=lambda m: m['shard_index'])
+
+    shard_count = manifests[0]['shard_count']
+    indices = [m['shard_index'] for m in manifests]
+    if any(m['shard_count'] != shard_count for m in manifests):
+        raise ValueError(f"Shards of different runs: shard counts {sorted({m['shard_count'] for m in manifests})}")
+    if indices != list(range(shard_count)):
+        missing = sorted(set(range(shard_count)) - set(indices))
+        duplicated = sorted({i for i in indices if indices.count(i) > 1})
+        raise ValueError(f"Incomplete shard set of {shard_count}: missing {missing}, duplicated {duplicated}")
+
+    reference = {k: v for k, v in manifests[0]['args'].items() if k not in EXECUTION_OPTIONS}
+    for manifest in manifests[1:]:
+        options = {k: v for k, v in manifest['args'].items() if k not in EXECUTION_OPTIONS}
+        differing = sorted(k for k in set(reference) | set(options) if reference.get(k) != options.get(k))
+        if differing:
+            raise ValueError(f"Shard {manifest['shard_index']} was run with different options: {differing}")
+
+    results = []
+    seen = set()
+    for manifest in manifests:
+        with open(os.path.join(manifest['folder'], 'patch_predictions.json'), 'r') as f:
+            shard_results = json.load(f)
+        for result in shard_results:
+            location = (result['x'], result['y'])
+            if location in seen:
+                raise ValueError(f"Patch at {location} was classified by more than one shard")
+            seen.add(location)
+        results.extend(shard_results)
+    results.sort(key=lambda r: (r['y'], r['x']))
+    return manifests, results
+
+
+def merge_timing(manifests):
+    """Timing of a merged run: shards run concurrently, so the slowest shard is the analysis time."""
+    timings = [m['timing'] for m in manifests]
+    tile_cache = [t['tile_cache'] for t in timings if t.get('tile_cache')]
+    stains = [t['stain_normalization'] for t in timings if t.get('stain_normalization')]
+
+    stain_stats = None
+    if stains:
+        stain_stats = {key: sum(s[key] for s in stains) for key in ('estimated', 'from_cache', 'patches')}
+        stain_stats['slides'] = max(s['slides'] for s in stains)
+        stain_stats['estimate_seconds'] = round(sum(s['estimate_seconds'] for s in stains), 3)
+        stain_stats['apply_seconds'] = round(sum(s['apply_seconds'] for s in stains), 3)
+        per_patch = [s['apply_ms_per_patch'] for s in stains if s['apply_ms_per_patch'] is not None]
+        stain_stats['apply_ms_per_patch'] = round(sum(per_patch) / len(per_patch), 3) if per_patch else None
+
+    def peak(key):
+        values = [t['memory'][key] for t in timings if t['memory'].get(key) is not None]
+        return max(values) if values else None
+
+    return {
+        'analysis_seconds': max(t['analysis_seconds'] for t in timings),
+        'shard_seconds': [t['analysis_seconds'] for t in timings],
+        'tile_cache': merge_stats(tile_cache) if tile_cache else None,
+        'stain_normalization': stain_stats,
+        # Peaks of the largest shard; every shard's own figures are kept alongside
+        'memory': {
+            'peak_rss_mb': peak('peak_rss_mb'),
+            'peak_worker_rss_mb': peak('peak_worker_rss_mb'),
+            'shards': [t['memory'] for t in timings]
+        }
+    }
+
+
+def cpu_groups(count):
+    """The CPUs of this process split into `count` contiguous groups (None where affinity is unsupported)."""
+    if not hasattr(os, 'sched_getaffinity'):
+        return [None] * count
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < count:
+        return [None] * count
+    size = len(cpus) // count
+    return [cpus[i * size:(i + 1) * size if i < count - 1 else len(cpus)] for i in range(count)]
+
+
+def run_local(shard_count, model_path, svs_path, output_folder, analysis_args=()):
+    """Run every shard of a slide as a local process, then merge; returns the merge exit code.
+
+    Each process is pinned to its own group of CPUs, so its execution plan
+    covers only its part of the machine, as it would on a separate node.
+    """
+    shard_root = os.path.join(output_folder, 'shards')
+    folders = [os.path.join(shard_root, f"shard_{i}") for i in range(shard_count)]
+    processes = []
+    start = time.time()
+    for index, (folder, cpus) in enumerate(zip(folders, cpu_groups(shard_count))):
+        command = [sys.executable, WHOLE_SLIDE_SCRIPT, model_path, svs_path, folder, *analysis_args,
+                   '--shard-index', str(index), '--shard-count', str(shard_count)]
+        affinity = (lambda cpus=cpus: os.sched_setaffinity(0, cpus)) if cpus is not None else None
+        print(f"Starting shard {index}/{shard_count}" + (f" on CPUs {cpus[0]}-{cpus[-1]}" if cpus else ""))
+        processes.append(subprocess.Popen(command, preexec_fn=affinity))
+
+    failed = [i for i, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        print(f"Shards {failed} failed; not merging")
+        return 1
+    print(f"All {shard_count} shards finished in {time.time() - start:.1f}s; merging")
+    return subprocess.call([sys.executable, WHOLE_SLIDE_SCRIPT, 'merge', output_folder, *folders])
+
+
+def read_slide_list(path):
+    """Slide paths of a cohort list: one per line, blank lines and #-comments ignored."""
+    with open(path, 'r') as f:
+        slides = [line.strip() for line in f]
+    return [s for s in slides if s and not s.startswith('#')]
+
+
+def slide_folder(output_root, slide_path):
+    return os.path.join(output_root, os.path.splitext(os.path.basename(slide_path))[0])
+
+
+def run_cohort(slide_list, model_path, output_root, shard_index, shard_count, analysis_args=(), rerun=False):
+    """Analyze this shard's slides one after another; returns the number of failed slides."""
+    slides = read_slide_list(slide_list)
+    names = [os.path.basename(slide_folder(output_root, s)) for s in slides]
+    duplicated = sorted({n for n in names if names.count(n) > 1})
+    if duplicated:
+        raise ValueError(f"Slides share output folder names: {duplicated}")
+
+    assigned = shard_slides(slides, shard_index, shard_count)
+    print(f"Shard {shard_index}/{shard_count}: {len(assigned)} of {len(slides)} slides")
+    os.makedirs(output_root, exist_ok=True)
+    status = []
+    for i, slide_path in enumerate(assigned):
+        folder = slide_folder(output_root, slide_path)
+        if not rerun and os.path.exists(os.path.join(folder, 'analysis_summary.json')):
+            print(f"[{i + 1}/{len(assigned)}] {slide_path}: already analyzed")
+            status.append({'slide_path': slide_path, 'output_folder': folder, 'status': 'done', 'seconds': 0})
+            continue
+        print(f"[{i + 1}/{len(assigned)}] Analyzing {slide_path}")
+        start = time.time()
+        code = subprocess.call([sys.executable, WHOLE_SLIDE_SCRIPT, model_path, slide_path, folder, *analysis_args])
+        status.append({
+            'slide_path': slide_path,
+            'output_folder': folder,
+            'status': 'done' if code == 0 else f'failed ({code})',
+            'seconds': round(time.time() - start, 1)
+        })
+
+    with open(os.path.join(output_root, f"cohort_shard_{shard_index}_of_{shard_count}.json"), 'w') as f:
+        json.dump({'shard_index': shard_index, 'shard_count': shard_count, 'slide_list': slide_list,
+                   'timestamp': datetime.now().isoformat(), 'slides': status}, f, indent=2)
+    return sum(1 for s in status if s['status'] != 'done')
+
+
+def merge_cohort(output_root):
+    """Combine the cohort shard records and per-slide summaries into cohort_summary.json."""
+    records = []
+    for path in sorted(glob.glob(os.path.join(output_root, COHORT_SHARD_PATTERN))):
+        with open(path, 'r') as f:
+            records.append(json.load(f))
+    if not records:
+        raise ValueError(f"No {COHORT_SHARD_PATTERN} in {output_root}")
+    shard_count = max(r['shard_count'] for r in records)
+    missing = sorted(set(range(shard_count)) - {r['shard_index'] for r in records if r['shard_count'] == shard_count})
+
+    slides = []
+    for record in sorted(records, key=lambda r: r['shard_index']):
+        for entry in record['slides']:
+            summary_path = os.path.join(entry['output_folder'], 'analysis_summary.json')
+            if entry['status'] == 'done' and os.path.exists(summary_path):
+                with open(summary_path, 'r') as f:
+                    summary = json.load(f)
+                entry = {**entry, 'model_type': summary['model_type'],
+                         'patches': summary['analysis_parameters']['total_patches'],
+                         'class_distribution': {c: d['percentage'] for c, d in summary['class_distribution'].items()}}
+            slides.append(entry)
+    slides.sort(key=lambda s: s['slide_path'])
+
+    cohort = {
+        'shard_count': shard_count,
+        'missing_shards': missing,
+        'slides': slides,
+        'failed': [s['slide_path'] for s in slides if s['status'] != 'done'],
+        'timestamp': datetime.now().isoformat()
+    }
+    with open(os.path.join(output_root, COHORT_SUMMARY), 'w') as f:
+        json.dump(cohort, f, indent=2)
+    return cohort
+
+
+if __name__ == "__main__":
+    # Options after "--" are passed to every whole-slide analysis unchanged
+    argv = sys.argv[1:]
+    analysis_args = []
+    if '--' in argv:
+        analysis_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    parser = argparse.ArgumentParser(description="Run sharded SPIDER whole-slide and cohort analyses")
+    commands = parser.add_subparsers(dest='command', required=True)
+    local = commands.add_parser('local', help="Run every shard of a slide as a local process, then merge")
+    local.add_argument('shard_count', type=int)
+    local.add_argument('model_path')
+    local.add_argument('svs_path')
+    local.add_argument('output_folder')
+    cohort = commands.add_parser('cohort', help="Analyze one shard of a cohort's slides")
+    cohort.add_argument('slide_list', help="Text file with one slide path per line")
+    cohort.add_argument('model_path')
+    cohort.add_argument('output_root', help="One output folder per slide is created here")
+    add_shard_arguments(cohort)
+    cohort.add_argument('--rerun', action='store_true', help="Analyze slides that already have a summary again")
+    cohort_merge = commands.add_parser('cohort-merge', help=f"Combine cohort shards into {COHORT_SUMMARY}")
+    cohort_merge.add_argument('output_root')
+    args = parser.parse_args(argv)
+
+    if args.command == 'local':
+        sys.exit(run_local(args.shard_count, args.model_path, args.svs_path, args.output_folder, analysis_args))
+    elif args.command == 'cohort':
+        try:
+            failed = run_cohort(args.slide_list, args.model_path, args.output_root, args.shard_index,
+                                args.shard_count, analysis_args, rerun=args.rerun)
+        except ValueError as e:
+            print(f"Error: {str(e)}")
+            sys.exit(1)
+        sys.exit(1 if failed else 0)
+    else:
+        cohort = merge_cohort(args.output_root)
+        print(f"{len(cohort['slides'])} slides from {cohort['shard_count']} shards, {len(cohort['failed'])} failed"
+              + (f", missing shards {cohort['missing_shards']}" if cohort['missing_shards'] else ""))
+        print(f"Saved {os.path.join(args.output_root, COHORT_SUMMARY)}")
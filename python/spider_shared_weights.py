@@ -0,0 +1,183 @@
+# spider_shared_weights.py
+# Model weights shared by forked worker processes, and per-worker memory measurement
+# The parent loads each model once and moves its parameters and buffers into
+# shared memory (torch share_memory_(), backed by /dev/shm), then freezes the
+# garbage collector's view of the objects it holds. Workers forked afterwards
+# map the same weight pages: nothing a worker does to them makes a private copy,
+# and the collector no longer writes to every inherited object header.
+#
+# RSS counts shared pages in every process that maps them, so it grows with the
+# worker count whether or not anything is duplicated. What each extra worker
+# really costs is its private memory (USS), read from /proc/<pid>/smaps_rollup.
+#
+# Per-worker private and shared memory with the weights shared vs. loaded by
+# every worker:
+#   python spider_shared_weights.py <model_path> [--workers 4]
+
+import gc
+import os
+import time
+import argparse
+import multiprocessing as mp
+
+try:
+    import psutil
+    HAS_PSUTIL = True
+except ImportError:
+    HAS_PSUTIL = False
+
+# Memory figures recorded per worker, in bytes
+MEMORY_KEYS = ('rss', 'pss', 'shared', 'private')
+
+# Patches between memory samples in a worker (reading smaps walks the page tables)
+MEMORY_SAMPLE_INTERVAL = 32
+
+
+def can_share_weights():
+    """Workers can map the parent's weights only when they are forked from it."""
+    return 'fork' in mp.get_all_start_methods()
+
+
+def worker_context():
+    """Multiprocessing context for inference workers: fork where available, so workers inherit loaded models."""
+    return mp.get_context('fork') if can_share_weights() else mp.get_context()
+
+
+def share_weights(models):
+    """Move the parameters and buffers of CPU models into shared memory; returns the bytes shared.
+
+    Call after loading and before forking workers. Already shared storages
+    (e.g. a second reference to the same model) are left as they are.
+    """
+    shared = 0
+    for model in models:
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            if tensor.device.type != 'cpu':
+                continue
+            if not tensor.is_shared():
+                tensor.share_memory_()
+            shared += tensor.numel() * tensor.element_size()
+    # Objects that exist now are never collected or moved, so forked workers do not dirty their pages
+    gc.collect()
+    gc.freeze()
+    return shared
+
+
+def process_memory(pid='self'):
+    """Resident memory of a process in bytes, split into shared and private pages, or None."""
+    try:
+        values = {}
+        with open(f'/proc/{pid}/smaps_rollup', 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 3 and parts[2] == 'kB':
+                    values[parts[0].rstrip(':')] = int(parts[1]) * 1024
+        return {
+            'rss': values.get('Rss', 0),
+            'pss': values.get('Pss', 0),
+            'shared': values.get('Shared_Clean', 0) + values.get('Shared_Dirty', 0),
+            'private': values.get('Private_Clean', 0) + values.get('Private_Dirty', 0)
+        }
+    except (OSError, ValueError):
+        pass
+    if HAS_PSUTIL:
+        try:
+            process = psutil.Process(os.getpid() if pid == 'self' else int(pid))
+            info = process.memory_full_info()
+            return {
+                'rss': info.rss,
+                'pss': getattr(info, 'pss', info.rss),
+                'shared': getattr(info, 'shared', 0),
+                'private': info.uss
+            }
+        except (psutil.Error, AttributeError):
+            pass
+    return None
+
+
+class WorkerMemory:
+    """Memory of each worker at its largest private footprint, in an array shared with the parent."""
+
+    def __init__(self, n_workers, context=None):
+        self.n_workers = n_workers
+        self.values = (context or mp).Array('q', n_workers * len(MEMORY_KEYS))
+        self.samples = 0
+
+    def record(self, worker_index):
+        """Sample this worker's memory (every MEMORY_SAMPLE_INTERVAL calls, starting with the first)."""
+        self.samples += 1
+        if (self.samples - 1) % MEMORY_SAMPLE_INTERVAL:
+            return
+        memory = process_memory()
+        if memory is None:
+            return
+        start = worker_index * len(MEMORY_KEYS)
+        if memory['private'] >= self.values[start + MEMORY_KEYS.index('private')]:
+            self.values[start:start + len(MEMORY_KEYS)] = [memory[key] for key in MEMORY_KEYS]
+
+    def summary(self):
+        workers = []
+        for i in range(self.n_workers):
+            sample = dict(zip(MEMORY_KEYS, self.values[i * len(MEMORY_KEYS):(i + 1) * len(MEMORY_KEYS)]))
+            if sample['rss']:
+                workers.append({f'{key}_mb': round(value / 1e6, 1) for key, value in sample.items()})
+        if not workers:
+            return None
+        return {
+            'workers': workers,
+            # What one more worker costs: its private pages; the shared ones are paid once
+            'mean_private_mb': round(sum(w['private_mb'] for w in workers) / len(workers), 1),
+            'max_shared_mb': max(w['shared_mb'] for w in workers)
+        }
+
+
+def describe_worker_memory(summary):
+    return (f"Worker memory: {summary['mean_private_mb']:.0f} MB private per worker (incremental), "
+            f"up to {summary['max_shared_mb']:.0f} MB shared, over {len(summary['workers'])} workers")
+
+
+_entry = None
+
+
+def _measure_worker(args):
+    # Benchmark worker: one forward pass, then this process's memory
+    model_path, reload, shape = args
+    import torch
+    from spider_model_registry import get_registry
+    if reload:
+        registry = get_registry()
+        registry.evict(model_path)
+        entry = registry.get(model_path)
+    else:
+        entry = _entry
+    with torch.no_grad():
+        entry.model(pixel_values=torch.rand((1, *shape)))
+    time.sleep(0.5)  # Keep every worker alive until all have measured
+    return process_memory()
+
+
+if __name__ == "__main__":
+    import torch
+    from spider_model_registry import get_registry
+    from spider_preprocessing import FastPreprocessor
+
+    parser = argparse.ArgumentParser(description="Measure per-worker memory with shared and per-worker model weights")
+    parser.add_argument('model_path')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    _entry = get_registry(torch.device('cpu')).get(args.model_path)
+    shape = FastPreprocessor.from_pretrained(args.model_path).output_shape(1120, 1120)
+    print(f"Model weights: {_entry.nbytes / 1e6:.0f} MB; parent {process_memory()['rss'] / 1e6:.0f} MB RSS")
+
+    # Per-worker copies first: sharing moves the parent's weights for good
+    for label, reload in (("weights loaded by every worker", True), ("weights shared by the parent", False)):
+        if not reload:
+            print(f"Shared {share_weights([_entry.model]) / 1e6:.0f} MB of weights")
+        with worker_context().Pool(args.workers) as pool:
+            samples = pool.map(_measure_worker, [(args.model_path, reload, shape)] * args.workers)
+        private = sum(s['private'] for s in samples) / len(samples) / 1e6
+        rss = sum(s['rss'] for s in samples) / len(samples) / 1e6
+        print(f"{label}: {private:.0f} MB private per worker (RSS {rss:.0f} MB); "
+              f"{args.workers} workers add {args.workers * private:.0f} MB")
@@ -0,0 +1,255 @@
+# spider_shm_pipeline.py
+# Multi-process whole-slide pipeline over a shared-memory patch ring buffer
+# Reader processes decode patches straight into fixed-size slots of a
+# multiprocessing.shared_memory block; inference workers receive slot indices
+# (a few bytes each) instead of pickled pixel arrays, and return compact NumPy
+# record arrays. Readers and inference workers are scaled independently.
+# Each reader ends its patches with a marker on the same queue, which a worker
+# passes on to the parent; workers are stopped only once every marker has come
+# through, so no patch can be overtaken by a stop marker. A process that fails
+# to start, or dies, fails the run instead of leaving it waiting.
+
+import queue
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from spider_shared_weights import worker_context
+
+# Queue messages besides slot indices / result records
+READER_DONE = 'reader_done'
+WORKER_DONE = 'worker_done'
+FAILED = 'failed'
+
+# Seconds between liveness checks while waiting for results
+POLL_INTERVAL = 5
+
+# Inference batch size when none is given
+DEFAULT_BATCH_SIZE = 4
+
+
+def result_dtype(n_classes):
+    """Record layout of one patch result."""
+    return np.dtype([
+        ('x', np.int64),
+        ('y', np.int64),
+        ('prediction', np.int32),
+        ('confidence', np.float32),
+        ('probabilities', np.float32, (n_classes,))
+    ])
+
+
+class PatchRingBuffer:
+    """Fixed-size RGB patch slots in one shared memory block."""
+
+    def __init__(self, n_slots, patch_size, name=None):
+        self.n_slots = n_slots
+        self.patch_size = patch_size
+        slot_shape = (n_slots, patch_size, patch_size, 3)
+        nbytes = int(np.prod(slot_shape))
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.slots = np.ndarray(slot_shape, dtype=np.uint8, buffer=self.shm.buf)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        self.slots = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _reader(rank, locations, slide_path, buffer_name, n_slots, patch_size, downsample, free_slots, ready, results):
+    """Decode patches into free slots and announce (slot, x, y) on the ready queue, then READER_DONE."""
+    ring = None
+    slide = None
+    try:
+        from spider_readers import open_reader
+        from spider_slide_io import read_region_at
+
+        ring = PatchRingBuffer(n_slots, patch_size, name=buffer_name)
+        slide = open_reader(slide_path)
+        for x, y in locations:
+            slot = free_slots.get()
+            try:
+                region = np.asarray(read_region_at(slide, (x, y), (patch_size, patch_size), downsample))
+                np.copyto(ring.slots[slot], region[..., :3])
+            except Exception as e:
+                print(f"Error reading patch at ({x}, {y}): {str(e)}")
+                free_slots.put(slot)
+                continue
+            ready.put((slot, x, y))
+    except Exception as e:
+        results.put((FAILED, f"Reader {rank}: {str(e)}"))
+    finally:
+        if slide is not None:
+            slide.close()
+        if ring is not None:
+            ring.close()
+        # After this reader's last patch on the same queue, so it cannot overtake them
+        ready.put(READER_DONE)
+
+
+def _inference_worker(rank, plan, model_path, buffer_name, n_slots, patch_size, batch_size, stain,
+                      free_slots, ready, results):
+    """Classify batches of ready slots and send record arrays back."""
+    def take(block=True):
+        # Reader end markers go on to the parent, which counts them
+        while True:
+            item = ready.get(block)
+            if not isinstance(item, str):
+                return item
+            results.put(item)
+
+    ring = None
+    try:
+        import torch
+        from spider_execution import apply_worker_settings
+        from spider_model_registry import get_registry
+        from spider_preprocessing import FastPreprocessor
+        from spider_batching import is_out_of_memory
+
+        apply_worker_settings(plan, rank)
+        entry = get_registry().get(model_path)
+        model = entry.model
+        device = get_registry().device
+        preprocessor = FastPreprocessor.from_pretrained(model_path, batch_size=batch_size, device=device)
+        dtype = result_dtype(len(entry.class_names))
+
+        def forward(pixel_values):
+            with torch.no_grad():
+                logits = model(pixel_values=pixel_values).logits
+            return torch.softmax(logits, dim=1).cpu().numpy()
+
+        ring = PatchRingBuffer(n_slots, patch_size, name=buffer_name)
+        finished = False
+        while not finished:
+            # Block for one patch, then take whatever else is ready up to the batch size
+            batch = [take()]
+            while len(batch) < batch_size and batch[-1] is not None:
+                try:
+                    batch.append(take(block=False))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                finished = True
+                batch = batch[:-1]
+            if not batch:
+                continue
+
+            slots = [item[0] for item in batch]
+            try:
+                # The preprocessor copies the pixels, so slots are free again right after
+                pixel_values = preprocessor([ring.slots[slot] for slot in slots], stain)
+                for slot in slots:
+                    free_slots.put(slot)
+                slots = []
+                try:
+                    probabilities = forward(pixel_values)
+                except Exception as e:
+                    if not is_out_of_memory(e) or len(batch) == 1:
+                        raise
+                    # Out of memory: smaller batches from now on, and this one in pieces
+                    batch_size = max(1, len(batch) // 2)
+                    print(f"Worker {rank}: out of memory, batch size now {batch_size}")
+                    probabilities = np.concatenate([forward(pixel_values[i:i + batch_size])
+                                                    for i in range(0, len(batch), batch_size)])
+            except Exception as e:
+                print(f"Error classifying batch of {len(batch)} patches: {str(e)}")
+                for slot in slots:
+                    free_slots.put(slot)
+                continue
+
+            records = np.empty(len(batch), dtype=dtype)
+            records['x'] = [item[1] for item in batch]
+            records['y'] = [item[2] for item in batch]
+            records['prediction'] = probabilities.argmax(axis=1)
+            records['confidence'] = probabilities.max(axis=1)
+            records['probabilities'] = probabilities
+            results.put(records)
+    except Exception as e:
+        results.put((FAILED, f"Inference worker {rank}: {str(e)}"))
+    finally:
+        if ring is not None:
+            ring.close()
+        results.put(WORKER_DONE)
+
+
+def run_pipeline(slide_path, model_path, locations, patch_size, downsample, class_names, plan,
+                 n_readers=2, batch_size=DEFAULT_BATCH_SIZE, stain=None):
+    """Classify `locations` (level-0 x, y) and yield result dicts as batches complete.
+
+    `stain` is an optional spider_stain.StainNormalizer applied to every batch.
+    """
+    n_workers = plan['workers']
+    n_slots = n_readers + 2 * n_workers * batch_size
+    ring = PatchRingBuffer(n_slots, patch_size)
+    print(f"Shared-memory pipeline: {n_readers} reader(s), {n_workers} inference worker(s), "
+          f"{n_slots} slots ({ring.slots.nbytes / 1e6:.0f} MB)")
+
+    # Forked where available, like the pool workers, so inference workers map the parent's shared weights
+    context = worker_context()
+    free_slots = context.Queue()
+    ready = context.Queue()
+    results = context.Queue()
+    for slot in range(n_slots):
+        free_slots.put(slot)
+
+    readers = [context.Process(target=_reader, args=(
+        rank, locations[rank::n_readers], slide_path, ring.name, n_slots, patch_size, downsample,
+        free_slots, ready, results)) for rank in range(n_readers)]
+    workers = [context.Process(target=_inference_worker, args=(
+        rank, plan, model_path, ring.name, n_slots, patch_size, batch_size, stain,
+        free_slots, ready, results)) for rank in range(n_workers)]
+    for process in readers + workers:
+        process.start()
+
+    readers_done = 0
+    workers_done = 0
+    try:
+        while workers_done < n_workers:
+            try:
+                message = results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                # Killed processes (e.g. out of memory) never send their markers
+                for kind, processes in (('Reader', readers), ('Inference worker', workers)):
+                    for rank, process in enumerate(processes):
+                        if process.exitcode not in (None, 0):
+                            raise RuntimeError(f"{kind} {rank} exited with code {process.exitcode}; "
+                                               f"shared-memory pipeline stopped")
+                continue
+            if isinstance(message, tuple):
+                raise RuntimeError(f"Shared-memory pipeline failed: {message[1]}")
+            if isinstance(message, str):
+                if message == READER_DONE:
+                    readers_done += 1
+                    if readers_done == n_readers:
+                        # Every patch has been taken by a worker: one stop marker per inference worker
+                        for _ in range(n_workers):
+                            ready.put(None)
+                else:
+                    workers_done += 1
+                continue
+
+            for record in message:
+                yield {
+                    'x': int(record['x']),
+                    'y': int(record['y']),
+                    'prediction': class_names[int(record['prediction'])],
+                    'probabilities': record['probabilities'].tolist(),
+                    'confidence': float(record['confidence'])
+                }
+    finally:
+        # After a failure the rest would only wait on each other
+        for process in readers + workers:
+            process.join(timeout=10 if workers_done == n_workers else 0)
+            if process.is_alive():
+                process.terminate()
+        ring.close()
@@ -0,0 +1,82 @@
+# spider_slide_io.py
+# Pyramid-level-aware slide reading
+# Reads each request from the pyramid level closest to the requested resolution
+# and only resamples the remainder, instead of decoding level 0 and downsampling.
+
+import os
+import math
+from PIL import Image
+from spider_tile_cache import get_tile_cache
+
+# Largest level (in pixels) read in one piece for a thumbnail
+MAX_THUMBNAIL_READ_PIXELS = 64 * 1024 * 1024
+
+
+def best_level(slide, downsample):
+    """Pyramid level to read for an effective downsample, and that level's downsample."""
+    level = slide.get_best_level_for_downsample(downsample)
+    return level, slide.level_downsamples[level]
+
+
+def read_region(slide, location, level, size):
+    """OpenSlide.read_region through the process-wide tile cache (when enabled)."""
+    cache = get_tile_cache()
+    if cache.enabled:
+        return cache.read_region(slide, location, level, size)
+    return slide.read_region(location, level, size)
+
+
+def read_region_at(slide, location, size, downsample=1.0):
+    """Read `size` output pixels covering size * downsample level-0 pixels at `location`.
+
+    The returned image is RGBA, as from OpenSlide.read_region. At downsample 1.0
+    this is a plain level-0 read.
+    """
+    if downsample <= 1.0:
+        return read_region(slide, location, 0, size)
+
+    level, level_ds = best_level(slide, downsample)
+    remainder = downsample / level_ds
+    read_size = (max(1, int(math.ceil(size[0] * remainder))),
+                 max(1, int(math.ceil(size[1] * remainder))))
+
+    region = read_region(slide, location, level, read_size)
+    if read_size != tuple(size):
+        region = region.resize(size, Image.BILINEAR)
+    return region
+
+
+def read_thumbnail(slide, size):
+    """RGB image of the whole slide at `size`, read from the lowest suitable level."""
+    width, height = slide.dimensions
+    downsample = max(width / size[0], height / size[1])
+    level, level_ds = best_level(slide, downsample)
+    level_size = slide.level_dimensions[level]
+
+    # Non-pyramidal slides have no small level; let OpenSlide stream the thumbnail
+    if level_size[0] * level_size[1] > MAX_THUMBNAIL_READ_PIXELS:
+        return slide.get_thumbnail(size).convert('RGB').resize(size, Image.BILINEAR)
+
+    region = slide.read_region((0, 0), level, level_size)
+    # Transparent (out-of-slide) pixels become white, as in get_thumbnail
+    background = Image.new('RGB', level_size, (255, 255, 255))
+    background.paste(region, mask=region.split()[3])
+    if level_size != tuple(size):
+        background = background.resize(size, Image.BILINEAR)
+    return background
+
+
+def load_or_create_thumbnail(slide, slide_path, size, cache_dir):
+    """Thumbnail cached in `cache_dir`, keyed by slide identity and size."""
+    stat = os.stat(slide_path)
+    stem = os.path.splitext(os.path.basename(slide_path))[0]
+    cache_name = f"thumbnail_{stem}_{stat.st_size}_{int(stat.st_mtime)}_{size[0]}x{size[1]}.png"
+    cache_path = os.path.join(cache_dir, cache_name)
+
+    if os.path.exists(cache_path):
+        print(f"Using cached thumbnail: {cache_name}")
+        return Image.open(cache_path).convert('RGB')
+
+    thumbnail = read_thumbnail(slide, size)
+    thumbnail.save(cache_path)
+    return thumbnail
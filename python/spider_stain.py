@@ -0,0 +1,215 @@
+# spider_stain.py
+# Per-slide stain normalization (Macenko) applied to whole preprocessed batches
+# The H&E stain vectors of a slide are estimated once from a low-resolution
+# thumbnail and cached next to the outputs, keyed by slide identity. Mapping a
+# slide's stains onto the reference stains is a single 3x3 matrix in optical
+# density space, which FastPreprocessor applies to the resized batch tensor, so
+# the per-patch cost is one log, one small matmul and one exp per output pixel.
+
+import os
+import json
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from spider_slide_io import read_thumbnail
+from spider_tile_cache import slide_identity
+
+# Reference H&E stain vectors (columns: haematoxylin, eosin) and their 99th
+# percentile concentrations, from Macenko et al. 2009
+HE_REFERENCE = np.array([[0.5626, 0.2159],
+                         [0.7201, 0.8012],
+                         [0.4062, 0.5581]])
+MAX_CONCENTRATIONS_REFERENCE = np.array([1.9705, 1.0308])
+
+# Cache of estimated stain matrices written to the output folder
+CACHE_FILENAME = 'stain_matrices.json'
+
+# Longest side of the thumbnail the stains are estimated from
+SAMPLE_SIZE = 2048
+
+# Optical density below which a pixel counts as background
+OD_THRESHOLD = 0.15
+
+# Percentile of the stain angles taken as the extreme stain directions
+ANGLE_PERCENTILE = 1
+
+
+def optical_density(rgb):
+    return -np.log((rgb.astype(np.float64) + 1) / 256)
+
+
+def estimate_macenko(rgb, od_threshold=OD_THRESHOLD, angle_percentile=ANGLE_PERCENTILE):
+    """Stain matrix (3 x 2, haematoxylin then eosin) and max concentrations of an RGB sample."""
+    od = optical_density(rgb.reshape(-1, 3))
+    tissue = od[(od > od_threshold).all(axis=1)]
+    if len(tissue) < 100:
+        raise ValueError(f"Only {len(tissue)} tissue pixels in the stain sample")
+
+    # Plane of the two largest principal directions of the tissue optical densities
+    _, eigenvectors = np.linalg.eigh(np.cov(tissue.T))
+    plane = eigenvectors[:, 1:3]
+    projected = tissue @ plane
+    angles = np.arctan2(projected[:, 1], projected[:, 0])
+    low, high = np.percentile(angles, [angle_percentile, 100 - angle_percentile])
+    v_low = plane @ np.array([np.cos(low), np.sin(low)])
+    v_high = plane @ np.array([np.cos(high), np.sin(high)])
+
+    # Haematoxylin absorbs more red (first OD component); vectors point into positive OD
+    stains = np.stack([v_low, v_high], axis=1) if v_low[0] > v_high[0] else np.stack([v_high, v_low], axis=1)
+    stains *= np.sign(stains.sum(axis=0, keepdims=True))
+    stains /= np.linalg.norm(stains, axis=0, keepdims=True)
+
+    concentrations = np.linalg.lstsq(stains, tissue.T, rcond=None)[0]
+    max_concentrations = np.percentile(concentrations, 99, axis=1)
+    return stains, max_concentrations
+
+
+class StainNormalizer:
+    """Maps a slide's stains onto the reference stains in optical density space."""
+
+    def __init__(self, stain_matrix, max_concentrations, target_matrix=HE_REFERENCE,
+                 target_max_concentrations=MAX_CONCENTRATIONS_REFERENCE):
+        self.stain_matrix = np.asarray(stain_matrix, dtype=np.float64)
+        self.max_concentrations = np.asarray(max_concentrations, dtype=np.float64)
+        # OD_out = target @ diag(target_max / max) @ pinv(stains) @ OD_in
+        scale = np.diag(np.asarray(target_max_concentrations) / self.max_concentrations)
+        self.transform = (np.asarray(target_matrix) @ scale @ np.linalg.pinv(self.stain_matrix)).astype(np.float32)
+        self._transform_tensor = None
+        self.patches = 0
+        self.apply_seconds = 0.0
+
+    @classmethod
+    def from_image(cls, rgb):
+        return cls(*estimate_macenko(np.asarray(rgb)[..., :3]))
+
+    def apply_array(self, rgb):
+        """Normalize an RGB uint8 array of any shape (..., 3)."""
+        od = optical_density(rgb[..., :3]).astype(np.float32)
+        od = od @ self.transform.T
+        return np.clip(256 * np.exp(-od) - 1, 0, 255).astype(np.uint8)
+
+    def apply_image(self, image):
+        """Normalized RGB PIL image (AutoProcessor fallback path)."""
+        return Image.fromarray(self.apply_array(np.asarray(image)))
+
+    def apply_tensor(self, batch):
+        """Normalize a float (N, 3, H, W) batch of 0-255 values in place."""
+        start = time.time()
+        if self._transform_tensor is None or self._transform_tensor.device != batch.device:
+            self._transform_tensor = torch.from_numpy(self.transform).to(batch.device)
+        od = batch.add_(1).div_(256).log_().neg_()
+        od = torch.einsum('ij,njhw->nihw', self._transform_tensor, od)
+        batch.copy_(od.neg_().exp_().mul_(256).sub_(1).clamp_(0, 255))
+        self.patches += batch.shape[0]
+        self.apply_seconds += time.time() - start
+        return batch
+
+    def benchmark(self, shape=(1, 3, 224, 224), repeats=20):
+        """Seconds per patch of apply_tensor on a batch of this shape."""
+        batch = torch.full(shape, 128.0)
+        patches, seconds = self.patches, self.apply_seconds
+        for _ in range(repeats):
+            self.apply_tensor(batch.fill_(128.0))
+        per_patch = (self.apply_seconds - seconds) / (repeats * shape[0])
+        self.patches, self.apply_seconds = patches, seconds
+        return per_patch
+
+    def to_dict(self):
+        return {
+            'stain_matrix': self.stain_matrix.round(6).tolist(),
+            'max_concentrations': self.max_concentrations.round(6).tolist()
+        }
+
+
+def _slide_key(slide, slide_path):
+    identity = slide_identity(slide)
+    if identity is None:
+        stat = os.stat(slide_path)
+        identity = f"{os.path.basename(slide_path)}_{stat.st_size}_{int(stat.st_mtime)}"
+    return identity
+
+
+class StainNormalizers:
+    """One normalizer per slide, estimated on first use and cached in `cache_dir`."""
+
+    def __init__(self, cache_dir, open_slide):
+        self.cache_path = os.path.join(cache_dir, CACHE_FILENAME)
+        self.open_slide = open_slide
+        self._normalizers = {}
+        self.estimated = 0
+        self.cached = 0
+        self.estimate_seconds = 0.0
+        self._cache = {}
+        if os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path, 'r') as f:
+                    self._cache = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable stain cache {self.cache_path}: {str(e)}")
+
+    def get(self, slide_path, slide=None):
+        """Normalizer of a slide, or None if its stains cannot be estimated."""
+        if slide_path in self._normalizers:
+            return self._normalizers[slide_path]
+
+        normalizer = None
+        opened = slide is None
+        try:
+            if opened:
+                slide = self.open_slide(slide_path)
+            key = _slide_key(slide, slide_path)
+            if key in self._cache:
+                entry = self._cache[key]
+                normalizer = StainNormalizer(entry['stain_matrix'], entry['max_concentrations'])
+                self.cached += 1
+            else:
+                start = time.time()
+                width, height = slide.dimensions
+                scale = SAMPLE_SIZE / max(width, height)
+                size = (max(1, int(width * scale)), max(1, int(height * scale)))
+                normalizer = StainNormalizer.from_image(read_thumbnail(slide, size))
+                elapsed = time.time() - start
+                self.estimate_seconds += elapsed
+                self.estimated += 1
+                print(f"Estimated stain matrix for {os.path.basename(slide_path)} in {elapsed:.2f}s")
+                self._cache[key] = {**normalizer.to_dict(), 'slide': os.path.basename(slide_path),
+                                    'seconds': round(elapsed, 3)}
+                with open(self.cache_path, 'w') as f:
+                    json.dump(self._cache, f, indent=2)
+        except Exception as e:
+            print(f"Stain normalization unavailable for {slide_path}: {str(e)}")
+        finally:
+            if opened and slide is not None:
+                slide.close()
+
+        self._normalizers[slide_path] = normalizer
+        return normalizer
+
+    def stats(self):
+        active = [n for n in self._normalizers.values() if n is not None]
+        patches = sum(n.patches for n in active)
+        apply_seconds = sum(n.apply_seconds for n in active)
+        return {
+            'slides': len(active),
+            'estimated': self.estimated,
+            'from_cache': self.cached,
+            'estimate_seconds': round(self.estimate_seconds, 3),
+            'patches': patches,
+            'apply_seconds': round(apply_seconds, 3),
+            'apply_ms_per_patch': round(1000 * apply_seconds / patches, 3) if patches else None
+        }
+
+
+def describe_stats(stats):
+    per_patch = f", {stats['apply_ms_per_patch']:.2f} ms/patch" if stats['apply_ms_per_patch'] is not None else ""
+    return (f"Stain normalization: {stats['slides']} slide(s), {stats['estimate_seconds']:.2f}s estimating "
+            f"({stats['from_cache']} from cache), {stats['patches']} patches{per_patch}")
+
+
+def add_stain_arguments(parser):
+    parser.add_argument('--stain-normalize', action='store_true',
+                        help=f"Normalize H&E stains per slide (Macenko); stain matrices are cached in "
+                             f"{CACHE_FILENAME} in the output folder")
@@ -0,0 +1,219 @@
+# spider_tile_cache.py
+# Process-wide cache of decoded slide tiles shared by every script
+# Regions are assembled from fixed-size tiles aligned to a grid at each pyramid
+# level, so overlapping patches, context windows and repeated analyses of the same
+# slide decode each tile once. Tiles are kept under a RAM budget with LRU eviction,
+# and optionally in a compressed on-disk tier that outlives the process.
+#
+# Budget and disk tier are set with SPIDER_TILE_CACHE_MB (0 disables the cache)
+# and SPIDER_TILE_CACHE_DIR.
+
+import os
+import math
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+# Tile edge in pixels at the level being read
+TILE_SIZE = 512
+
+# Default RAM budget for decoded tiles, overridable with SPIDER_TILE_CACHE_MB
+DEFAULT_BUDGET_MB = 512
+
+# Stable slide identity computed by OpenSlide from the slide's own data
+QUICKHASH_PROPERTY = 'openslide.quickhash-1'
+
+STAT_KEYS = ('hits', 'disk_hits', 'misses', 'evictions')
+
+
+def slide_identity(slide):
+    """Key of a slide across handles and processes, or None if it has none."""
+    identity = slide.properties.get(QUICKHASH_PROPERTY)
+    if identity is None:
+        identity = getattr(slide, '_filename', None)
+    return identity
+
+
+def tile_origin(level_pixel, downsample):
+    """Smallest level-0 coordinate that a read maps (int(x / downsample)) to `level_pixel`.
+
+    Truncating or rounding level_pixel * downsample lands one pixel early when the
+    downsample is not an integer (e.g. 4.0003), so cached tiles would be shifted
+    against direct reads.
+    """
+    origin = math.ceil(level_pixel * downsample)
+    # Guard against the product overshooting by a floating-point ulp
+    while origin > 0 and int((origin - 1) / downsample) == level_pixel:
+        origin -= 1
+    return origin
+
+
+class TileCache:
+    """LRU cache of decoded RGBA tiles keyed by slide, level and tile coordinates."""
+
+    def __init__(self, budget_bytes=None, disk_dir=None, tile_size=TILE_SIZE):
+        if budget_bytes is None:
+            budget_bytes = int(os.environ.get('SPIDER_TILE_CACHE_MB', DEFAULT_BUDGET_MB)) * 1024 * 1024
+        if disk_dir is None:
+            disk_dir = os.environ.get('SPIDER_TILE_CACHE_DIR') or None
+        self.budget_bytes = budget_bytes
+        self.disk_dir = disk_dir
+        self.tile_size = tile_size
+        self.tile_bytes = tile_size * tile_size * 4
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.budget_bytes >= self.tile_bytes
+
+    @property
+    def resident_bytes(self):
+        return len(self._tiles) * self.tile_bytes
+
+    def _disk_path(self, key):
+        identity, level, tx, ty = key
+        slide_dir = hashlib.sha1(identity.encode()).hexdigest()[:16]
+        return os.path.join(self.disk_dir, slide_dir, f"{level}_{tx}_{ty}.tile")
+
+    def _load_from_disk(self, key):
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                data = zlib.decompress(f.read())
+            return np.frombuffer(data, dtype=np.uint8).reshape(self.tile_size, self.tile_size, 4)
+        except (OSError, ValueError, zlib.error) as e:
+            print(f"Ignoring unreadable cached tile {path}: {str(e)}")
+            return None
+
+    def _save_to_disk(self, key, tile):
+        # Written once per tile and renamed into place, so concurrent workers never see partial files
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(zlib.compress(tile.tobytes(), 1))
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Could not write cached tile {path}: {str(e)}")
+
+    def _tile(self, slide, key, downsample, persistent):
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+
+        # Decode outside the lock; slide readers are safe to read from several threads
+        tile = None
+        if persistent:
+            tile = self._load_from_disk(key)
+        if tile is not None:
+            with self._lock:
+                self.disk_hits += 1
+        else:
+            _, level, tx, ty = key
+            origin = (tile_origin(tx * self.tile_size, downsample), tile_origin(ty * self.tile_size, downsample))
+            if hasattr(slide, 'read_array'):
+                # Reader backends return arrays directly (chunked TIFF decodes the covering chunks in parallel)
+                tile = slide.read_array(origin, level, (self.tile_size, self.tile_size))
+            else:
+                tile = np.asarray(slide.read_region(origin, level, (self.tile_size, self.tile_size)))
+            with self._lock:
+                self.misses += 1
+            if persistent:
+                self._save_to_disk(key, tile)
+
+        with self._lock:
+            self._tiles[key] = tile
+            self._tiles.move_to_end(key)
+            while self.resident_bytes > self.budget_bytes:
+                self._tiles.popitem(last=False)
+                self.evictions += 1
+        return tile
+
+    def read_region(self, slide, location, level, size):
+        """Drop-in for slide.read_region(location, level, size), assembled from cached tiles."""
+        width, height = size
+        downsample = slide.level_downsamples[level]
+        # Top-left of the request in level pixels, as OpenSlide computes it
+        left = int(location[0] / downsample)
+        top = int(location[1] / downsample)
+        t = self.tile_size
+        tx0, ty0 = left // t, top // t
+        tx1, ty1 = (left + width - 1) // t, (top + height - 1) // t
+
+        # Requests that would flush most of the cache, and handles without a stable
+        # identity (an id() could be reused by a later handle), are read directly
+        identity = slide_identity(slide)
+        n_tiles = (tx1 - tx0 + 1) * (ty1 - ty0 + 1)
+        if identity is None or n_tiles * self.tile_bytes > self.budget_bytes // 2:
+            return slide.read_region(location, level, size)
+        persistent = self.disk_dir is not None
+
+        region = np.empty((height, width, 4), dtype=np.uint8)
+        for ty in range(ty0, ty1 + 1):
+            for tx in range(tx0, tx1 + 1):
+                tile = self._tile(slide, (identity, level, tx, ty), downsample, persistent)
+                # Overlap of this tile with the request, in level pixels
+                x0, y0 = max(left, tx * t), max(top, ty * t)
+                x1, y1 = min(left + width, (tx + 1) * t), min(top + height, (ty + 1) * t)
+                region[y0 - top:y1 - top, x0 - left:x1 - left] = tile[y0 - ty * t:y1 - ty * t, x0 - tx * t:x1 - tx * t]
+        return Image.fromarray(region, 'RGBA')
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round((self.hits + self.disk_hits) / lookups, 3) if lookups else None,
+            'resident_mb': round(self.resident_bytes / 1e6, 1),
+            'budget_mb': round(self.budget_bytes / 1e6, 1),
+            'disk_dir': self.disk_dir
+        }
+
+
+def merge_stats(stats_list):
+    """Combined statistics of several processes' caches."""
+    merged = {key: sum(s[key] for s in stats_list) for key in STAT_KEYS}
+    lookups = merged['hits'] + merged['disk_hits'] + merged['misses']
+    merged['hit_ratio'] = round((merged['hits'] + merged['disk_hits']) / lookups, 3) if lookups else None
+    return merged
+
+
+def describe_stats(stats):
+    if stats['hit_ratio'] is None:
+        return "Tile cache: no lookups"
+    return (f"Tile cache: {stats['hit_ratio']:.1%} hit ratio ({stats['hits']} memory hits, "
+            f"{stats['disk_hits']} disk hits, {stats['misses']} decoded, {stats['evictions']} evicted)")
+
+
+_cache = None
+
+
+def get_tile_cache():
+    """Process-wide tile cache used by spider_slide_io.read_region_at."""
+    global _cache
+    if _cache is None:
+        _cache = TileCache()
+    return _cache
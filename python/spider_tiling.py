@@ -0,0 +1,217 @@
+# spider_tiling.py
+# Polygon-aware tile generation for SPIDER tile classification
+# Rasterizes an annotation polygon once at grid resolution and selects tiles by
+# minimum coverage fraction and tissue content using array operations.
+
+import math
+import numpy as np
+from PIL import Image
+
+# Fields copied from a generated tile into its prediction record
+TILE_FIELDS = ('parent_annotation_id', 'gridX', 'gridY', 'roi', 'coverage', 'tissue', 'weight')
+
+# Defaults used when a tiling request does not specify them
+DEFAULT_MIN_COVERAGE = 0.25
+DEFAULT_MIN_TISSUE = 0.1
+DEFAULT_SUPERSAMPLE = 4
+
+
+def rasterize_rings(rings, origin, cell_size, shape, supersample=DEFAULT_SUPERSAMPLE):
+    """Return the fraction of each grid cell covered by the polygon rings.
+
+    Rings are lists of (x, y) vertices in level-0 pixels; the even-odd rule is
+    used so interior rings (holes) are subtracted. Each cell is sampled on a
+    supersample x supersample lattice with one scanline pass per sample row.
+    """
+    rows, cols = shape
+    ss = supersample
+    step = cell_size / ss
+    n_rows, n_cols = rows * ss, cols * ss
+
+    # Collect all edges of all rings
+    x0, y0, x1, y1 = [], [], [], []
+    for ring in rings:
+        pts = np.asarray(ring, dtype=np.float64)
+        if len(pts) < 3:
+            continue
+        nxt = np.roll(pts, -1, axis=0)
+        x0.append(pts[:, 0])
+        y0.append(pts[:, 1])
+        x1.append(nxt[:, 0])
+        y1.append(nxt[:, 1])
+    if not x0:
+        return np.zeros(shape, dtype=np.float32)
+    x0, y0, x1, y1 = (np.concatenate(a)[None, :] for a in (x0, y0, x1, y1))
+
+    # Intersections of every sample row with every edge
+    ys = (origin[1] + (np.arange(n_rows) + 0.5) * step)[:, None]
+    crosses = (y0 <= ys) != (y1 <= ys)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xs = x0 + (ys - y0) / (y1 - y0) * (x1 - x0)
+    xs = np.where(crosses, xs, np.inf)
+    if xs.shape[1] % 2:
+        xs = np.concatenate([xs, np.full((n_rows, 1), np.inf)], axis=1)
+    xs.sort(axis=1)
+
+    # Spans between consecutive intersection pairs, in sample-column units
+    starts = xs[:, 0::2]
+    ends = xs[:, 1::2]
+    valid = np.isfinite(starts) & np.isfinite(ends)
+    row_idx = np.broadcast_to(np.arange(n_rows)[:, None], starts.shape)[valid]
+    col_start = np.clip(np.ceil((starts[valid] - origin[0]) / step - 0.5), 0, n_cols).astype(np.int64)
+    col_end = np.clip(np.ceil((ends[valid] - origin[0]) / step - 0.5), 0, n_cols).astype(np.int64)
+
+    # Fill spans with a difference array and a cumulative sum
+    diff = np.zeros((n_rows, n_cols + 1), dtype=np.int32)
+    np.add.at(diff, (row_idx, col_start), 1)
+    np.add.at(diff, (row_idx, col_end), -1)
+    inside = np.cumsum(diff, axis=1)[:, :n_cols] > 0
+
+    return inside.reshape(rows, ss, cols, ss).mean(axis=(1, 3)).astype(np.float32)
+
+
+def tissue_fraction(slide, origin, cell_size, shape, samples=8):
+    """Return the tissue fraction of each grid cell from a low-resolution read."""
+    rows, cols = shape
+    level = slide.get_best_level_for_downsample(cell_size / samples)
+    level_ds = slide.level_downsamples[level]
+    width = max(1, int(math.ceil(cols * cell_size / level_ds)))
+    height = max(1, int(math.ceil(rows * cell_size / level_ds)))
+
+    region = np.asarray(slide.read_region((int(origin[0]), int(origin[1])), level, (width, height)))
+    rgb = region[..., :3].astype(np.int16)
+
+    # Tissue is coloured (some saturation), not near-white, and inside the slide (alpha > 0)
+    spread = rgb.max(axis=2) - rgb.min(axis=2)
+    mask = (spread > 20) & (rgb.mean(axis=2) < 235) & (region[..., 3] > 0)
+
+    mask_img = Image.fromarray(mask.astype(np.uint8) * 255)
+    mask_img = mask_img.resize((cols * samples, rows * samples), Image.BILINEAR)
+    fine = np.asarray(mask_img, dtype=np.float32) / 255.0
+    return fine.reshape(rows, samples, cols, samples).mean(axis=(1, 3))
+
+
+def _window_mean(grid, k):
+    """Mean of every k x k window of a grid (integral image)."""
+    integral = np.pad(grid, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+    sums = integral[k:, k:] - integral[:-k, k:] - integral[k:, :-k] + integral[:-k, :-k]
+    return sums / float(k * k)
+
+
+def grid_tissue_fraction(slide, cell_size, patch_cells, shape):
+    """Tissue fraction of each patch of a slide-wide grid whose patches span patch_cells x patch_cells cells."""
+    rows, cols = shape
+    k = max(1, patch_cells)
+    return _window_mean(tissue_fraction(slide, (0, 0), cell_size, (rows + k - 1, cols + k - 1)), k)
+
+
+def generate_tiles(rings, patch_size, stride, min_coverage=DEFAULT_MIN_COVERAGE,
+                   slide=None, min_tissue=DEFAULT_MIN_TISSUE, supersample=DEFAULT_SUPERSAMPLE):
+    """Select tiles for an annotation polygon.
+
+    Returns a list of dicts with grid position, level-0 origin, polygon coverage,
+    tissue fraction and aggregation weight (the coverage fraction).
+    """
+    points = np.concatenate([np.asarray(r, dtype=np.float64) for r in rings if len(r) >= 3])
+    min_x, min_y = np.floor(points.min(axis=0))
+    max_x, max_y = np.ceil(points.max(axis=0))
+
+    # Tile grid covering the bounding box
+    n_cols = max(1, int(math.ceil((max_x - min_x - patch_size) / stride)) + 1)
+    n_rows = max(1, int(math.ceil((max_y - min_y - patch_size) / stride)) + 1)
+
+    # Rasterize once on a stride-sized cell grid; each tile spans k x k cells
+    k = max(1, int(round(patch_size / stride)))
+    cell_shape = (n_rows + k - 1, n_cols + k - 1)
+    origin = (min_x, min_y)
+
+    coverage_cells = rasterize_rings(rings, origin, stride, cell_shape, supersample)
+    coverage = _window_mean(coverage_cells, k)
+
+    if slide is not None and min_tissue > 0:
+        tissue = _window_mean(tissue_fraction(slide, origin, stride, cell_shape), k)
+    else:
+        tissue = np.ones_like(coverage)
+
+    keep = (coverage >= min_coverage) & (tissue >= min_tissue)
+    grid_y, grid_x = np.nonzero(keep)
+
+    tiles = []
+    for gy, gx in zip(grid_y.tolist(), grid_x.tolist()):
+        tiles.append({
+            'gridX': gx,
+            'gridY': gy,
+            'x': int(min_x + gx * stride),
+            'y': int(min_y + gy * stride),
+            'coverage': round(float(coverage[gy, gx]), 3),
+            'tissue': round(float(tissue[gy, gx]), 3),
+            'weight': round(float(coverage[gy, gx]), 3)
+        })
+
+    print(f"Tiling: {n_cols}x{n_rows} candidate tiles, kept {len(tiles)} "
+          f"(coverage >= {min_coverage}, tissue >= {min_tissue})")
+    return tiles
+
+
+def iter_tiling_requests(records, open_slide=None, on_tiles=None):
+    """Yield records, replacing those carrying a 'tiling' block with their tiles.
+
+    Records without a 'tiling' block are passed through unchanged. Records are
+    consumed lazily; on_tiles(tiles) is called with the tile records of each
+    request before the first of them is yielded.
+    """
+    slides = {}
+    try:
+        for record in records:
+            tiling = record.get('tiling')
+            if not tiling:
+                yield record
+                continue
+
+            slide = None
+            min_tissue = float(tiling.get('min_tissue', DEFAULT_MIN_TISSUE))
+            if open_slide is not None and min_tissue > 0:
+                slide_path = record['slide_path']
+                if slide_path not in slides:
+                    try:
+                        slides[slide_path] = open_slide(slide_path)
+                    except Exception as e:
+                        print(f"Could not open slide for tissue detection: {str(e)}")
+                        slides[slide_path] = None
+                slide = slides[slide_path]
+
+            patch_size = int(tiling.get('patch_size', 1120))
+            annotation_id = str(record['id'])
+            tiles = generate_tiles(
+                record['rings'],
+                patch_size,
+                int(tiling.get('stride', patch_size)),
+                min_coverage=float(tiling.get('min_coverage', DEFAULT_MIN_COVERAGE)),
+                slide=slide,
+                min_tissue=min_tissue
+            )
+
+            tile_records = [{
+                'id': f"tile_{annotation_id}_{tile['gridX']}_{tile['gridY']}",
+                'slide_path': record['slide_path'],
+                'image_name': record.get('image_name', 'unknown'),
+                'parent_annotation_id': annotation_id,
+                'gridX': tile['gridX'],
+                'gridY': tile['gridY'],
+                'roi': {'x': tile['x'], 'y': tile['y'], 'width': patch_size, 'height': patch_size},
+                'coverage': tile['coverage'],
+                'tissue': tile['tissue'],
+                'weight': tile['weight']
+            } for tile in tiles]
+            if on_tiles is not None:
+                on_tiles(tile_records)
+            yield from tile_records
+    finally:
+        for slide in slides.values():
+            if slide is not None:
+                slide.close()
+
+
+def tile_fields(record):
+    """Tile metadata to carry over from an input record into its prediction."""
+    return {k: record[k] for k in TILE_FIELDS if k in record}
@@ -0,0 +1,91 @@
+# spider_tta.py
+# Confidence-aware test-time augmentation (TTA) for SPIDER classifiers
+# Only regions whose first-pass confidence or top-1/top-2 margin is below a threshold
+# are augmented. Their flipped/rotated views go through the model in one batched call
+# and the probabilities of all views are averaged.
+
+import torch
+
+# Dihedral views of a (N, 3, H, W) batch; 'identity' is the first pass
+VIEWS = {
+    'identity': lambda x: x,
+    'hflip': lambda x: torch.flip(x, dims=[3]),
+    'vflip': lambda x: torch.flip(x, dims=[2]),
+    'rot90': lambda x: torch.rot90(x, 1, dims=[2, 3]),
+    'rot180': lambda x: torch.rot90(x, 2, dims=[2, 3]),
+    'rot270': lambda x: torch.rot90(x, 3, dims=[2, 3]),
+    'transpose': lambda x: x.transpose(2, 3),
+    'antitranspose': lambda x: torch.rot90(x, 2, dims=[2, 3]).transpose(2, 3)
+}
+
+DEFAULT_VIEWS = 8
+DEFAULT_CONFIDENCE_THRESHOLD = 0.7
+DEFAULT_MARGIN_THRESHOLD = 0.2
+
+
+def add_tta_arguments(parser):
+    """Command-line options shared by the classifiers."""
+    parser.add_argument('--tta', action='store_true',
+                        help="Augment low-confidence regions with flips/rotations")
+    parser.add_argument('--tta-views', type=int, default=DEFAULT_VIEWS,
+                        help=f"Views per augmented region, including the original (2-8, default: {DEFAULT_VIEWS})")
+    parser.add_argument('--tta-confidence', type=float, default=DEFAULT_CONFIDENCE_THRESHOLD,
+                        help=f"Augment when the top probability is below this (default: {DEFAULT_CONFIDENCE_THRESHOLD})")
+    parser.add_argument('--tta-margin', type=float, default=DEFAULT_MARGIN_THRESHOLD,
+                        help=f"Augment when top-1 minus top-2 is below this (default: {DEFAULT_MARGIN_THRESHOLD})")
+
+
+class TestTimeAugmenter:
+    """Re-predicts uncertain regions from several dihedral views in one batch."""
+
+    def __init__(self, n_views=DEFAULT_VIEWS, confidence_threshold=DEFAULT_CONFIDENCE_THRESHOLD,
+                 margin_threshold=DEFAULT_MARGIN_THRESHOLD):
+        self.views = list(VIEWS)[:max(2, min(n_views, len(VIEWS)))]
+        self.confidence_threshold = confidence_threshold
+        self.margin_threshold = margin_threshold
+        self.augmented = 0
+        self.total = 0
+
+    @classmethod
+    def from_args(cls, args):
+        """Augmenter configured from add_tta_arguments options, or None when TTA is off."""
+        if not args.tta:
+            return None
+        return cls(args.tta_views, args.tta_confidence, args.tta_margin)
+
+    def needs_augmentation(self, probabilities):
+        top2 = torch.topk(probabilities, min(2, probabilities.shape[-1])).values
+        margin = top2[0] - top2[1] if len(top2) > 1 else top2[0]
+        return bool(top2[0] < self.confidence_threshold or margin < self.margin_threshold)
+
+    def __call__(self, model, pixel_values, probabilities):
+        """Refine one region's first-pass probabilities.
+
+        `pixel_values` is the (1, 3, H, W) model input of the first pass and
+        `probabilities` its softmax output (1-D tensor). Returns the final
+        probabilities and a dict with the number of extra views evaluated and
+        the fraction of all views agreeing with the final prediction.
+        """
+        self.total += 1
+        if not self.needs_augmentation(probabilities):
+            return probabilities, {'augmentations': 0, 'agreement': None}
+
+        # All extra views in one forward pass
+        batch = torch.cat([VIEWS[name](pixel_values) for name in self.views[1:]], dim=0)
+        with torch.no_grad():
+            logits = model(pixel_values=batch).logits
+        view_probs = torch.cat([probabilities[None].to(logits.device), torch.softmax(logits, dim=1)], dim=0)
+
+        final = view_probs.mean(dim=0)
+        agreement = (view_probs.argmax(dim=1) == final.argmax()).float().mean().item()
+        self.augmented += 1
+        return final, {'augmentations': len(self.views) - 1, 'agreement': round(agreement, 3)}
+
+    def stats(self):
+        return {
+            'augmented_regions': self.augmented,
+            'total_regions': self.total,
+            'views': len(self.views),
+            'confidence_threshold': self.confidence_threshold,
+            'margin_threshold': self.margin_threshold
+        }
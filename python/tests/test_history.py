@@ -0,0 +1,57 @@
+# JSONL histories are imported once, extended when they grow and replaced when rewritten
+
+import os
+import json
+import sqlite3
+
+from spider_history import PredictionHistory, HISTORY_FILENAME
+
+
+def write_jsonl(path, records, mtime):
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    os.utime(path, (mtime, mtime))
+
+
+def records(prefix, n):
+    return [{'id': f"{prefix}{i}", 'image_name': 'slide', 'prediction': 'Tumor',
+             'timestamp': f"2026-01-01T00:00:{i:02d}"} for i in range(n)]
+
+
+def test_rewritten_file_replaces_its_earlier_import(tmp_path):
+    path = tmp_path / 'prediction_history_colorectal.jsonl'
+    write_jsonl(path, records('a', 5), 1_000_000)
+    with PredictionHistory.open(str(tmp_path)) as history:
+        assert history.stats()['records'] == 5
+        history.add({'id': 'live', 'image_name': 'slide', 'prediction': 'Stroma'})
+
+    # Same size, new content and modification time
+    write_jsonl(path, records('b', 5), 2_000_000)
+    with PredictionHistory.open(str(tmp_path)) as history:
+        ids = sorted(r['id'] for r in history.query())
+    assert ids == sorted([f"b{i}" for i in range(5)] + ['live'])
+
+
+def test_grown_file_imports_only_new_records(tmp_path):
+    path = tmp_path / 'prediction_history.jsonl'
+    write_jsonl(path, records('a', 3), 1_000_000)
+    PredictionHistory.open(str(tmp_path)).close()
+    write_jsonl(path, records('a', 7), 2_000_000)
+    with PredictionHistory.open(str(tmp_path)) as history:
+        assert sorted(r['id'] for r in history.query()) == sorted(f"a{i}" for i in range(7))
+        # Unchanged since: nothing is imported again
+        assert history.import_jsonl(str(path)) == 0
+
+
+def test_database_without_source_column_is_migrated(tmp_path):
+    connection = sqlite3.connect(str(tmp_path / HISTORY_FILENAME))
+    connection.execute("CREATE TABLE predictions (seq INTEGER PRIMARY KEY AUTOINCREMENT, annotation_id TEXT, "
+                       "image_name TEXT, model_type TEXT, timestamp TEXT, prediction TEXT, confidence REAL, "
+                       "record TEXT NOT NULL)")
+    connection.execute("INSERT INTO predictions (annotation_id, record) VALUES ('old', '{\"id\": \"old\"}')")
+    connection.commit()
+    connection.close()
+    with PredictionHistory.open(str(tmp_path)) as history:
+        history.add({'id': 'new'})
+        assert sorted(r['id'] for r in history.query()) == ['new', 'old']
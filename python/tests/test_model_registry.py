@@ -0,0 +1,56 @@
+# Registry eviction must respect the budget without dropping models that are still in use
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+import spider_model_registry
+from spider_model_registry import ModelRegistry, RegisteredModel, estimate_nbytes
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    # Every "model" is a 1 MB float32 parameter; the directory name is its identity
+    monkeypatch.setattr(spider_model_registry, 'config_hash', lambda path: path)
+    monkeypatch.setattr(spider_model_registry, 'estimate_nbytes', lambda path: MB)
+    registry = ModelRegistry(budget_bytes=2 * MB + 1, device=torch.device('cpu'))
+
+    def load(key, model_path):
+        model = torch.nn.Linear(MB // 4, 1, bias=False)
+        return RegisteredModel(key, model_path, model, None, [], 'unknown')
+
+    monkeypatch.setattr(registry, '_load', load)
+    return registry
+
+
+def test_least_recently_used_model_is_evicted(registry):
+    registry.get('a')
+    registry.get('b')
+    registry.get('a')
+    registry.get('c')
+    assert list(registry._models) == ['a', 'c']
+    assert registry.evictions == 1
+
+
+def test_pinned_models_are_not_evicted(registry):
+    a = registry.acquire('a')
+    registry.get('b')
+    registry.get('c')
+    assert list(registry._models) == ['a', 'c']
+
+    registry.evict('a')
+    assert 'a' in registry._models
+
+    registry.release(a)
+    registry.get('d')
+    assert list(registry._models) == ['c', 'd']
+
+
+def test_sharded_weights_are_summed(tmp_path):
+    for name, size in (('model-00001-of-00002.safetensors', 300), ('model-00002-of-00002.safetensors', 200),
+                       ('pytorch_model.bin', 1000)):
+        (tmp_path / name).write_bytes(b'\0' * size)
+    assert estimate_nbytes(str(tmp_path)) == 500
@@ -0,0 +1,106 @@
+# FastPreprocessor must produce the same tensors as the model's AutoImageProcessor
+
+import json
+
+import numpy as np
+import pytest
+
+from spider_preprocessing import FastPreprocessor, as_rgb_image
+
+try:
+    import torch
+    import transformers
+except ImportError:
+    torch = transformers = None
+
+requires_torch = pytest.mark.skipif(torch is None or transformers is None, reason="needs torch and transformers")
+
+NORMALIZATION = {
+    'do_rescale': True,
+    'rescale_factor': 1 / 255,
+    'do_normalize': True,
+    'image_mean': [0.485, 0.456, 0.406],
+    'image_std': [0.229, 0.224, 0.225]
+}
+
+# Synthetic models covering the resize modes FastPreprocessor implements
+CONFIGS = {
+    'fixed_size': {'image_processor_type': 'ViTImageProcessor', 'do_resize': True,
+                   'size': {'height': 224, 'width': 224}, 'resample': 3, **NORMALIZATION},
+    'shortest_edge_center_crop': {'image_processor_type': 'CLIPImageProcessor', 'do_resize': True,
+                                  'size': {'shortest_edge': 224}, 'resample': 3, 'do_center_crop': True,
+                                  'crop_size': {'height': 224, 'width': 224}, 'do_convert_rgb': True,
+                                  **NORMALIZATION},
+    'no_resize': {'image_processor_type': 'ViTImageProcessor', 'do_resize': False, **NORMALIZATION}
+}
+
+
+@requires_torch
+@pytest.mark.parametrize('name', sorted(CONFIGS))
+def test_matches_auto_image_processor(tmp_path, name):
+    (tmp_path / 'preprocessor_config.json').write_text(json.dumps(CONFIGS[name]))
+    # The PIL-based processor: FastPreprocessor resamples through PIL to match it
+    processor = transformers.AutoImageProcessor.from_pretrained(str(tmp_path), use_fast=False)
+    fast = FastPreprocessor.from_pretrained(str(tmp_path))
+
+    rng = np.random.default_rng(0)
+    patches = [rng.integers(0, 256, (300, 260, 4), dtype=np.uint8) for _ in range(3)]
+    expected = processor(images=[as_rgb_image(patch) for patch in patches], return_tensors='pt')['pixel_values']
+    actual = fast(patches).cpu()
+
+    assert tuple(actual.shape) == tuple(expected.shape)
+    assert tuple(actual.shape[1:]) == fast.output_shape(300, 260)
+    assert torch.allclose(actual, expected.to(actual.dtype), atol=1e-4)
+
+
+@requires_torch
+def test_buffers_grow_with_the_batch(tmp_path):
+    (tmp_path / 'preprocessor_config.json').write_text(json.dumps(CONFIGS['fixed_size']))
+    fast = FastPreprocessor.from_pretrained(str(tmp_path))
+    rng = np.random.default_rng(1)
+    patches = [rng.integers(0, 256, (224, 224, 3), dtype=np.uint8) for _ in range(5)]
+
+    single = fast(patches[:1]).clone()
+    assert fast.batch_size == 1
+    batch = fast(patches)
+    assert fast.batch_size == 5
+    assert torch.equal(batch[0], single[0])
+
+
+def expected_rgb(patch, config):
+    """A region resized and center-cropped with PIL, as the image processors do."""
+    image = as_rgb_image(patch)
+    width, height = image.size
+    short = config['size']['shortest_edge']
+    if height <= width:
+        size = (int(short * width / height), short)
+    else:
+        size = (short, int(short * height / width))
+    image = image.resize(size, resample=config['resample'])
+    crop = config['crop_size']
+    left, top = (size[0] - crop['width']) // 2, (size[1] - crop['height']) // 2
+    return np.asarray(image)[top:top + crop['height'], left:left + crop['width']]
+
+
+def test_mixed_shapes_are_rejected():
+    # Shortest-edge resizing without a crop keeps each region's aspect ratio
+    config = dict(CONFIGS['shortest_edge_center_crop'], do_center_crop=False)
+    fast = FastPreprocessor(config)
+    rng = np.random.default_rng(2)
+    patches = [rng.integers(0, 256, (300, 260, 3), dtype=np.uint8),
+               rng.integers(0, 256, (260, 300, 3), dtype=np.uint8)]
+    with pytest.raises(ValueError, match='different sizes'):
+        fast.stage(patches)
+
+
+def test_staged_regions_survive_buffer_growth():
+    config = CONFIGS['shortest_edge_center_crop']
+    fast = FastPreprocessor(config)
+    rng = np.random.default_rng(3)
+    # Different input sizes that crop to the same output, in batches that grow the buffer
+    patches = [rng.integers(0, 256, (300 + 10 * i, 260, 4), dtype=np.uint8) for i in range(6)]
+    for batch in (patches[:1], patches[1:3], patches):
+        n = fast.stage(batch)
+        assert n == len(batch) and fast.batch_size >= n
+        for i, patch in enumerate(batch):
+            assert np.array_equal(fast._staging[i], expected_rgb(patch, config))
@@ -0,0 +1,56 @@
+# Heatmap pyramids: lower levels average the area they cover, flushes write only changed tiles
+
+import os
+
+import numpy as np
+from PIL import Image
+
+from spider_pyramid import HeatmapPyramid
+
+CLASSES = ['Tumor', 'Stroma']
+COLORS = {'Tumor': '#FF0000', 'Stroma': '#0000FF'}
+
+
+def make_pyramid(tmp_path, grid_shape=(4, 4)):
+    # One pixel per cell at the highest level, so level max_level - 1 averages 2 x 2 cells
+    return HeatmapPyramid(str(tmp_path), grid_shape, CLASSES, COLORS, origin_offset=0, cell_extent=560,
+                          tile_size=256, cell_pixels=1)
+
+
+def read_tile(pyramid, layer, level):
+    path = os.path.join(pyramid.output_dir, f"{layer}_files", str(level), "0_0.png")
+    return np.asarray(Image.open(path))
+
+
+def test_lower_levels_average_the_cells_they_cover(tmp_path):
+    pyramid = make_pyramid(tmp_path)
+    pyramid.add(0, 0, [1.0, 0.0])
+    pyramid.add(1, 0, [0.0, 1.0])
+    pyramid.add(0, 1, [0.5, 0.5])
+    pyramid.flush()
+
+    level = pyramid.max_level - 1
+    tumor = read_tile(pyramid, 'class_00', level)
+    # (1.0 + 0.0 + 0.5 + unclassified) / 4 of the top-left 2 x 2 block
+    assert tumor[0, 0, 3] == int(0.375 * 255)
+    assert tumor[1, 1, 3] == 0
+
+    classification = read_tile(pyramid, 'classification', level)
+    # Three of four cells classified: two red, one blue
+    assert classification[0, 0, 3] == int(0.75 * 255)
+    assert tuple(classification[0, 0, :3]) == (170, 0, 85)
+
+
+def test_flush_writes_only_changed_tiles(tmp_path):
+    pyramid = make_pyramid(tmp_path)
+    pyramid.add(0, 0, [1.0, 0.0])
+    first = pyramid.flush()
+    assert first == len(pyramid.layers) * (pyramid.max_level + 1)
+
+    # The same probabilities again change no pixel
+    pyramid.add(0, 0, [1.0, 0.0])
+    assert pyramid.flush() == 0
+
+    # A cell with no Stroma leaves every Stroma tile as it was
+    pyramid.add(1, 1, [1.0, 0.0])
+    assert pyramid.flush() == 2 * (pyramid.max_level + 1)
@@ -0,0 +1,87 @@
+# Shards must cover every patch and slide exactly once, and merging must reject incomplete or mixed shard sets
+
+import json
+
+import pytest
+
+from spider_shards import SHARD_MANIFEST, shard_items, shard_slides, write_manifest, load_shards
+
+
+@pytest.mark.parametrize('n_items,shard_count,chunk_size', [(0, 3, 32), (10, 4, 32), (1000, 3, 32), (1001, 7, 5),
+                                                            (64, 1, 32), (97, 97, 1)])
+def test_shards_partition_the_items(n_items, shard_count, chunk_size):
+    items = [(x, x % 13) for x in range(n_items)]
+    shards = [shard_items(items, i, shard_count, chunk_size) for i in range(shard_count)]
+    assigned = [item for shard in shards for item in shard]
+    assert sorted(assigned) == sorted(items)
+    assert len(set(assigned)) == len(assigned)
+    # Round-robin chunks keep the shards balanced to within one chunk
+    assert max(map(len, shards)) - min(map(len, shards)) <= chunk_size
+
+
+def test_slide_shards_ignore_input_order():
+    slides = [f"/slides/slide_{i:03d}.svs" for i in range(23)]
+    shards = [shard_slides(slides, i, 4) for i in range(4)]
+    assert sorted(s for shard in shards for s in shard) == sorted(slides)
+    assert shards == [shard_slides(list(reversed(slides)), i, 4) for i in range(4)]
+
+
+@pytest.mark.parametrize('shard_index,shard_count', [(-1, 2), (2, 2), (0, 0)])
+def test_invalid_shard_is_rejected(shard_index, shard_count):
+    with pytest.raises(ValueError):
+        shard_items(range(10), shard_index, shard_count)
+
+
+def write_shards(tmp_path, shard_count, locations, args=None, indices=None):
+    folders = []
+    for i in (range(shard_count) if indices is None else indices):
+        folder = tmp_path / f"shard_{len(folders)}"
+        folder.mkdir()
+        shard_locations = shard_items(locations, i, shard_count, chunk_size=4)
+        results = [{'x': x, 'y': y, 'prediction': 'Tumor'} for x, y in shard_locations]
+        (folder / 'patch_predictions.json').write_text(json.dumps(results))
+        write_manifest(str(folder), {'shard_index': i, 'shard_count': shard_count,
+                                     'args': {'patch_stride': 560, 'shard_index': i, 'num_workers': i + 1,
+                                              **(args or {}).get(i, {})}})
+        folders.append(str(folder))
+    return folders
+
+
+LOCATIONS = [(x * 560, y * 560) for y in range(6) for x in range(7)]
+
+
+def test_merge_restores_every_patch_in_raster_order(tmp_path):
+    manifests, results = load_shards(write_shards(tmp_path, 3, LOCATIONS))
+    assert [m['shard_index'] for m in manifests] == [0, 1, 2]
+    assert [(r['x'], r['y']) for r in results] == sorted(LOCATIONS, key=lambda location: (location[1], location[0]))
+
+
+def test_missing_shard_is_rejected(tmp_path):
+    with pytest.raises(ValueError, match='missing \\[1\\]'):
+        load_shards(write_shards(tmp_path, 3, LOCATIONS, indices=[0, 2]))
+
+
+def test_duplicated_shard_is_rejected(tmp_path):
+    with pytest.raises(ValueError, match='duplicated \\[0\\]'):
+        load_shards(write_shards(tmp_path, 2, LOCATIONS, indices=[0, 0]))
+
+
+def test_overlapping_patches_are_rejected(tmp_path):
+    folders = write_shards(tmp_path, 2, LOCATIONS)
+    with open(f"{folders[1]}/patch_predictions.json", 'w') as f:
+        json.dump([{'x': 0, 'y': 0, 'prediction': 'Tumor'}], f)
+    with pytest.raises(ValueError, match='more than one shard'):
+        load_shards(folders)
+
+
+def test_shards_of_different_runs_are_rejected(tmp_path):
+    # Execution options (workers) may differ; analysis options may not
+    with pytest.raises(ValueError, match='patch_stride'):
+        load_shards(write_shards(tmp_path, 2, LOCATIONS, args={1: {'patch_stride': 280}}))
+
+
+def test_folder_without_manifest_is_rejected(tmp_path):
+    folders = write_shards(tmp_path, 2, LOCATIONS)
+    (tmp_path / 'shard_1' / SHARD_MANIFEST).unlink()
+    with pytest.raises(ValueError, match='no shard_manifest.json'):
+        load_shards(folders)
@@ -0,0 +1,66 @@
+# Cached reads must match direct slide reads, including at levels with non-integer downsamples
+
+import numpy as np
+from PIL import Image
+
+from spider_tile_cache import TileCache, tile_origin
+
+
+class PyramidSlide:
+    """In-memory two-level slide that maps locations to level pixels with int(x / downsample)."""
+
+    def __init__(self, downsample=4.0003, size=(3000, 2000)):
+        rng = np.random.default_rng(0)
+        width, height = size
+        self.levels = [rng.integers(0, 256, (height, width, 4), dtype=np.uint8),
+                       rng.integers(0, 256, (int(height / downsample), int(width / downsample), 4), dtype=np.uint8)]
+        self.level_downsamples = (1.0, downsample)
+        self.dimensions = size
+        self.properties = {}
+        self._filename = f'pyramid_{downsample}'
+        self.reads = 0
+
+    def read_region(self, location, level, size):
+        self.reads += 1
+        pixels = self.levels[level]
+        left = int(location[0] / self.level_downsamples[level])
+        top = int(location[1] / self.level_downsamples[level])
+        region = np.zeros((size[1], size[0], 4), dtype=np.uint8)
+        x0, y0 = max(0, left), max(0, top)
+        x1, y1 = min(left + size[0], pixels.shape[1]), min(top + size[1], pixels.shape[0])
+        if x1 > x0 and y1 > y0:
+            region[y0 - top:y1 - top, x0 - left:x1 - left] = pixels[y0:y1, x0:x1]
+        return Image.fromarray(region, 'RGBA')
+
+
+def test_tile_origin_maps_back_to_the_tile():
+    for downsample in (1.0, 2.0, 4.0003, 3.99987, 16.0001, 32.5):
+        for level_pixel in range(0, 20000, 512):
+            origin = tile_origin(level_pixel, downsample)
+            assert int(origin / downsample) == level_pixel
+            assert origin == 0 or int((origin - 1) / downsample) < level_pixel
+
+
+def test_cached_reads_match_direct_reads_at_every_level():
+    for downsample in (4.0003, 3.99987, 4.0):
+        slide = PyramidSlide(downsample)
+        cache = TileCache(budget_bytes=64 * 1024 * 1024)
+        rng = np.random.default_rng(1)
+        for level in (0, 1):
+            for _ in range(20):
+                location = (int(rng.integers(0, 2800)), int(rng.integers(0, 1800)))
+                size = (int(rng.integers(1, 400)), int(rng.integers(1, 400)))
+                direct = np.asarray(slide.read_region(location, level, size))
+                cached = np.asarray(cache.read_region(slide, location, level, size))
+                assert np.array_equal(cached, direct), (downsample, level, location, size)
+        assert cache.hits > 0
+
+
+def test_repeated_reads_decode_each_tile_once():
+    slide = PyramidSlide()
+    cache = TileCache(budget_bytes=64 * 1024 * 1024)
+    first = np.asarray(cache.read_region(slide, (4100, 2100), 1, (300, 200)))
+    reads = slide.reads
+    second = np.asarray(cache.read_region(slide, (4100, 2100), 1, (300, 200)))
+    assert np.array_equal(first, second)
+    assert slide.reads == reads
@@ -1,40 +1,49 @@
 # whole_slide_analysis_spider_universal.py
 # Universal whole slide analysis script for all SPIDER models
 # Generates heatmaps and visualizations for Colorectal, Skin, and Thorax models
+# Patches are classified through spider_classifier.SpiderClassifier in this process and in
+# every pool worker; main(argv) and analyze(args) run the analysis when imported
 
 import os
 import sys
 import json
-import torch
+import time
+import argparse
 import numpy as np
-from PIL import Image
-import openslide
-from transformers import AutoModel, AutoProcessor
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 from matplotlib.colors import LinearSegmentedColormap
 from datetime import datetime
-from pathlib import Path
 import multiprocessing as mp
 from functools import partial
+from spider_model_registry import model_nbytes
+from spider_readers import open_reader, MPP_X_PROPERTY
+from spider_execution import plan_execution, apply_worker_settings, describe
+from spider_shm_pipeline import run_pipeline, DEFAULT_BATCH_SIZE as DEFAULT_SHM_BATCH
+from spider_geojson import DETECTIONS_FILENAME, write_detections
+from spider_postprocessing import (SMOOTHING_METHODS, results_to_grid, smooth_grid, apply_to_results,
+                                   high_confidence_regions)
+from spider_priority import (PatchScheduler, DistributionEstimate, ConvergenceMonitor, run_prioritized,
+                            DEFAULT_LOW_CONFIDENCE, DEFAULT_TOLERANCE)
+from spider_sampling import StratifiedSampler, CompositionEstimator, DEFAULT_CI_WIDTH, DEFAULT_CONFIDENCE
+from spider_tiling import grid_tissue_fraction, DEFAULT_MIN_TISSUE
+from spider_stain import StainNormalizers, add_stain_arguments, describe_stats as describe_stain_stats
+from spider_pyramid import HeatmapPyramid
+from spider_slide_io import read_region_at, load_or_create_thumbnail
+from spider_tile_cache import STAT_KEYS, get_tile_cache, merge_stats, describe_stats
+from spider_batching import AdaptiveBatcher, is_out_of_memory, memory_summary, MAX_AUTO_BATCH
+from spider_classifier import SpiderClassifier, RESULT_KEYS
+from spider_shared_weights import (can_share_weights, worker_context, share_weights, WorkerMemory,
+                                   describe_worker_memory)
+from spider_shards import add_shard_arguments, check_shard, shard_items, write_manifest, load_shards, merge_timing
 import warnings
 warnings.filterwarnings('ignore')
 
-# Parse command line arguments
-if len(sys.argv) < 4:
-    print("Usage: python whole_slide_analysis_spider_universal.py <model_path> <svs_path> <output_folder> [patch_stride] [max_patches] [num_workers]")
-    print("Example: python whole_slide_analysis_spider_universal.py ./SPIDER-skin-model ./slide.svs ./output 560 1000 4")
-    sys.exit(1)
+# Patches between incremental writes of the tiled heatmap pyramids
+PYRAMID_FLUSH_INTERVAL = 256
 
-model_path = sys.argv[1]
-svs_path = sys.argv[2]
-output_folder = sys.argv[3]
-patch_stride = int(sys.argv[4]) if len(sys.argv) > 4 else 560  # 50% overlap by default
-max_patches = int(sys.argv[5]) if len(sys.argv) > 5 else 1000
-num_workers = int(sys.argv[6]) if len(sys.argv) > 6 else 4
-
-# Create output directory
-os.makedirs(output_folder, exist_ok=True)
+# Patches between progressive summaries in priority and sampling order
+PARTIAL_SUMMARY_INTERVAL = 100
 
 # Model-specific visualization settings
 MODEL_SETTINGS = {
@@ -85,438 +94,1001 @@ MODEL_SETTINGS = {
     }
 }
 
-# Detect model type from path
-def detect_model_type(model_path):
-    model_path_lower = model_path.lower()
-    if "colorectal" in model_path_lower:
-        return "colorectal"
-    elif "skin" in model_path_lower:
-        return "skin"
-    elif "thorax" in model_path_lower:
-        return "thorax"
-    else:
-        print("Warning: Could not detect model type from path. Using default settings.")
-        return "colorectal"
+# Pool worker state: classifier, slide handle, options and tile cache counters of this worker
+_worker_state = {}
 
-# Load SPIDER model
-def load_spider_model(model_path):
-    print(f"Loading SPIDER model from: {model_path}")
-    
-    model_type = detect_model_type(model_path)
-    print(f"Detected model type: {model_type}")
+# Model type, class colours and analysis name of a classifier's model or ensemble
+def model_settings(classifier):
+    if classifier.ensemble is not None:
+        color_map = {}
+        for entry in classifier.ensemble.entries:
+            color_map = {**MODEL_SETTINGS.get(entry.model_type, {}).get("colors", {}), **color_map}
+        return "ensemble", color_map, f"SPIDER Ensemble Analysis ({' + '.join(classifier.ensemble.names)})"
     
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print(f"Using device: {device}")
+    # The model type is detected from the class names in config.json
+    model_type = classifier.model_type
+    if model_type == "unknown":
+        print("Warning: Could not detect model type. Using default settings.")
+        model_type = "colorectal"
+    settings = MODEL_SETTINGS.get(model_type, MODEL_SETTINGS["colorectal"])
+    return model_type, settings["colors"], settings["name"]
+
+# Patch result as saved in patch_predictions.json
+def patch_result(x, y, output):
+    return {
+        'x': x,
+        'y': y,
+        'prediction': output['prediction'],
+        'probabilities': output['probabilities'].tolist(),
+        'confidence': output['confidence'],
+        # Ensemble: per-model predictions and disagreement
+        **{key: value for key, value in output.items() if key not in RESULT_KEYS}
+    }
+
+# Classify a batch of (x, y, size) patches; patches that cannot be read get None.
+# Running out of memory is not a read error: it propagates so the batcher retries smaller.
+def classify_patches(classifier, slide, batch_info, read_downsample, stain=None):
+    patches, located = [], []
+    for x, y, size in batch_info:
+        try:
+            # Closest pyramid level (RGBA; the preprocessor drops alpha)
+            patches.append(read_region_at(slide, (x, y), (size, size), read_downsample))
+            located.append((x, y))
+        except Exception as e:
+            if is_out_of_memory(e):
+                raise
+            print(f"Error processing patch at ({x}, {y}): {str(e)}")
     
+    # Batched without an ensemble; an ensemble reads and preprocesses each patch once for every model
+    outputs = classifier.classify_images(patches, stain, detailed=False)
+    batch_results = [None] * (len(batch_info) - len(patches))
+    batch_results.extend(patch_result(x, y, output) for (x, y), output in zip(located, outputs))
+    return batch_results
+
+# Classify a single patch; errors are printed and give None
+def classify_patch(classifier, slide, patch_info, read_downsample, stain=None):
     try:
-        model = AutoModel.from_pretrained(
-            model_path,
-            trust_remote_code=True,
-            local_files_only=True
-        )
-        
-        processor = AutoProcessor.from_pretrained(
-            model_path,
-            trust_remote_code=True,
-            local_files_only=True
-        )
-        
-        model.to(device)
-        model.eval()
-        
-        # Load class names
-        config_path = os.path.join(model_path, "config.json")
-        with open(config_path, 'r') as f:
-            config = json.load(f)
-        
-        class_names = config.get('class_names', [])
-        print(f"Model has {len(class_names)} classes")
-        
-        return model, processor, class_names, device, model_type
-    
+        return classify_patches(classifier, slide, [patch_info], read_downsample, stain)[0]
     except Exception as e:
-        print(f"Error loading model: {str(e)}")
-        sys.exit(1)
+        print(f"Error processing patch at ({patch_info[0]}, {patch_info[1]}): {str(e)}")
+        return None
+
+# Worker initializer: thread count, CPU pinning, a slide handle and a classifier per worker.
+# Forked workers find the models loaded (and shared) by the parent in the registry.
+def init_worker(plan, counter, cache_stats, memory, config):
+    with counter.get_lock():
+        worker_index = counter.value
+        counter.value += 1
+    apply_worker_settings(plan, worker_index)
+    _worker_state.update(config)
+    _worker_state['index'] = worker_index
+    _worker_state['cache_stats'] = cache_stats
+    _worker_state['memory'] = memory
+    _worker_state['slide'] = open_reader(config['svs_path'])
+    _worker_state['classifier'] = SpiderClassifier(config['model_path'], ensemble=config['ensemble'],
+                                                   ensemble_threads=config['ensemble_threads'], batch_size=1)
 
-# Process a single patch
-def process_patch(patch_info, model_path):
-    x, y, patch_size = patch_info
+def publish_cache_stats():
+    stats = get_tile_cache().stats()
+    start = _worker_state['index'] * len(STAT_KEYS)
+    _worker_state['cache_stats'][start:start + len(STAT_KEYS)] = [stats[key] for key in STAT_KEYS]
+
+# Process a patch in a pool worker, then publish its tile cache counters and sample its memory
+def pool_patch(patch_info):
+    state = _worker_state
+    result = classify_patch(state['classifier'], state['slide'], patch_info, state['read_downsample'],
+                            state['stain'])
+    publish_cache_stats()
+    state['memory'].record(state['index'])
+    return result
+
+def worker_tile_cache_stats(cache_stats, num_workers):
+    return merge_stats([dict(zip(STAT_KEYS, cache_stats[i * len(STAT_KEYS):(i + 1) * len(STAT_KEYS)]))
+                        for i in range(num_workers)])
+
+# Argument parsers of the analysis and of the merge subcommand
+def build_parsers():
+    parser = argparse.ArgumentParser(
+        description="Universal whole slide analysis for SPIDER models",
+        epilog="Example: python whole_slide_analysis_spider_universal.py ./SPIDER-skin-model ./slide.svs ./output 560 1000 4. "
+               "Sharded across nodes: add --shard-index I --shard-count N with one output folder per shard, then "
+               "combine them with: python whole_slide_analysis_spider_universal.py merge ./output ./shard_0 ./shard_1 ..."
+    )
+    parser.add_argument('model_path', help="SPIDER model directory")
+    parser.add_argument('svs_path', help="Slide to analyze")
+    parser.add_argument('output_folder', help="Folder for heatmaps, summary and report")
+    parser.add_argument('patch_stride', nargs='?', type=int, default=560,
+                        help="Stride between patches, in pixels at the read resolution (default: 560, 50%% overlap)")
+    parser.add_argument('max_patches', nargs='?', type=int, default=1000, help="Maximum number of patches (default: 1000)")
+    parser.add_argument('num_workers', nargs='?', type=int, default=0,
+                        help="Parallel worker processes; 0 plans workers and threads for this machine (default: 0)")
+    parser.add_argument('--read-downsample', type=float, default=1.0,
+                        help="Analyze at a lower magnification; patches are read from the closest pyramid level (default: 1.0)")
+    parser.add_argument('--heatmap-format', choices=['png', 'dzi', 'both'], default='png',
+                        help="png: matplotlib figures; dzi: tiled multi-resolution pyramids written as patches finish (default: png)")
+    parser.add_argument('--merge-detections', action='store_true',
+                        help="Merge adjacent same-class tiles into polygons in the exported detections")
+    parser.add_argument('--smoothing', choices=SMOOTHING_METHODS, default='none',
+                        help="Spatial smoothing of the patch probability grid: neighbourhood average or mean-field Potts (default: none)")
+    parser.add_argument('--smoothing-radius', type=int, default=1,
+                        help="Neighbourhood radius in patches for --smoothing average (default: 1)")
+    parser.add_argument('--smoothing-weight', type=float, default=1.0,
+                        help="Neighbour agreement weight for --smoothing potts (default: 1.0)")
+    parser.add_argument('--ensemble', nargs='+', metavar='MODEL_PATH', default=[],
+                        help="Additional models; every patch is read and preprocessed once and classified by all models")
+    parser.add_argument('--ensemble-threads', type=int, default=1,
+                        help="Run ensemble models in parallel threads (default: 1, sequential)")
+    parser.add_argument('--pipeline', choices=['pool', 'shm'], default='pool',
+                        help="pool: one process per patch task; shm: reader processes feed inference workers "
+                             "through a shared-memory ring buffer (default: pool)")
+    parser.add_argument('--readers', type=int, default=2, help="Reader processes for --pipeline shm (default: 2)")
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help="Inference batch size; 0 sizes batches from available memory in a single process "
+                             f"(up to {MAX_AUTO_BATCH}) and uses {DEFAULT_SHM_BATCH} for --pipeline shm (default: 0)")
+    parser.add_argument('--order', choices=['raster', 'priority', 'sample'], default='raster',
+                        help="raster: rows from the top-left until max_patches; priority: coarse-to-fine over the whole "
+                             "slide, then around low-confidence patches; sample: stratified random tissue patches until "
+                             "the composition intervals are narrow enough. max_patches is the budget (default: raster)")
+    parser.add_argument('--time-budget', type=float, default=0,
+                        help="Stop after this many seconds of patch scoring; implies --order priority unless "
+                             "sampling (default: 0, none)")
+    parser.add_argument('--converge-tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help=f"Priority order: stop once the estimated class distribution changes by at most this "
+                             f"fraction over consecutive checks; 0 disables (default: {DEFAULT_TOLERANCE})")
+    parser.add_argument('--low-confidence', type=float, default=DEFAULT_LOW_CONFIDENCE,
+                        help=f"Priority order: neighbours of patches below this confidence are scored early "
+                             f"(default: {DEFAULT_LOW_CONFIDENCE})")
+    parser.add_argument('--focus-classes', nargs='+', metavar='CLASS', default=[],
+                        help="Priority order: also score neighbours of patches predicted as these classes early")
+    parser.add_argument('--ci-width', type=float, default=DEFAULT_CI_WIDTH,
+                        help=f"Sampling: stop once every class's confidence interval is at most this wide; "
+                             f"0 samples up to the budget (default: {DEFAULT_CI_WIDTH})")
+    parser.add_argument('--confidence-level', type=float, default=DEFAULT_CONFIDENCE,
+                        help=f"Sampling: confidence level of the intervals (default: {DEFAULT_CONFIDENCE})")
+    parser.add_argument('--min-tissue', type=float, default=DEFAULT_MIN_TISSUE,
+                        help=f"Sampling: minimum tissue fraction of a patch to be sampled (default: {DEFAULT_MIN_TISSUE})")
+    add_stain_arguments(parser)
+    add_shard_arguments(parser)
+
+    # Merge subcommand: combine the outputs of --shard-index/--shard-count runs without re-running inference
+    merge_parser = argparse.ArgumentParser(
+        prog="whole_slide_analysis_spider_universal.py merge",
+        description="Combine whole-slide shard outputs into patch predictions, heatmaps, summary and report",
+        epilog="Example: python whole_slide_analysis_spider_universal.py merge ./output ./shard_0 ./shard_1"
+    )
+    merge_parser.add_argument('output_folder', help="Folder for the merged heatmaps, summary and report")
+    merge_parser.add_argument('shard_folders', nargs='+', help="Output folders of every shard of one run")
+
+    return parser, merge_parser
+
+# Analysis options, plus the shard manifests and their results for the merge subcommand
+def parse_arguments(argv):
+    parser, merge_parser = build_parsers()
     
-    # Reload model for each worker (required for multiprocessing)
-    model, processor, class_names, device, _ = load_spider_model(model_path)
+    if argv and argv[0] == 'merge':
+        merge_args = merge_parser.parse_args(argv[1:])
+        if any(os.path.realpath(f) == os.path.realpath(merge_args.output_folder) for f in merge_args.shard_folders):
+            merge_parser.error("the merged output folder must not be a shard folder")
+        try:
+            shard_manifests, shard_results = load_shards(merge_args.shard_folders)
+        except ValueError as e:
+            print(f"Cannot merge shards: {str(e)}")
+            sys.exit(1)
+        # The analysis options are those the shards ran with
+        args = argparse.Namespace(**shard_manifests[0]['args'])
+        args.output_folder = merge_args.output_folder
+        print(f"Merging {len(shard_manifests)} shards: {len(shard_results)} patch predictions")
+        return args, shard_manifests, shard_results
     
+    args = parser.parse_args(argv)
     try:
-        # Extract patch
-        patch = slide.read_region((x, y), 0, (patch_size, patch_size)).convert('RGB')
-        
-        # Process with model
-        inputs = processor(images=patch, return_tensors="pt")
-        for k, v in inputs.items():
-            if isinstance(v, torch.Tensor):
-                inputs[k] = v.to(device)
+        check_shard(args.shard_index, args.shard_count)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.shard_count > 1 and (args.order != 'raster' or args.time_budget > 0):
+        parser.error("sharding splits the raster patch set; --order priority/sample and --time-budget "
+                     "choose patches from earlier results")
+    return args, None, None
+
+# Class heatmaps and classification overview as matplotlib figures
+def write_heatmap_figures(output_folder, results, slide, svs_path, class_names, color_map, analysis_name,
+                          patch_extent):
+    slide_width, slide_height = slide.dimensions
+    
+    # Create heatmaps for each class
+    print("Generating heatmaps...")
+
+    # Get thumbnail for overlay (read from the lowest suitable pyramid level, cached per slide)
+    thumbnail_size = (2000, int(2000 * slide_height / slide_width))
+    thumbnail = load_or_create_thumbnail(slide, svs_path, thumbnail_size, output_folder)
+
+    # Calculate scaling factors
+    scale_x = thumbnail_size[0] / slide_width
+    scale_y = thumbnail_size[1] / slide_height
+
+    # Create visualization for each class
+    fig, axes = plt.subplots(3, 4, figsize=(20, 15))
+    axes = axes.flatten()
+
+    for idx, class_name in enumerate(class_names[:12]):  # Show up to 12 classes
+        ax = axes[idx]
+    
+        # Create heatmap for this class
+        heatmap = np.zeros(thumbnail_size[::-1])  # height x width
+        counts = np.zeros(thumbnail_size[::-1])
+    
+        for result in results:
+            x_thumb = int(result['x'] * scale_x)
+            y_thumb = int(result['y'] * scale_y)
+            w_thumb = int(patch_extent * scale_x)
+            h_thumb = int(patch_extent * scale_y)
         
-        with torch.no_grad():
-            outputs = model(**inputs)
+            # Get probability for this class
+            prob = result['probabilities'][idx]
         
-        logits = outputs.logits
-        probabilities = torch.softmax(logits[0], dim=0).cpu().numpy()
-        prediction_idx = probabilities.argmax().item()
+            # Add to heatmap
+            y_end = min(y_thumb + h_thumb, heatmap.shape[0])
+            x_end = min(x_thumb + w_thumb, heatmap.shape[1])
         
-        return {
-            'x': x,
-            'y': y,
-            'prediction': class_names[prediction_idx],
-            'probabilities': probabilities.tolist(),
-            'confidence': float(probabilities[prediction_idx])
-        }
+            heatmap[y_thumb:y_end, x_thumb:x_end] += prob
+            counts[y_thumb:y_end, x_thumb:x_end] += 1
     
-    except Exception as e:
-        print(f"Error processing patch at ({x}, {y}): {str(e)}")
-        return None
-
-# Main analysis
-print(f"Starting whole slide analysis for: {svs_path}")
-
-# Load slide
-slide = openslide.OpenSlide(svs_path)
-slide_width, slide_height = slide.dimensions
-print(f"Slide dimensions: {slide_width} x {slide_height}")
-
-# Load model for getting class names
-model, processor, class_names, device, model_type = load_spider_model(model_path)
-
-# Get model settings
-settings = MODEL_SETTINGS.get(model_type, MODEL_SETTINGS["colorectal"])
-color_map = settings["colors"]
-analysis_name = settings["name"]
-
-# Calculate patches to process
-patch_size = 1120  # SPIDER input size
-patches_to_process = []
-
-# Simple grid sampling with stride
-for y in range(0, slide_height - patch_size, patch_stride):
-    for x in range(0, slide_width - patch_size, patch_stride):
-        patches_to_process.append((x, y, patch_size))
-        if len(patches_to_process) >= max_patches:
-            break
-    if len(patches_to_process) >= max_patches:
-        break
-
-print(f"Processing {len(patches_to_process)} patches with stride {patch_stride}")
-
-# Process patches in parallel
-if num_workers > 1:
-    print(f"Using {num_workers} workers for parallel processing")
-    # Close the slide object before multiprocessing
-    slide.close()
+        # Average the probabilities
+        with np.errstate(divide='ignore', invalid='ignore'):
+            heatmap = np.divide(heatmap, counts)
+            heatmap[counts == 0] = 0
     
-    # Process patches
-    with mp.Pool(num_workers) as pool:
-        process_func = partial(process_patch, model_path=model_path)
-        results = list(pool.imap_unordered(process_func, patches_to_process))
+        # Show thumbnail with heatmap overlay
+        ax.imshow(thumbnail, alpha=0.5)
     
-    # Reopen slide for thumbnail
-    slide = openslide.OpenSlide(svs_path)
-else:
-    # Single-threaded processing
-    results = []
-    for i, patch_info in enumerate(patches_to_process):
-        if i % 100 == 0:
-            print(f"Processing patch {i+1}/{len(patches_to_process)}")
-        result = process_patch(patch_info, model_path)
-        results.append(result)
+        # Get color for this class
+        class_color = color_map.get(class_name, '#808080')
+        # Create custom colormap from white to class color
+        colors = ['white', class_color]
+        n_bins = 100
+        cmap = LinearSegmentedColormap.from_list(class_name, colors, N=n_bins)
+    
+        im = ax.imshow(heatmap, alpha=0.7, cmap=cmap, vmin=0, vmax=1)
+        ax.set_title(f"{class_name}", fontsize=12)
+        ax.axis('off')
 
-# Filter out failed patches
-results = [r for r in results if r is not None]
-print(f"Successfully processed {len(results)} patches")
+    # Remove unused subplots
+    for idx in range(len(class_names), len(axes)):
+        fig.delaxes(axes[idx])
 
-# Save raw results
-results_path = os.path.join(output_folder, 'patch_predictions.json')
-with open(results_path, 'w') as f:
-    json.dump(results, f)
+    plt.suptitle(f"{analysis_name} - {os.path.basename(svs_path)}", fontsize=16)
+    plt.tight_layout()
+    plt.savefig(os.path.join(output_folder, 'class_heatmaps.png'), dpi=150, bbox_inches='tight')
+    plt.close()
 
-# Create heatmaps for each class
-print("Generating heatmaps...")
+    # Create overall classification map
+    print("Creating classification map...")
 
-# Get thumbnail for overlay
-thumbnail_size = (2000, int(2000 * slide_height / slide_width))
-thumbnail = slide.get_thumbnail(thumbnail_size)
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(20, 10))
 
-# Calculate scaling factors
-scale_x = thumbnail_size[0] / slide_width
-scale_y = thumbnail_size[1] / slide_height
+    # Show original thumbnail
+    ax1.imshow(thumbnail)
+    ax1.set_title("Original Slide", fontsize=14)
+    ax1.axis('off')
 
-# Create visualization for each class
-fig, axes = plt.subplots(3, 4, figsize=(20, 15))
-axes = axes.flatten()
+    # Create classification overlay
+    classification_map = np.zeros((*thumbnail_size[::-1], 3))
 
-for idx, class_name in enumerate(class_names[:12]):  # Show up to 12 classes
-    ax = axes[idx]
-    
-    # Create heatmap for this class
-    heatmap = np.zeros(thumbnail_size[::-1])  # height x width
-    counts = np.zeros(thumbnail_size[::-1])
-    
     for result in results:
         x_thumb = int(result['x'] * scale_x)
         y_thumb = int(result['y'] * scale_y)
-        w_thumb = int(patch_size * scale_x)
-        h_thumb = int(patch_size * scale_y)
-        
-        # Get probability for this class
-        prob = result['probabilities'][idx]
-        
-        # Add to heatmap
-        y_end = min(y_thumb + h_thumb, heatmap.shape[0])
-        x_end = min(x_thumb + w_thumb, heatmap.shape[1])
-        
-        heatmap[y_thumb:y_end, x_thumb:x_end] += prob
-        counts[y_thumb:y_end, x_thumb:x_end] += 1
+        w_thumb = int(patch_extent * scale_x)
+        h_thumb = int(patch_extent * scale_y)
     
-    # Average the probabilities
-    with np.errstate(divide='ignore', invalid='ignore'):
-        heatmap = np.divide(heatmap, counts)
-        heatmap[counts == 0] = 0
+        # Get color for predicted class
+        predicted_class = result['prediction']
+        color_hex = color_map.get(predicted_class, '#808080')
+        color_rgb = [int(color_hex[i:i+2], 16)/255 for i in (1, 3, 5)]
     
-    # Show thumbnail with heatmap overlay
-    ax.imshow(thumbnail, alpha=0.5)
+        # Apply color with confidence-based opacity
+        confidence = result['confidence']
+        y_end = min(y_thumb + h_thumb, classification_map.shape[0])
+        x_end = min(x_thumb + w_thumb, classification_map.shape[1])
     
-    # Get color for this class
-    class_color = color_map.get(class_name, '#808080')
-    # Create custom colormap from white to class color
-    colors = ['white', class_color]
-    n_bins = 100
-    cmap = LinearSegmentedColormap.from_list(class_name, colors, N=n_bins)
+        for c in range(3):
+            classification_map[y_thumb:y_end, x_thumb:x_end, c] = color_rgb[c]
+
+    # Show classification map
+    ax2.imshow(thumbnail, alpha=0.3)
+    ax2.imshow(classification_map, alpha=0.7)
+    ax2.set_title("Classification Map", fontsize=14)
+    ax2.axis('off')
+
+    # Add legend
+    legend_elements = []
+    class_counts = {}
+    for result in results:
+        class_counts[result['prediction']] = class_counts.get(result['prediction'], 0) + 1
+
+    # Sort by count
+    sorted_classes = sorted(class_counts.items(), key=lambda x: x[1], reverse=True)
+
+    for class_name, count in sorted_classes[:10]:  # Show top 10 classes
+        color = color_map.get(class_name, '#808080')
+        percentage = (count / len(results)) * 100
+        legend_elements.append(mpatches.Patch(color=color, 
+                                            label=f"{class_name} ({percentage:.1f}%)"))
+
+    ax2.legend(handles=legend_elements, loc='center left', bbox_to_anchor=(1, 0.5))
+
+    plt.suptitle(f"{analysis_name} Results", fontsize=16)
+    plt.tight_layout()
+    plt.savefig(os.path.join(output_folder, 'classification_overview.png'), dpi=150, bbox_inches='tight')
+    plt.close()
+
+# HTML report of an analysis summary
+def write_report(output_folder, summary, color_map, heatmap_format, heatmap_pyramid):
+    analysis_name = summary["analysis_type"]
+    model_type = summary["model_type"]
+    svs_path = summary["slide_path"]
+    slide_width = summary["slide_dimensions"]["width"]
+    slide_height = summary["slide_dimensions"]["height"]
+    parameters = summary["analysis_parameters"]
+    patch_size = parameters["patch_size"]
+    budget_summary = summary["budget"]
     
-    im = ax.imshow(heatmap, alpha=0.7, cmap=cmap, vmin=0, vmax=1)
-    ax.set_title(f"{class_name}", fontsize=12)
-    ax.axis('off')
+    # Heatmap sections of the HTML report: inline figures, or links to the tiled pyramids
+    if heatmap_format in ('png', 'both'):
+        overview_section = """<h2>Classification Overview</h2>
+        <img src="classification_overview.png" alt="Classification Overview">
+        """
+        heatmap_section = """<h2>Class-Specific Heatmaps</h2>
+        <img src="class_heatmaps.png" alt="Class Heatmaps">
+        """
+    else:
+        overview_section = ""
+        heatmap_section = ""
+    if heatmap_pyramid is not None:
+        pyramid_items = '\n'.join(
+            f'        <li><a href="heatmap_tiles/{layer}.dzi">{layer}.dzi</a></li>' for layer in heatmap_pyramid.layers
+        )
+        heatmap_section += f"""<h2>Tiled Heatmaps (Deep Zoom)</h2>
+        <p>Open in any DZI-capable viewer (e.g. OpenSeadragon). Layer-to-class mapping and
+        slide coordinates: <a href="heatmap_tiles/manifest.json">manifest.json</a></p>
+        <ul>
+    {pyramid_items}
+        </ul>
+        """
 
-# Remove unused subplots
-for idx in range(len(class_names), len(axes)):
-    fig.delaxes(axes[idx])
+    # Generate HTML report
+    html_report = f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>{analysis_name} Report</title>
+        <style>
+            body {{ font-family: Arial, sans-serif; margin: 20px; }}
+            h1, h2 {{ color: #2c3e50; }}
+            .overview {{ display: flex; gap: 20px; margin: 20px 0; }}
+            .stat-box {{ background: #f0f0f0; padding: 15px; border-radius: 5px; }}
+            .distribution-table {{ border-collapse: collapse; width: 100%; }}
+            .distribution-table th, .distribution-table td {{ 
+                border: 1px solid #ddd; padding: 8px; text-align: left; 
+            }}
+            .distribution-table th {{ background-color: #3498db; color: white; }}
+            .color-box {{ display: inline-block; width: 20px; height: 20px; 
+                         margin-right: 5px; vertical-align: middle; }}
+            img {{ max-width: 100%; height: auto; }}
+        </style>
+    </head>
+    <body>
+        <h1>{analysis_name} Report</h1>
+        <p>Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
+        
+        <div class="overview">
+            <div class="stat-box">
+                <h3>Slide Information</h3>
+                <p>File: {os.path.basename(svs_path)}</p>
+                <p>Dimensions: {slide_width} × {slide_height} pixels</p>
+            </div>
+            <div class="stat-box">
+                <h3>Analysis Parameters</h3>
+                <p>Model: {model_type.upper()}</p>
+                <p>Patches analyzed: {parameters["total_patches"]}</p>
+                <p>Patch size: {patch_size} × {patch_size} pixels</p>
+                <p>Stride: {parameters["patch_stride"]} pixels</p>
+            </div>
+        </div>
+        
+        {overview_section}
+        <h2>Class Distribution</h2>
+        <table class="distribution-table">
+            <tr>
+                <th>Class</th>
+                <th>Color</th>
+                <th>Count</th>
+                <th>Percentage</th>
+            </tr>
+    """
 
-plt.suptitle(f"{analysis_name} - {os.path.basename(svs_path)}", fontsize=16)
-plt.tight_layout()
-plt.savefig(os.path.join(output_folder, 'class_heatmaps.png'), dpi=150, bbox_inches='tight')
-plt.close()
+    # Add class distribution to HTML
+    for class_name, stats in sorted(summary["class_distribution"].items(), 
+                                   key=lambda x: x[1]["percentage"], reverse=True):
+        if stats["percentage"] > 0:
+            color = color_map.get(class_name, '#808080')
+            html_report += f"""
+            <tr>
+                <td>{class_name}</td>
+                <td><span class="color-box" style="background-color: {color};"></span></td>
+                <td>{stats["count"]}</td>
+                <td>{stats["percentage"]:.1f}%</td>
+            </tr>
+            """
 
-# Create overall classification map
-print("Creating classification map...")
+    html_report += """
+        </table>
+    """
 
-fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(20, 10))
+    # Tissue composition estimated from sampled patches, with confidence intervals
+    if budget_summary is not None and budget_summary.get("composition"):
+        html_report += f"""
+        <h2>Estimated Tissue Composition</h2>
+        <p>{budget_summary["samples"]} sampled of {budget_summary["tissue_patches"]} tissue patches,
+        {budget_summary["confidence_level"]:.0%} confidence intervals</p>
+        <table class="distribution-table">
+            <tr>
+                <th>Class</th>
+                <th>Estimate</th>
+                <th>Interval</th>
+            </tr>
+    """
+        for class_name, estimate in sorted(budget_summary["composition"].items(),
+                                           key=lambda x: x[1]["proportion"], reverse=True):
+            html_report += f"""
+            <tr>
+                <td>{class_name}</td>
+                <td>{estimate["proportion"]:.1%}</td>
+                <td>{estimate["ci_lower"]:.1%} – {estimate["ci_upper"]:.1%}</td>
+            </tr>
+            """
+        html_report += """
+        </table>
+    """
 
-# Show original thumbnail
-ax1.imshow(thumbnail)
-ax1.set_title("Original Slide", fontsize=14)
-ax1.axis('off')
+    html_report += f"""
+        {heatmap_section}
+        <h2>High-Confidence Regions</h2>
+        <ul>
+    """
 
-# Create classification overlay
-classification_map = np.zeros((*thumbnail_size[::-1], 3))
+    # Add high-confidence regions (largest first)
+    for region in summary["high_confidence_regions"]:
+        bbox = region["bounding_box"]
+        area = f'{region["area_mm2"]:.2f} mm²' if "area_mm2" in region else f'{region["area_pixels"]:,} px²'
+        html_report += f"""
+            <li><strong>{region["class"]}</strong>: {region["patch_count"]} high-confidence patches, {area}
+                (avg. confidence: {region["average_confidence"]:.1%}), bounding box 
+                ({bbox["x"]}, {bbox["y"]}, {bbox["width"]} × {bbox["height"]}), most confident patch at 
+                ({region["peak"]["x"]}, {region["peak"]["y"]})</li>
+        """
+
+    html_report += """
+        </ul>
+    </body>
+    </html>
+    """
+
+    # Save HTML report
+    with open(os.path.join(output_folder, 'report.html'), 'w') as f:
+        f.write(html_report)
 
-for result in results:
-    x_thumb = int(result['x'] * scale_x)
-    y_thumb = int(result['y'] * scale_y)
-    w_thumb = int(patch_size * scale_x)
-    h_thumb = int(patch_size * scale_y)
+# Whole-slide analysis of one slide, or the merge of shard outputs when shard_manifests is given
+def analyze(args, shard_manifests=None, shard_results=None):
+    # A shard run classifies its part of the patch set and leaves the outputs to the merge
+    shard_run = shard_manifests is None and args.shard_count > 1
     
-    # Get color for predicted class
-    predicted_class = result['prediction']
-    color_hex = color_map.get(predicted_class, '#808080')
-    color_rgb = [int(color_hex[i:i+2], 16)/255 for i in (1, 3, 5)]
+    model_path = args.model_path
+    svs_path = args.svs_path
+    output_folder = args.output_folder
+    patch_stride = args.patch_stride
+    max_patches = args.max_patches
+    num_workers = args.num_workers
+    read_downsample = args.read_downsample
+    heatmap_format = args.heatmap_format
+    merge_detections = args.merge_detections
+    smoothing = args.smoothing
     
-    # Apply color with confidence-based opacity
-    confidence = result['confidence']
-    y_end = min(y_thumb + h_thumb, classification_map.shape[0])
-    x_end = min(x_thumb + w_thumb, classification_map.shape[1])
+    # Create output directory
+    os.makedirs(output_folder, exist_ok=True)
     
-    for c in range(3):
-        classification_map[y_thumb:y_end, x_thumb:x_end, c] = color_rgb[c]
-
-# Show classification map
-ax2.imshow(thumbnail, alpha=0.3)
-ax2.imshow(classification_map, alpha=0.7)
-ax2.set_title("Classification Map", fontsize=14)
-ax2.axis('off')
-
-# Add legend
-legend_elements = []
-class_counts = {}
-for result in results:
-    class_counts[result['prediction']] = class_counts.get(result['prediction'], 0) + 1
-
-# Sort by count
-sorted_classes = sorted(class_counts.items(), key=lambda x: x[1], reverse=True)
-
-for class_name, count in sorted_classes[:10]:  # Show top 10 classes
-    color = color_map.get(class_name, '#808080')
-    percentage = (count / len(results)) * 100
-    legend_elements.append(mpatches.Patch(color=color, 
-                                        label=f"{class_name} ({percentage:.1f}%)"))
-
-ax2.legend(handles=legend_elements, loc='center left', bbox_to_anchor=(1, 0.5))
-
-plt.suptitle(f"{analysis_name} Results", fontsize=16)
-plt.tight_layout()
-plt.savefig(os.path.join(output_folder, 'classification_overview.png'), dpi=150, bbox_inches='tight')
-plt.close()
-
-# Generate summary report
-print("Generating summary report...")
-
-summary = {
-    "analysis_type": analysis_name,
-    "model_type": model_type,
-    "slide_path": svs_path,
-    "slide_dimensions": {"width": slide_width, "height": slide_height},
-    "analysis_parameters": {
-        "patch_size": patch_size,
-        "patch_stride": patch_stride,
-        "total_patches": len(results),
-        "max_patches": max_patches
-    },
-    "timestamp": datetime.now().isoformat(),
-    "class_distribution": {},
-    "high_confidence_regions": []
-}
+    print(f"Starting whole slide analysis for: {svs_path}")
+    
+    # Load slide
+    slide = open_reader(svs_path)
+    slide_width, slide_height = slide.dimensions
+    print(f"Slide dimensions: {slide_width} x {slide_height}")
+    
+    classifier = None
+    if shard_manifests is None:
+        # Models are cached in a process-wide registry keyed by config hash. Ensemble mode: the
+        # primary model plus --ensemble models, predicting over the union of their classes
+        try:
+            classifier = SpiderClassifier(model_path, ensemble=args.ensemble, ensemble_threads=args.ensemble_threads)
+        except Exception as e:
+            print(f"Error loading model: {str(e)}")
+            sys.exit(1)
+        device = classifier.device
+        class_names = classifier.class_names
+        model_type, color_map, analysis_name = model_settings(classifier)
+        print(f"Detected model type: {model_type}")
+        print(f"Using device: {device}")
+        print(f"Model has {len(class_names)} classes")
+        
+        # Optional stain normalization: the slide's stain matrix is estimated (or loaded from the cache) once
+        stains = None
+        stain_normalizer = None
+        if args.stain_normalize:
+            stains = StainNormalizers(output_folder, open_reader)
+            stain_normalizer = stains.get(svs_path, slide)
+        
+        # Plan inference workers and threads per worker so workers do not oversubscribe the cores
+        ensemble = classifier.ensemble
+        models = [entry.model for entry in ensemble.entries] if ensemble is not None else [classifier.model]
+        weights_nbytes = sum(model_nbytes(model) for model in models)
+        pipeline = args.pipeline
+        if pipeline == 'shm' and ensemble is not None:
+            print("Ensemble mode uses the process pool; ignoring --pipeline shm")
+            pipeline = 'pool'
+        
+        # Budgeted runs choose each next patch from the results so far
+        order = args.order
+        if args.time_budget > 0 and order == 'raster':
+            print("A time budget uses priority order")
+            order = 'priority'
+        if order != 'raster' and pipeline == 'shm':
+            print(f"{order.capitalize()} order schedules patches from earlier results; ignoring --pipeline shm")
+            pipeline = 'pool'
+        batch_size = (args.batch_size or DEFAULT_SHM_BATCH) if pipeline == 'shm' else 1
+        # Forked CPU workers map the weights loaded here instead of each holding a copy
+        shared_weights = device.type == 'cpu' and can_share_weights()
+        requested_workers = num_workers
+        execution_plan = plan_execution(requested_workers, weights_nbytes, batch_size=batch_size,
+                                        device_type=device.type, shared_weights=shared_weights)
+        num_workers = execution_plan['workers']
+        shared_weights_bytes = 0
+        if shared_weights and (num_workers > 1 or pipeline == 'shm'):
+            try:
+                shared_weights_bytes = share_weights(models)
+                print(f"Model weights in shared memory: {shared_weights_bytes / 1e6:.0f} MB, mapped by every worker")
+            except (RuntimeError, OSError) as e:
+                # e.g. a 64 MB /dev/shm in a container: workers inherit the weights copy-on-write
+                # instead, and the plan counts them once per worker again
+                print(f"Could not move model weights to shared memory ({str(e)}); planning with per-worker weights")
+                execution_plan = plan_execution(requested_workers, weights_nbytes, batch_size=batch_size,
+                                                device_type=device.type, shared_weights=False)
+                num_workers = execution_plan['workers']
+        print(f"Execution plan: {describe(execution_plan)}")
+        ensemble_names = ensemble.names if ensemble is not None else None
+    else:
+        # Merging: the model settings come from the shard manifests and no model is loaded
+        manifest = shard_manifests[0]
+        class_names = manifest['class_names']
+        model_type = manifest['model_type']
+        color_map = manifest['color_map']
+        analysis_name = manifest['analysis_name']
+        ensemble_names = manifest['ensemble_models']
+        stains = None
+        stain_normalizer = None
+        shared_weights_bytes = 0
+        order = args.order
+        pipeline = [m['pipeline'] for m in shard_manifests]
+        execution_plan = [m['execution'] for m in shard_manifests]
+        print(f"Detected model type: {model_type}")
+    
+    # Calculate patches to process
+    patch_size = 1120  # SPIDER input size
+    patches_to_process = []
+
+    # Level-0 footprint of a patch and of the stride at the read resolution
+    patch_extent = int(round(patch_size * read_downsample))
+    level0_stride = max(1, int(round(patch_stride * read_downsample)))
 
-# Calculate class distribution
-for class_name in class_names:
-    count = sum(1 for r in results if r['prediction'] == class_name)
-    percentage = (count / len(results)) * 100 if results else 0
-    summary["class_distribution"][class_name] = {
-        "count": count,
-        "percentage": round(percentage, 2)
+    # Patch grid: cell (i, j) is the patch at level-0 (i * level0_stride, j * level0_stride)
+    grid_w = len(range(0, slide_width - patch_extent, level0_stride))
+    grid_h = len(range(0, slide_height - patch_extent, level0_stride))
+
+    if order != 'raster':
+        print(f"Scoring up to {min(max_patches, grid_w * grid_h)} of {grid_w * grid_h} patches in {order} order"
+              + (f" within {args.time_budget:g}s" if args.time_budget > 0 else ""))
+    else:
+        # Simple grid sampling with stride
+        for y in range(0, slide_height - patch_extent, level0_stride):
+            for x in range(0, slide_width - patch_extent, level0_stride):
+                patches_to_process.append((x, y, patch_size))
+                if len(patches_to_process) >= max_patches:
+                    break
+            if len(patches_to_process) >= max_patches:
+                break
+
+        candidate_patches = len(patches_to_process)
+        if shard_run:
+            patches_to_process = shard_items(patches_to_process, args.shard_index, args.shard_count)
+            print(f"Shard {args.shard_index}/{args.shard_count}: {len(patches_to_process)} of {candidate_patches} patches")
+
+        print(f"Processing {len(patches_to_process)} patches with stride {patch_stride}"
+              + (f" at downsample {read_downsample:g}" if read_downsample > 1 else ""))
+
+    # Tiled heatmap pyramids at patch-grid resolution, updated as patches finish
+    heatmap_pyramid = None
+    if heatmap_format in ('dzi', 'both') and not shard_run:
+        heatmap_pyramid = HeatmapPyramid(
+            os.path.join(output_folder, 'heatmap_tiles'),
+            (grid_h, grid_w),
+            class_names,
+            color_map,
+            origin_offset=(patch_extent - level0_stride) // 2,  # Each cell is the centre of its patch
+            cell_extent=level0_stride
+        )
+
+    results = []
+    batcher = None
+
+    def collect_result(result):
+        results.append(result)
+        if heatmap_pyramid is not None and result is not None:
+            heatmap_pyramid.add(result['x'] // level0_stride, result['y'] // level0_stride, result['probabilities'])
+            if len(results) % PYRAMID_FLUSH_INTERVAL == 0:
+                heatmap_pyramid.flush()
+
+    def write_partial_summary(monitor, scheduler):
+        partial = {
+            "patches_scored": scheduler.issued,
+            "candidate_patches": grid_w * grid_h,
+            "elapsed_seconds": round(time.time() - analysis_start, 2),
+            **monitor.report()
+        }
+        with open(os.path.join(output_folder, 'partial_summary.json'), 'w') as f:
+            json.dump(partial, f, indent=2)
+
+    # What each pool worker needs to build its own classifier and read its own patches
+    worker_config = {
+        'svs_path': svs_path,
+        'model_path': model_path,
+        'ensemble': args.ensemble,
+        'ensemble_threads': args.ensemble_threads,
+        'read_downsample': read_downsample,
+        'stain': stain_normalizer
     }
 
-# Find high-confidence regions for each significant class
-for class_name, stats in summary["class_distribution"].items():
-    if stats["percentage"] > 5:  # Only for classes with >5% presence
-        high_conf_patches = [r for r in results 
-                           if r['prediction'] == class_name and r['confidence'] > 0.8]
+    # Process patches: priority-ordered or sampled under a budget, shared-memory
+    # reader/inference pipeline, process pool, or in this process
+    analysis_start = time.time()
+    tile_cache_stats = None
+    pool_memory = None
+    budget_summary = None
+    if shard_manifests is not None:
+        # Merge: the shards classified disjoint parts of the patch set
+        for result in shard_results:
+            collect_result(result)
+    elif order != 'raster':
+        if order == 'priority':
+            scheduler = PatchScheduler((grid_h, grid_w), max_patches, low_confidence=args.low_confidence,
+                                       focus_classes=args.focus_classes)
+            estimate = DistributionEstimate((grid_h, grid_w), scheduler.spacing, class_names)
+            monitor = ConvergenceMonitor(estimate, tolerance=args.converge_tolerance)
+        else:
+            # Sample tissue patches only; the mask comes from a low-resolution read
+            tissue = grid_tissue_fraction(slide, level0_stride, int(round(patch_extent / level0_stride)),
+                                          (grid_h, grid_w))
+            scheduler = StratifiedSampler(tissue >= args.min_tissue, max_patches)
+            monitor = CompositionEstimator(scheduler, class_names, ci_width=args.ci_width,
+                                           confidence=args.confidence_level)
+            print(f"Sampling from {scheduler.population} tissue patches in {len(scheduler.strata)} strata")
+        
+        def cell_patch(gy, gx):
+            return (gx * level0_stride, gy * level0_stride, patch_size)
+        
+        def on_result(gy, gx, result):
+            collect_result(result)
+            # Progressive outputs: the pyramid flushes in collect_result, the estimate here
+            if len(results) % PARTIAL_SUMMARY_INTERVAL == 0:
+                write_partial_summary(monitor, scheduler)
         
-        if high_conf_patches:
-            # Find centroid of high-confidence regions
-            avg_x = sum(p['x'] for p in high_conf_patches) / len(high_conf_patches)
-            avg_y = sum(p['y'] for p in high_conf_patches) / len(high_conf_patches)
+        if num_workers > 1:
+            print(f"Using {num_workers} workers for parallel processing")
+            slide.close()
+            worker_counter = mp.Value('i', 0)
+            cache_stats = mp.Array('q', num_workers * len(STAT_KEYS))
+            pool_memory = WorkerMemory(num_workers)
+            with worker_context().Pool(num_workers, initializer=init_worker,
+                                       initargs=(execution_plan, worker_counter, cache_stats, pool_memory,
+                                                 worker_config)) as pool:
+                def submit(gy, gx, callback):
+                    pool.apply_async(pool_patch, (cell_patch(gy, gx),), callback=callback,
+                                     error_callback=lambda e: callback(None))
+                
+                # Two patches per worker in flight keeps workers busy while new results steer the order
+                stop_reason = run_prioritized(scheduler, submit, on_result, args.time_budget, monitor,
+                                              in_flight=2 * num_workers)
+            tile_cache_stats = worker_tile_cache_stats(cache_stats, num_workers)
+            slide = open_reader(svs_path)
+        else:
+            apply_worker_settings(execution_plan)
             
-            summary["high_confidence_regions"].append({
-                "class": class_name,
-                "patch_count": len(high_conf_patches),
-                "centroid": {"x": int(avg_x), "y": int(avg_y)},
-                "average_confidence": round(
-                    sum(p['confidence'] for p in high_conf_patches) / len(high_conf_patches), 3
-                )
-            })
-
-# Save summary
-summary_path = os.path.join(output_folder, 'analysis_summary.json')
-with open(summary_path, 'w') as f:
-    json.dump(summary, f, indent=2)
-
-# Generate HTML report
-html_report = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <title>{analysis_name} Report</title>
-    <style>
-        body {{ font-family: Arial, sans-serif; margin: 20px; }}
-        h1, h2 {{ color: #2c3e50; }}
-        .overview {{ display: flex; gap: 20px; margin: 20px 0; }}
-        .stat-box {{ background: #f0f0f0; padding: 15px; border-radius: 5px; }}
-        .distribution-table {{ border-collapse: collapse; width: 100%; }}
-        .distribution-table th, .distribution-table td {{ 
-            border: 1px solid #ddd; padding: 8px; text-align: left; 
-        }}
-        .distribution-table th {{ background-color: #3498db; color: white; }}
-        .color-box {{ display: inline-block; width: 20px; height: 20px; 
-                     margin-right: 5px; vertical-align: middle; }}
-        img {{ max-width: 100%; height: auto; }}
-    </style>
-</head>
-<body>
-    <h1>{analysis_name} Report</h1>
-    <p>Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
-    
-    <div class="overview">
-        <div class="stat-box">
-            <h3>Slide Information</h3>
-            <p>File: {os.path.basename(svs_path)}</p>
-            <p>Dimensions: {slide_width} × {slide_height} pixels</p>
-        </div>
-        <div class="stat-box">
-            <h3>Analysis Parameters</h3>
-            <p>Model: {model_type.upper()}</p>
-            <p>Patches analyzed: {len(results)}</p>
-            <p>Patch size: {patch_size} × {patch_size} pixels</p>
-            <p>Stride: {patch_stride} pixels</p>
-        </div>
-    </div>
-    
-    <h2>Classification Overview</h2>
-    <img src="classification_overview.png" alt="Classification Overview">
-    
-    <h2>Class Distribution</h2>
-    <table class="distribution-table">
-        <tr>
-            <th>Class</th>
-            <th>Color</th>
-            <th>Count</th>
-            <th>Percentage</th>
-        </tr>
-"""
-
-# Add class distribution to HTML
-for class_name, stats in sorted(summary["class_distribution"].items(), 
-                               key=lambda x: x[1]["percentage"], reverse=True):
-    if stats["percentage"] > 0:
-        color = color_map.get(class_name, '#808080')
-        html_report += f"""
-        <tr>
-            <td>{class_name}</td>
-            <td><span class="color-box" style="background-color: {color};"></span></td>
-            <td>{stats["count"]}</td>
-            <td>{stats["percentage"]:.1f}%</td>
-        </tr>
-        """
+            def submit(gy, gx, callback):
+                callback(classify_patch(classifier, slide, cell_patch(gy, gx), read_downsample, stain_normalizer))
+            
+            stop_reason = run_prioritized(scheduler, submit, on_result, args.time_budget, monitor)
+            tile_cache_stats = get_tile_cache().stats()
+        
+        write_partial_summary(monitor, scheduler)
+        print(f"{order.capitalize()} run stopped ({stop_reason}) after {scheduler.issued} of {grid_w * grid_h} patches")
+        # Slide-level estimates (quadtree map or stratified sample); class_distribution counts only scored patches
+        budget_summary = {
+            "stop_reason": stop_reason,
+            "patches_scored": scheduler.issued,
+            "candidate_patches": grid_w * grid_h,
+            "patch_budget": max_patches,
+            "time_budget": args.time_budget or None,
+            **({"converge_tolerance": args.converge_tolerance} if order == 'priority' else {}),
+            **monitor.report()
+        }
+    elif pipeline == 'shm':
+        # Readers open their own slide handles
+        slide.close()
+        locations = [(x, y) for x, y, _ in patches_to_process]
+        for result in run_pipeline(svs_path, model_path, locations, patch_size, read_downsample, class_names,
+                                   execution_plan, n_readers=args.readers, batch_size=batch_size,
+                                   stain=stain_normalizer):
+            collect_result(result)
+        
+        # Reopen slide for thumbnail
+        slide = open_reader(svs_path)
+    elif num_workers > 1:
+        print(f"Using {num_workers} workers for parallel processing")
+        # Close the slide object before multiprocessing
+        slide.close()
+        
+        # Process patches
+        worker_counter = mp.Value('i', 0)
+        cache_stats = mp.Array('q', num_workers * len(STAT_KEYS))
+        pool_memory = WorkerMemory(num_workers)
+        with worker_context().Pool(num_workers, initializer=init_worker,
+                                   initargs=(execution_plan, worker_counter, cache_stats, pool_memory,
+                                             worker_config)) as pool:
+            for result in pool.imap_unordered(pool_patch, patches_to_process):
+                collect_result(result)
+        tile_cache_stats = worker_tile_cache_stats(cache_stats, num_workers)
+        
+        # Reopen slide for thumbnail
+        slide = open_reader(svs_path)
+    elif classifier.ensemble is None and classifier.preprocessor is not None and patches_to_process:
+        # Single-process processing in batches sized from the memory available as the run goes
+        apply_worker_settings(execution_plan)
+        input_shape = classifier.preprocessor.output_shape(patch_size, patch_size)
+        batcher = AdaptiveBatcher.for_model(classifier.model, input_shape, device,
+                                            max_batch=args.batch_size or MAX_AUTO_BATCH)
+        # Each batcher batch is one forward pass; preprocessing buffers follow the batcher's size
+        # as it grows, not max_batch
+        classifier.batch_size = batcher.max_batch
+        process_batch = partial(classify_patches, classifier, slide, read_downsample=read_downsample,
+                                stain=stain_normalizer)
+        next_report = 0
+        for batch_results in batcher.run(patches_to_process, process_batch):
+            if len(results) >= next_report:
+                print(f"Processing patch {len(results)+1}/{len(patches_to_process)} (batch size {batcher.size})")
+                next_report += 100
+            for result in batch_results:
+                collect_result(result)
+        tile_cache_stats = get_tile_cache().stats()
+    else:
+        # Single-process processing with the planned thread count
+        apply_worker_settings(execution_plan)
+        for i, patch_info in enumerate(patches_to_process):
+            if i % 100 == 0:
+                print(f"Processing patch {i+1}/{len(patches_to_process)}")
+            collect_result(classify_patch(classifier, slide, patch_info, read_downsample, stain_normalizer))
+        tile_cache_stats = get_tile_cache().stats()
+    analysis_seconds = time.time() - analysis_start
+    stain_stats = None
+    memory_stats = memory_summary()
+    if shard_manifests is not None:
+        # Shards run concurrently: the slowest shard is the analysis time, counters are summed
+        shard_timing = merge_timing(shard_manifests)
+        analysis_seconds = shard_timing['analysis_seconds']
+        tile_cache_stats = shard_timing['tile_cache']
+        stain_stats = shard_timing['stain_normalization']
+        memory_stats = shard_timing['memory']
+        missing = sum(m['patches']['assigned'] for m in shard_manifests) - len(results)
+        print(f"Merged {len(results)} patch predictions from {len(shard_manifests)} shards"
+              + (f" ({missing} patches could not be classified)" if missing else "")
+              + f"; slowest shard {analysis_seconds:.1f}s")
 
-html_report += """
-    </table>
-    
-    <h2>Class-Specific Heatmaps</h2>
-    <img src="class_heatmaps.png" alt="Class Heatmaps">
-    
-    <h2>High-Confidence Regions</h2>
-    <ul>
-"""
+    # Filter out failed patches
+    results = [r for r in results if r is not None]
+    print(f"Successfully processed {len(results)} patches in {analysis_seconds:.1f}s")
+    if tile_cache_stats is not None:
+        print(describe_stats(tile_cache_stats))
+    if stain_normalizer is not None:
+        stain_stats = stains.stats()
+        if stain_stats['patches'] == 0:
+            # Patches were normalized in worker processes; time the batch operation here instead
+            stain_stats['apply_ms_per_patch'] = round(1000 * stain_normalizer.benchmark(), 3)
+            stain_stats['apply_ms_per_patch_source'] = 'benchmark'
+    if stain_stats is not None:
+        print(describe_stain_stats(stain_stats))
+    if batcher is not None:
+        memory_stats['batching'] = batcher.stats()
+        print(f"Batch size {batcher.initial_size} -> {batcher.size} over {batcher.batches} batches "
+              f"({batcher.oom_retries} out-of-memory retries, {batcher.pressure_shrinks} pressure shrinks, "
+              f"{batcher.grows} grows)")
+    elif pipeline == 'shm':
+        memory_stats['batching'] = {'batch_size': batch_size}
+    if shared_weights_bytes:
+        memory_stats['shared_weights_mb'] = round(shared_weights_bytes / 1e6, 1)
+    # Private memory is what each extra worker costs; RSS also counts the pages workers share
+    if pool_memory is not None and pool_memory.summary() is not None:
+        memory_stats['worker_memory'] = pool_memory.summary()
+        print(describe_worker_memory(memory_stats['worker_memory']))
+    print(f"Peak RSS: {memory_stats['peak_rss_mb']} MB (largest worker: {memory_stats['peak_worker_rss_mb']} MB)")
 
-# Add high-confidence regions
-for region in summary["high_confidence_regions"]:
-    html_report += f"""
-        <li><strong>{region["class"]}</strong>: {region["patch_count"]} high-confidence patches 
-            (avg. confidence: {region["average_confidence"]:.1%}) centered around 
-            ({region["centroid"]["x"]}, {region["centroid"]["y"]})</li>
-    """
+    # Save raw results
+    results_path = os.path.join(output_folder, 'patch_predictions.json')
+    with open(results_path, 'w') as f:
+        json.dump(results, f)
+
+    # Shard runs stop here: smoothing, heatmaps, detections, summary and report need every shard's
+    # predictions and are written by the merge subcommand
+    if shard_run:
+        manifest_path = write_manifest(output_folder, {
+            "shard_index": args.shard_index,
+            "shard_count": args.shard_count,
+            "args": vars(args),
+            "slide_path": svs_path,
+            "model_type": model_type,
+            "class_names": class_names,
+            "color_map": color_map,
+            "analysis_name": analysis_name,
+            "ensemble_models": ensemble_names,
+            "pipeline": pipeline,
+            "execution": execution_plan,
+            "patches": {"candidates": candidate_patches, "assigned": len(patches_to_process), "classified": len(results)},
+            "timing": {
+                "analysis_seconds": round(analysis_seconds, 2),
+                "tile_cache": tile_cache_stats,
+                "stain_normalization": stain_stats,
+                "memory": memory_stats
+            },
+            "timestamp": datetime.now().isoformat()
+        })
+        slide.close()
+        if classifier is not None:
+            classifier.close()
+        print(f"\nShard {args.shard_index}/{args.shard_count} complete: {len(results)} patch predictions in {output_folder}")
+        print("Merge every shard with: python whole_slide_analysis_spider_universal.py merge <output_folder> <shard folders>")
+        return
+
+    # Spatial smoothing over the patch grid; heatmaps, detections and the summary use the smoothed results
+    if smoothing != 'none':
+        print(f"Smoothing patch predictions ({smoothing})...")
+        grid_probabilities, processed = results_to_grid(results, level0_stride, (grid_h, grid_w), len(class_names))
+        smoothed = smooth_grid(grid_probabilities, processed, smoothing,
+                               radius=args.smoothing_radius, weight=args.smoothing_weight)
+        results = apply_to_results(results, smoothed, level0_stride, class_names)
+        changed = sum(1 for r in results if r['prediction'] != r['raw_prediction'])
+        print(f"Smoothing changed the class of {changed}/{len(results)} patches")
+        if heatmap_pyramid is not None:
+            heatmap_pyramid.set_grid(smoothed, processed)
+
+    if heatmap_pyramid is not None:
+        heatmap_pyramid.flush()
+        print(f"Tiled heatmaps written to: {heatmap_pyramid.output_dir}")
+
+    # Export QuPath-importable detections (scripts/spider_import_detections.groovy)
+    detections_path = os.path.join(output_folder, DETECTIONS_FILENAME)
+    n_detections = write_detections(detections_path, results, class_names, color_map,
+                                    patch_extent, level0_stride, merge=merge_detections)
+    print(f"Exported {n_detections} {'merged regions' if merge_detections else 'tiles'} as QuPath detections")
+
+    # Matplotlib figures (skipped when only tiled pyramids are requested)
+    if heatmap_format in ('png', 'both'):
+        write_heatmap_figures(output_folder, results, slide, svs_path, class_names, color_map, analysis_name,
+                              patch_extent)
+
+    # Generate summary report
+    print("Generating summary report...")
+
+    summary = {
+        "analysis_type": analysis_name,
+        "model_type": model_type,
+        "slide_path": svs_path,
+        "slide_dimensions": {"width": slide_width, "height": slide_height},
+        "analysis_parameters": {
+            "patch_size": patch_size,
+            "patch_stride": patch_stride,
+            "read_downsample": read_downsample,
+            "heatmap_format": heatmap_format,
+            "smoothing": smoothing,
+            "ensemble_models": ensemble_names,
+            "execution": execution_plan,
+            "pipeline": pipeline,
+            "order": order,
+            "total_patches": len(results),
+            "max_patches": max_patches
+        },
+        "timestamp": datetime.now().isoformat(),
+        "timing": {
+            "analysis_seconds": round(analysis_seconds, 2),
+            "patches_per_second": round(len(results) / analysis_seconds, 3) if analysis_seconds > 0 else None,
+            # Readers of the shared-memory pipeline keep their own caches; not reported
+            "tile_cache": tile_cache_stats,
+            "stain_normalization": stain_stats,
+            # Peak resident memory of this process and of the largest worker, and the batch sizes used
+            "memory": memory_stats
+        },
+        "budget": budget_summary,
+        # Merged runs: the shard folders and their per-shard analysis times
+        "shards": {
+            "count": len(shard_manifests),
+            "folders": [m['folder'] for m in shard_manifests],
+            "analysis_seconds": shard_timing['shard_seconds']
+        } if shard_manifests is not None else None,
+        "class_distribution": {},
+        "high_confidence_regions": []
+    }
+
+    # Model disagreement in ensemble mode
+    if ensemble_names is not None:
+        disagreements = [r['disagreement'] for r in results if 'disagreement' in r]
+        summary["ensemble"] = {
+            "models": ensemble_names,
+            "mean_disagreement": round(sum(disagreements) / len(disagreements), 3) if disagreements else None,
+            "patches_with_disagreement": sum(1 for d in disagreements if d > 0),
+            "per_model_distribution": {
+                name: {c: sum(1 for r in results if r['models'][name]['prediction'] == c)
+                       for c in sorted({r['models'][name]['prediction'] for r in results})}
+                for name in ensemble_names
+            }
+        }
+
+    # Calculate class distribution
+    for class_name in class_names:
+        count = sum(1 for r in results if r['prediction'] == class_name)
+        percentage = (count / len(results)) * 100 if results else 0
+        summary["class_distribution"][class_name] = {
+            "count": count,
+            "percentage": round(percentage, 2)
+        }
+
+    # Connected regions of same-class patches with confidence > 0.8 on the patch grid
+    mpp = slide.properties.get(MPP_X_PROPERTY)
+    summary["high_confidence_regions"] = high_confidence_regions(
+        results, class_names, level0_stride, patch_extent, (grid_h, grid_w),
+        microns_per_pixel=float(mpp) if mpp else None
+    )
+
+    # Save summary
+    summary_path = os.path.join(output_folder, 'analysis_summary.json')
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    write_report(output_folder, summary, color_map, heatmap_format, heatmap_pyramid)
+
+    # Clean up
+    slide.close()
+    if classifier is not None:
+        classifier.close()
+
+    print("\nAnalysis complete!")
+    print(f"Results saved to: {output_folder}")
+    if heatmap_format in ('png', 'both'):
+        print("- Classification overview: classification_overview.png")
+        print("- Class heatmaps: class_heatmaps.png")
+    if heatmap_pyramid is not None:
+        print("- Tiled heatmaps: heatmap_tiles/ (classification.dzi, class_XX.dzi, manifest.json)")
+    print("- Summary data: analysis_summary.json")
+    print("- HTML report: report.html")
+    print("- Raw predictions: patch_predictions.json")
+    print(f"- QuPath detections: {DETECTIONS_FILENAME}")
+
+def main(argv=None):
+    args, shard_manifests, shard_results = parse_arguments(sys.argv[1:] if argv is None else argv)
+    analyze(args, shard_manifests, shard_results)
 
-html_report += """
-    </ul>
-</body>
-</html>
-"""
-
-# Save HTML report
-with open(os.path.join(output_folder, 'report.html'), 'w') as f:
-    f.write(html_report)
-
-# Clean up
-slide.close()
-
-print(f"\nAnalysis complete!")
-print(f"Results saved to: {output_folder}")
-print(f"- Classification overview: classification_overview.png")
-print(f"- Class heatmaps: class_heatmaps.png")
-print(f"- Summary data: analysis_summary.json")
-print(f"- HTML report: report.html")
-print(f"- Raw predictions: patch_predictions.json")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -19,6 +19,8 @@ def outputPath = new File(new File(projectPath).getParent(), "output/classificat
 def scriptPath = new File(new File(projectPath).getParent(), "python/spider_qupath_classifier.py").getAbsolutePath()
 def modelPath = "D:\\histai\\SPIDER-colorectal-model"  // Update this to your SPIDER model path
 def tempAnnotationsPath = buildFilePath(outputPath, "annotations_to_predict.json")
+def useTTA = false  // Re-check low-confidence regions with flipped/rotated views (slower for those regions)
+def useStainNormalization = false  // Normalize H&E stains per slide (estimated once per slide and cached)
 
 // Create output directory
 def outputDir = new File(outputPath)
@@ -77,80 +79,11 @@ new File(tempAnnotationsPath).text = jsonString
 
 println("Exported " + annotationData.size() + " annotations to " + tempAnnotationsPath)
 
-// STEP 2: RUN SPIDER CLASSIFICATION
+// STEP 2: RUN SPIDER CLASSIFICATION (results are applied as they stream in)
 println("\n--- STEP 2: RUNNING SPIDER CLASSIFICATION ---")
 
-// Run SPIDER classifier
-def command = [pythonPath, scriptPath, tempAnnotationsPath, modelPath, outputPath]
-println("Running command: " + command.join(" "))
-
-def process = new ProcessBuilder(command)
-    .redirectErrorStream(true)
-    .start()
-
-// Read and print the output
-def reader = new BufferedReader(new InputStreamReader(process.getInputStream()))
-def line
-while ((line = reader.readLine()) != null) {
-    println(line)
-}
-
-def exitCode = process.waitFor()
-println("Python process finished with exit code: " + exitCode)
-
-if (exitCode != 0) {
-    Dialogs.showErrorMessage("Error", "SPIDER classification failed. Check the log for details.")
-    return
-}
-
-println("Classification completed successfully!")
-
-// STEP 3: APPLY CLASSIFICATIONS
-println("\n--- STEP 3: APPLYING CLASSIFICATIONS ---")
-
-// Load predictions
-def predictionsPath = buildFilePath(outputPath, "predictions.json")
-def predictionsFile = new File(predictionsPath)
-
-if (!predictionsFile.exists()) {
-    Dialogs.showErrorMessage("Error", "Predictions file not found at " + predictionsPath)
-    return
-}
-
-def jsonText = predictionsFile.text
-def jsonParser = new JsonParser()
-def jsonArray = jsonParser.parse(jsonText).getAsJsonArray()
-
-// Convert to a list structure we can work with
-def predictions = []
-for (int i = 0; i < jsonArray.size(); i++) {
-    def predictionObj = jsonArray.get(i).getAsJsonObject()
-    def prediction = [
-        id: predictionObj.get("id").getAsString()
-    ]
-    
-    if (!predictionObj.get("prediction").isJsonNull()) {
-        prediction.prediction = predictionObj.get("prediction").getAsString()
-        
-        // Extract probabilities
-        def probsObj = predictionObj.get("probabilities").getAsJsonObject()
-        def probs = [:]
-        probsObj.keySet().each { className ->
-            probs[className] = probsObj.get(className).getAsDouble()
-        }
-        prediction.probabilities = probs
-    } else {
-        prediction.prediction = null
-        prediction.probabilities = null
-    }
-    
-    predictions.add(prediction)
-}
-
-println("Loaded " + predictions.size() + " predictions")
-
-// Get all annotations (not just unclassified ones)
-def allAnnotations = getAnnotationObjects()
+// Prefix used by the Python classifier for machine-readable progress/result lines
+def EVENT_PREFIX = "SPIDER_EVENT "
 
 // Function to find or create a PathClass by name
 def findOrCreatePathClass = { String name ->
@@ -182,42 +115,151 @@ def findOrCreatePathClass = { String name ->
     return pathClass
 }
 
-// Map by ID for quick lookup
+// Map by ID for quick lookup (all annotations, not just unclassified ones)
 def annotationMap = [:]
-allAnnotations.each { annotation ->
+getAnnotationObjects().each { annotation ->
     annotationMap[annotation.getID().toString()] = annotation
 }
 
-// Apply classes based on predictions
+def jsonParser = new JsonParser()
 def applied = 0
+def received = 0
+
+// Apply one prediction record (a JsonObject from the stream or predictions.json)
+def applyPrediction = { predictionObj ->
+    def predictionId = predictionObj.get("id").getAsString()
+    def annotation = annotationMap[predictionId]
+    if (annotation == null) {
+        println("WARNING: Could not find annotation with ID " + predictionId)
+        return
+    }
+    if (predictionObj.get("prediction").isJsonNull())
+        return
+    
+    def className = predictionObj.get("prediction").getAsString()
+    def probsObj = predictionObj.get("probabilities").getAsJsonObject()
+    
+    // Apply class
+    annotation.setPathClass(findOrCreatePathClass(className))
+    
+    // Add confidence information as a comment
+    def confidence = String.format("%.1f", probsObj.get(className).getAsDouble() * 100)
+    annotation.setName("SPIDER: " + className + " (" + confidence + "%)")
+    
+    // Add measurements for probabilities
+    probsObj.keySet().each { key ->
+        annotation.measurements.put("SPIDER: P(" + key + ")", probsObj.get(key).getAsDouble())
+    }
+    
+    applied++
+    println("Applied class " + className + " to annotation " + predictionId)
+}
 
-predictions.each { prediction ->
-    def annotation = annotationMap[prediction.id]
-    if (annotation != null && prediction.prediction != null) {
-        // Get or create the class
-        def pathClass = findOrCreatePathClass(prediction.prediction)
-        
-        // Apply class
-        annotation.setPathClass(pathClass)
-        
-        // Add confidence information as a comment
-        def confidence = String.format("%.1f", prediction.probabilities[prediction.prediction] * 100)
-        def comment = "SPIDER: " + prediction.prediction + " (" + confidence + "%)"
-        annotation.setName(comment)
-        
-        // Add measurements for probabilities
-        prediction.probabilities.each { className, probability ->
-            annotation.measurements.put("SPIDER: P(" + className + ")", probability)
+// Format throughput and ETA from a progress event
+def formatProgress = { event ->
+    def done = event.get("done").getAsInt()
+    // The total is null while an incrementally read input has not been counted
+    def totalElement = event.get("total")
+    def total = (totalElement == null || totalElement.isJsonNull()) ? null : totalElement.getAsInt()
+    def rate = event.get("rate").getAsDouble()
+    def eta = event.get("eta")
+    def etaStr = (eta == null || eta.isJsonNull()) ? "--" : String.format("%.0fs", eta.getAsDouble())
+    if (total == null)
+        return String.format("Progress: %d - %.2f regions/s, ETA %s", done, rate, etaStr)
+    return String.format("Progress: %d/%d (%.0f%%) - %.2f regions/s, ETA %s",
+        done, total, total > 0 ? 100.0 * done / total : 100.0, rate, etaStr)
+}
+
+// Run SPIDER classifier
+def command = [pythonPath, scriptPath, tempAnnotationsPath, modelPath, outputPath]
+if (useTTA)
+    command.add("--tta")
+if (useStainNormalization)
+    command.add("--stain-normalize")
+println("Running command: " + command.join(" "))
+
+def process = new ProcessBuilder(command)
+    .redirectErrorStream(true)
+    .start()
+
+// Read the output, applying result records as they arrive
+def reader = new BufferedReader(new InputStreamReader(process.getInputStream()))
+def lastRefresh = 0L
+def line
+while ((line = reader.readLine()) != null) {
+    if (!line.startsWith(EVENT_PREFIX)) {
+        println(line)
+        continue
+    }
+    
+    def event
+    try {
+        event = jsonParser.parse(line.substring(EVENT_PREFIX.length())).getAsJsonObject()
+    } catch (Exception e) {
+        println(line)
+        continue
+    }
+    
+    def type = event.get("type").getAsString()
+    if (type == "results") {
+        def records = event.get("records").getAsJsonArray()
+        for (int i = 0; i < records.size(); i++) {
+            applyPrediction(records.get(i).getAsJsonObject())
         }
+        received += records.size()
+        println(formatProgress(event))
         
-        applied++
-        
-        // Debug info
-        println("Applied class " + prediction.prediction + " to annotation " + prediction.id)
-    } else {
-        if (annotation == null) {
-            println("WARNING: Could not find annotation with ID " + prediction.id)
+        // Refresh the viewer at most once per second
+        def now = System.currentTimeMillis()
+        if (now - lastRefresh > 1000) {
+            fireHierarchyUpdate()
+            lastRefresh = now
         }
+    } else if (type == "start") {
+        def total = event.get("total")
+        if (total == null || total.isJsonNull())
+            println("SPIDER started (reading regions incrementally)")
+        else
+            println("SPIDER started on " + total.getAsInt() + " regions")
+    } else if (type == "error") {
+        println("ERROR: " + event.get("message").getAsString())
+    } else if (type == "finish") {
+        println(formatProgress(event))
+    }
+}
+
+def exitCode = process.waitFor()
+println("Python process finished with exit code: " + exitCode)
+
+if (exitCode != 0 && applied == 0) {
+    Dialogs.showErrorMessage("Error", "SPIDER classification failed. Check the log for details.")
+    return
+}
+
+if (exitCode != 0) {
+    println("WARNING: Classification did not finish; keeping " + applied + " results received so far")
+} else {
+    println("Classification completed successfully!")
+}
+
+// STEP 3: APPLY CLASSIFICATIONS
+println("\n--- STEP 3: APPLYING CLASSIFICATIONS ---")
+
+// Fall back to predictions.json when the classifier did not stream any results
+if (received == 0) {
+    def predictionsPath = buildFilePath(outputPath, "predictions.json")
+    def predictionsFile = new File(predictionsPath)
+    
+    if (!predictionsFile.exists()) {
+        Dialogs.showErrorMessage("Error", "Predictions file not found at " + predictionsPath)
+        return
+    }
+    
+    def jsonArray = jsonParser.parse(predictionsFile.text).getAsJsonArray()
+    println("Loaded " + jsonArray.size() + " predictions")
+    
+    for (int i = 0; i < jsonArray.size(); i++) {
+        applyPrediction(jsonArray.get(i).getAsJsonObject())
     }
 }
 
@@ -232,4 +274,4 @@ if (applied > 0) {
 
 // Show total time
 def totalTimeSeconds = (System.currentTimeMillis() - startTime) / 1000
-println("INFO: Total run time: " + String.format("%.2f", totalTimeSeconds) + " seconds")
\ No newline at end of file
+println("INFO: Total run time: " + String.format("%.2f", totalTimeSeconds) + " seconds")
@@ -19,6 +19,8 @@ def outputPath = new File(new File(projectPath).getParent(), "output/classificat
 def scriptPath = new File(new File(projectPath).getParent(), "python/spider_qupath_classifier_detailed.py").getAbsolutePath()
 def modelPath = "D:\\histai\\SPIDER-colorectal-model"  // Update this to your SPIDER model path
 def tempAnnotationsPath = buildFilePath(outputPath, "annotations_to_predict.json")
+def useTTA = false  // Re-check low-confidence regions with flipped/rotated views (slower for those regions)
+def useStainNormalization = false  // Normalize H&E stains per slide (estimated once per slide and cached)
 
 // Create output directory
 def outputDir = new File(outputPath)
@@ -82,6 +84,10 @@ println("\n--- STEP 2: RUNNING SPIDER CLASSIFICATION ---")
 
 // Run SPIDER classifier
 def command = [pythonPath, scriptPath, tempAnnotationsPath, modelPath, outputPath]
+if (useTTA)
+    command.add("--tta")
+if (useStainNormalization)
+    command.add("--stain-normalize")
 println("Running command: " + command.join(" "))
 
 def process = new ProcessBuilder(command)
@@ -0,0 +1,72 @@
+// SPIDER Detection Importer
+// This script imports the detections.geojson written by whole_slide_analysis_spider_universal.py
+// (one detection per patch, or per merged same-class region, with class probability measurements)
+// and adds them to the current image in a single batch, without re-running inference
+
+import qupath.lib.objects.PathObject
+import qupath.lib.io.GsonTools
+import qupath.lib.gui.dialogs.Dialogs
+import com.google.gson.JsonParser
+
+// Configuration
+def detectionsPath = ""  // Path to detections.geojson; leave empty to choose a file
+def replaceExisting = true  // Remove SPIDER detections from a previous import first
+
+// Start timing
+def startTime = System.currentTimeMillis()
+println("Starting SPIDER detection import at " + new Date())
+
+// Locate the detections file
+def detectionsFile = detectionsPath ? new File(detectionsPath) : null
+if (detectionsFile == null || !detectionsFile.exists()) {
+    def defaultDir = new File(new File(buildFilePath(PROJECT_BASE_DIR)).getParent(), "output/whole_slide")
+    detectionsFile = Dialogs.promptForFile("Select SPIDER detections", defaultDir.exists() ? defaultDir : null,
+        "GeoJSON", ".geojson")
+}
+if (detectionsFile == null || !detectionsFile.exists()) {
+    Dialogs.showErrorMessage("SPIDER Import", "No detections file selected")
+    return
+}
+
+println("Reading ${detectionsFile.getAbsolutePath()}")
+
+// Parse the FeatureCollection; QuPath's Gson deserializes each feature into a PathObject
+def gson = GsonTools.getInstance()
+def features
+detectionsFile.withReader("UTF-8") { reader ->
+    features = new JsonParser().parse(reader).getAsJsonObject().get("features").getAsJsonArray()
+}
+
+def detections = new ArrayList<PathObject>(features.size())
+int failed = 0
+for (int i = 0; i < features.size(); i++) {
+    try {
+        detections.add(gson.fromJson(features.get(i), PathObject.class))
+    } catch (Exception e) {
+        failed++
+        if (failed <= 5)
+            println("Error parsing feature ${i}: ${e.getMessage()}")
+    }
+}
+features = null
+
+def parseSeconds = (System.currentTimeMillis() - startTime) / 1000
+println("Parsed ${detections.size()} detections in ${parseSeconds}s" + (failed ? " (${failed} failed)" : ""))
+
+// Remove detections from a previous import
+if (replaceExisting) {
+    def previous = getDetectionObjects().findAll { detection ->
+        detection.getMeasurementList().getMeasurementNames().contains("SPIDER: Confidence")
+    }
+    if (!previous.isEmpty()) {
+        removeObjects(previous, true)
+        println("Removed ${previous.size()} previously imported SPIDER detections")
+    }
+}
+
+// Add everything in one batch: a single hierarchy event instead of one per object
+addObjects(detections)
+fireHierarchyUpdate()
+
+def totalTimeSeconds = (System.currentTimeMillis() - startTime) / 1000
+println("Imported ${detections.size()} SPIDER detections in ${totalTimeSeconds}s")
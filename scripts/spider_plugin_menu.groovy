@@ -678,7 +678,7 @@ def runTileAnalysis(String modelType) {
     
     def outputPath = buildFilePath(projectParent, "output", "classifications")
     def pythonScriptPath = buildFilePath(projectParent, "python", "spider_qupath_classifier.py")
-    def tempAnnotationsPath = buildFilePath(outputPath, "tiles_to_predict.json")
+    def tempAnnotationsPath = buildFilePath(outputPath, "tiles_to_predict.ndjson")
     
     // Check if scripts exist
     if (!new File(pythonScriptPath).exists()) {
@@ -777,9 +777,14 @@ def runTileAnalysis(String modelType) {
         }
     }
     
-    // Export tiles as JSON
-    def gson = GsonTools.getInstance(true)
-    new File(tempAnnotationsPath).text = gson.toJson(allTiles)
+    // Export tiles as NDJSON (one tile per line), which Python reads incrementally
+    def gson = GsonTools.getInstance()
+    new File(tempAnnotationsPath).withWriter("UTF-8") { writer ->
+        allTiles.each { tile ->
+            writer.write(gson.toJson(tile))
+            writer.write("\n")
+        }
+    }
     
     println("Exported ${allTiles.size()} tiles to ${tempAnnotationsPath}")
     
@@ -1031,6 +1036,7 @@ def showWholeSlideDialog(String modelType) {
         def strideField = new TextField("560")  // Default = 50% overlap
         def maxPatchesField = new TextField("1000")  // Memory limit
         def workersField = new TextField("1")  // Force single-threaded to avoid Windows multiprocessing issues
+        def timeBudgetField = new TextField("0")  // Seconds; 0 = score every patch up to Max Patches
         
         grid.add(new Label("Output Directory:"), 0, 0)
         grid.add(outputField, 1, 0)
@@ -1049,22 +1055,28 @@ def showWholeSlideDialog(String modelType) {
         
         // Add OS-specific note
         def workersNote = System.getProperty("os.name").toLowerCase().contains("windows") ? 
-            "(Windows: use 1 for stability)" : "(parallel processing)"
+            "(Windows: use 1 for stability)" : "(0 = plan for this machine)"
         grid.add(new Label(workersNote), 2, 3)
         
+        grid.add(new Label("Time Budget (s):"), 0, 4)
+        grid.add(timeBudgetField, 1, 4)
+        grid.add(new Label("(e.g. 60 for triage; 0 = full run)"), 2, 4)
+        
         dialog.getDialogPane().setContent(grid)
         dialog.getDialogPane().getButtonTypes().addAll(ButtonType.OK, ButtonType.CANCEL)
         
         def result = dialog.showAndWait()
         if (result.isPresent() && result.get() == ButtonType.OK) {
             runWholeSlideAnalysis(modelType, outputField.getText(), 
-                strideField.getText(), maxPatchesField.getText(), workersField.getText())
+                strideField.getText(), maxPatchesField.getText(), workersField.getText(),
+                timeBudgetField.getText())
         }
     }
 }
 
 // Run whole slide analysis
-def runWholeSlideAnalysis(String modelType, String outputDir, String stride, String maxPatches, String workers) {
+def runWholeSlideAnalysis(String modelType, String outputDir, String stride, String maxPatches, String workers,
+                          String timeBudget = "0") {
     // Check configuration
     if (!SPIDERConfig.pythonPath || !SPIDERConfig.modelsBasePath) {
         Dialogs.showErrorMessage("Configuration Required", 
@@ -1138,7 +1150,7 @@ def runWholeSlideAnalysis(String modelType, String outputDir, String stride, Str
     new File(outputDir).mkdirs()
     
     // Force single-threaded processing on Windows to avoid multiprocessing issues
-    if (System.getProperty("os.name").toLowerCase().contains("windows") && workers.toInteger() > 1) {
+    if (System.getProperty("os.name").toLowerCase().contains("windows") && workers.toInteger() != 1) {
         println("Warning: Forcing single-threaded processing on Windows to avoid multiprocessing issues")
         workers = "1"
     }
@@ -1155,6 +1167,11 @@ def runWholeSlideAnalysis(String modelType, String outputDir, String stride, Str
         workers
     ]
     
+    // Time-budgeted triage: patches are scored coarse to fine over the whole slide
+    if (timeBudget.isNumber() && timeBudget.toDouble() > 0) {
+        command.addAll(["--time-budget", timeBudget])
+    }
+    
     println("Running: " + command.join(" "))
     
     // Run in background
@@ -1174,7 +1191,8 @@ def runWholeSlideAnalysis(String modelType, String outputDir, String stride, Str
         if (exitCode == 0) {
             Platform.runLater {
                 Dialogs.showInfoNotification("Whole Slide Analysis", 
-                    "Analysis completed! Results saved to: ${outputDir}")
+                    "Analysis completed! Results saved to: ${outputDir}\n" +
+                    "Run spider_import_detections.groovy to load detections.geojson into QuPath")
             }
         } else {
             Platform.runLater {
@@ -18,8 +18,12 @@ def pythonPath = "D:\\DigitalPathologyDrafts\\.venv\\Scripts\\python.exe"  // Up
 def modelPath = "D:\\histai\\SPIDER-colorectal-model"  // Update to your model path
 def patchSize = 1120  // SPIDER model input size
 def patchStride = 1120  // No overlap with stride=patchSize
+def minCoverage = 0.25  // Minimum fraction of a tile that must lie inside the annotation
+def minTissue = 0.1  // Minimum tissue fraction of a tile (0 disables tissue detection)
 def visualizeResults = true
 def keepTempFiles = false
+def useTTA = false  // Re-check low-confidence regions with flipped/rotated views (slower for those regions)
+def useStainNormalization = false  // Normalize H&E stains per slide (estimated once per slide and cached)
 
 // Abbreviated class name map (keep these short for cleaner display)
 def classAbbreviations = [
@@ -70,189 +74,63 @@ if (selectedAnnotations.isEmpty()) {
 
 println("Processing ${selectedAnnotations.size()} selected annotations")
 
-// STEP 1: GENERATE TILES
-println("\n--- STEP 1: GENERATING TILES ---")
+// STEP 1: EXPORT ANNOTATION POLYGONS FOR TILING
+println("\n--- STEP 1: EXPORTING ANNOTATION POLYGONS ---")
 
-// List to hold all tiles
+// Tiles are generated by the Python classifier, which rasterizes each polygon once
+// and keeps tiles by coverage and tissue content; they are registered as they arrive
 def allTiles = []
 def tilesByAnnotation = [:]
+def tilingRequests = []
 
 selectedAnnotations.eachWithIndex { annotation, annotationIndex ->
     def annotationROI = annotation.getROI()
-    def annotationID = annotation.getID()
-    
-    // Get annotation bounds
-    def startX = annotationROI.getBoundsX()
-    def startY = annotationROI.getBoundsY()
-    def width = annotationROI.getBoundsWidth()
-    def height = annotationROI.getBoundsHeight()
-    
-    println("Annotation ${annotationIndex+1}/${selectedAnnotations.size()}: ${width}x${height} px")
+    def geometry = annotationROI.getGeometry()
     
-    // Calculate number of tiles
-    def numTilesX = Math.max(1, Math.floor(width / patchStride) as int)
-    def numTilesY = Math.max(1, Math.floor(height / patchStride) as int)
+    println("Annotation ${annotationIndex+1}/${selectedAnnotations.size()}: " +
+        "${annotationROI.getBoundsWidth()}x${annotationROI.getBoundsHeight()} px")
     
-    println("Creating ${numTilesX}x${numTilesY} = ${numTilesX * numTilesY} tiles")
-    
-    // Initialize list for this annotation
-    def tilesForAnnotation = []
-    tilesByAnnotation[annotationID] = tilesForAnnotation
-    
-    // Generate tiles
-    for (int y = 0; y < numTilesY; y++) {
-        for (int x = 0; x < numTilesX; x++) {
-            // Calculate tile coordinates
-            def tileX = startX + x * patchStride
-            def tileY = startY + y * patchStride
-            
-            // Create rectangle ROI for this tile
-            def tileROI = ROIs.createRectangleROI(
-                tileX, tileY, patchSize, patchSize, ImagePlane.getDefaultPlane())
-            
-            // Skip tiles that don't intersect with the annotation
-            if (!annotationROI.getGeometry().intersects(tileROI.getGeometry()))
-                continue
-                
-            // Create unique ID for this tile
-            def tileID = "tile_${annotationID}_${x}_${y}"
-            
-            // Create tile object for JSON
-            def tileObj = [
-                id: tileID,
-                slide_path: imagePath,
-                image_name: imageName,
-                parent_annotation_id: annotationID,
-                gridX: x,
-                gridY: y,
-                roi: [
-                    x: tileX,
-                    y: tileY,
-                    width: patchSize,
-                    height: patchSize
-                ]
-            ]
-            
-            allTiles.add(tileObj)
-            tilesForAnnotation.add(tileObj)
+    // Export every ring (exterior and holes) of every polygon part
+    def rings = []
+    for (int i = 0; i < geometry.getNumGeometries(); i++) {
+        def polygon = geometry.getGeometryN(i)
+        if (!(polygon instanceof org.locationtech.jts.geom.Polygon))
+            continue
+        def polygonRings = [polygon.getExteriorRing()]
+        for (int j = 0; j < polygon.getNumInteriorRing(); j++)
+            polygonRings.add(polygon.getInteriorRingN(j))
+        polygonRings.each { ring ->
+            rings.add(ring.getCoordinates().collect { [it.x, it.y] })
         }
     }
+    
+    tilesByAnnotation[annotation.getID().toString()] = []
+    tilingRequests.add([
+        id: annotation.getID().toString(),
+        slide_path: imagePath,
+        image_name: imageName,
+        rings: rings,
+        tiling: [
+            patch_size: patchSize,
+            stride: patchStride,
+            min_coverage: minCoverage,
+            min_tissue: minTissue
+        ]
+    ])
 }
 
-// Export tiles as JSON
+// Export tiling requests as JSON
 def gson = GsonTools.getInstance(true)
-def jsonString = gson.toJson(allTiles)
+def jsonString = gson.toJson(tilingRequests)
 new File(tempAnnotationsPath).text = jsonString
 
-println("Exported ${allTiles.size()} tiles to ${tempAnnotationsPath}")
+println("Exported ${tilingRequests.size()} annotation polygons to ${tempAnnotationsPath}")
 
-// STEP 2: RUN SPIDER CLASSIFICATION
+// STEP 2: RUN SPIDER CLASSIFICATION (tiles are visualized as results stream in)
 println("\n--- STEP 2: RUNNING SPIDER CLASSIFICATION ---")
 
-// Run SPIDER classifier Python script
-def command = [pythonPath, scriptPath, tempAnnotationsPath, modelPath, outputPath]
-println("Running command: " + command.join(" "))
-
-def process = new ProcessBuilder(command)
-    .redirectErrorStream(true)
-    .start()
-
-// Read and print the output
-def reader = new BufferedReader(new InputStreamReader(process.getInputStream()))
-def line
-while ((line = reader.readLine()) != null) {
-    println(line)
-}
-
-def exitCode = process.waitFor()
-println("Python process finished with exit code: " + exitCode)
-
-if (exitCode != 0) {
-    Dialogs.showErrorMessage("Error", "SPIDER classification failed. Check the log for details.")
-    return
-}
-
-println("Classification completed successfully!")
-
-// STEP 3: PROCESS RESULTS
-println("\n--- STEP 3: PROCESSING RESULTS ---")
-
-// Load predictions
-def predictionsPath = buildFilePath(outputPath, "predictions.json")
-def predictionsFile = new File(predictionsPath)
-
-if (!predictionsFile.exists()) {
-    Dialogs.showErrorMessage("Error", "Predictions file not found at " + predictionsPath)
-    return
-}
-
-def jsonText = predictionsFile.text
-def jsonParser = new com.google.gson.JsonParser()
-def jsonArray = jsonParser.parse(jsonText).getAsJsonArray()
-
-// Convert to a list structure
-def predictions = []
-for (int i = 0; i < jsonArray.size(); i++) {
-    try {
-        def predictionObj = jsonArray.get(i).getAsJsonObject()
-        
-        // Handle ID format - using Groovy's dynamic typing 
-        def id
-        def idElement = predictionObj.get("id")
-        if (idElement.isJsonPrimitive()) {
-            id = idElement.getAsString()
-        } else if (idElement.isJsonObject()) {
-            // Extract the ID components without needing JsonObject class
-            def idObj = idElement.getAsJsonObject()
-            def values = []
-            if (idObj.has("values") && idObj.get("values").isJsonArray()) {
-                def valuesArray = idObj.get("values").getAsJsonArray()
-                for (int j = 0; j < valuesArray.size(); j++) {
-                    values.add(valuesArray.get(j).toString().replaceAll('"', ''))
-                }
-            }
-            id = "tile_${values[0]}_${values[1]}_${values[2]}"
-        } else {
-            id = "prediction_${i}"
-        }
-        
-        def prediction = [id: id]
-        
-        if (!predictionObj.get("prediction").isJsonNull()) {
-            prediction.prediction = predictionObj.get("prediction").getAsString()
-            
-            // Extract probabilities
-            def probsObj = predictionObj.get("probabilities").getAsJsonObject()
-            def probs = [:]
-            probsObj.keySet().each { className ->
-                probs[className] = probsObj.get(className).getAsDouble()
-            }
-            prediction.probabilities = probs
-        } else {
-            prediction.prediction = null
-            prediction.probabilities = null
-        }
-        
-        predictions.add(prediction)
-    } catch (Exception e) {
-        println("Error parsing prediction ${i}: ${e.getMessage()}")
-    }
-}
-
-println("Loaded ${predictions.size()} tile predictions")
-
-// STEP 4: VISUALIZE RESULTS
-println("\n--- STEP 4: VISUALIZING RESULTS ---")
-
-// Load class information from predictions
-def classSet = new HashSet<String>()
-predictions.each { prediction ->
-    if (prediction.prediction != null) {
-        classSet.add(prediction.prediction)
-    }
-}
-def classes = classSet.toList()
-println("Found ${classes.size()} classes")
+// Prefix used by the Python classifier for machine-readable progress/result lines
+def EVENT_PREFIX = "SPIDER_EVENT "
 
 // Helper function to create distinct colors for classes
 def getClassColors = { classNames ->
@@ -303,15 +181,12 @@ def getClassColors = { classNames ->
     return colorMap
 }
 
-// Create color map for classes
-def classColorMap = getClassColors(classes)
-
 // Function to find or create a PathClass by name with our color map
+// (classes are only known once results arrive, so colors are resolved per name)
 def findOrCreatePathClass = { String name ->
     def pathClass = PathClassFactory.getPathClass(name)
     if (pathClass == null) {
-        // Use our color map
-        def color = classColorMap[name]
+        def color = getClassColors([name])[name]
         if (color == null) {
             color = Color.rgb(128, 128, 128, 0.6) // Gray default with alpha
         }
@@ -320,101 +195,300 @@ def findOrCreatePathClass = { String name ->
     return pathClass
 }
 
-// Create class map for statistics
-def allPathClasses = classes.collect { findOrCreatePathClass(it) }
+// Extract a prediction ID, handling GString-serialized IDs from older exports
+def parsePredictionId = { idElement, int index ->
+    if (idElement.isJsonPrimitive()) {
+        return idElement.getAsString()
+    } else if (idElement.isJsonObject()) {
+        // Extract the ID components without needing JsonObject class
+        def idObj = idElement.getAsJsonObject()
+        def values = []
+        if (idObj.has("values") && idObj.get("values").isJsonArray()) {
+            def valuesArray = idObj.get("values").getAsJsonArray()
+            for (int j = 0; j < valuesArray.size(); j++) {
+                values.add(valuesArray.get(j).toString().replaceAll('"', ''))
+            }
+        }
+        return "tile_${values[0]}_${values[1]}_${values[2]}".toString()
+    }
+    return "prediction_${index}".toString()
+}
+
+// Convert a prediction JsonObject into a map
+def parsePrediction = { predictionObj, int index ->
+    def prediction = [id: parsePredictionId(predictionObj.get("id"), index)]
+    
+    if (!predictionObj.get("prediction").isJsonNull()) {
+        prediction.prediction = predictionObj.get("prediction").getAsString()
+        
+        // Extract probabilities
+        def probsObj = predictionObj.get("probabilities").getAsJsonObject()
+        def probs = [:]
+        probsObj.keySet().each { className ->
+            probs[className] = probsObj.get(className).getAsDouble()
+        }
+        prediction.probabilities = probs
+    } else {
+        prediction.prediction = null
+        prediction.probabilities = null
+    }
+    return prediction
+}
+
+// Tile lookup for streamed results
+def tilesById = [:]
+
+// Register a tile generated by the Python classifier
+def registerTile = { tileObj ->
+    def id = tileObj.get("id").getAsString()
+    if (tilesById.containsKey(id))
+        return
+    def roiObj = tileObj.get("roi").getAsJsonObject()
+    def tile = [
+        id: id,
+        parent_annotation_id: tileObj.get("parent_annotation_id").getAsString(),
+        gridX: tileObj.get("gridX").getAsInt(),
+        gridY: tileObj.get("gridY").getAsInt(),
+        weight: tileObj.has("weight") ? tileObj.get("weight").getAsDouble() : 1.0,
+        roi: [
+            x: roiObj.get("x").getAsDouble(),
+            y: roiObj.get("y").getAsDouble(),
+            width: roiObj.get("width").getAsDouble(),
+            height: roiObj.get("height").getAsDouble()
+        ]
+    ]
+    tilesById[id] = tile
+    allTiles.add(tile)
+    def annotationTiles = tilesByAnnotation[tile.parent_annotation_id]
+    if (annotationTiles != null)
+        annotationTiles.add(tile)
+}
+
+// Clear any existing tile annotations for the selected annotations before results arrive
+if (visualizeResults) {
+    selectedAnnotations.each { annotation ->
+        def annotationID = annotation.getID()
+        def existingTiles = getAnnotationObjects().findAll { 
+            it.getName() != null && it.getName().startsWith("Tile_${annotationID}_") 
+        }
+        removeObjects(existingTiles, true)
+    }
+}
+
+// Create tile annotations for a batch of predictions in a single hierarchy update
+def visualizePredictions = { batch ->
+    def tileAnnotations = []
+    batch.each { prediction ->
+        def tile = tilesById[prediction.id]
+        if (tile == null || prediction.prediction == null)
+            return
+        
+        // Get the classification
+        def className = prediction.prediction
+        def confidence = prediction.probabilities[className]
+        
+        // Create ROI for this tile
+        def roi = ROIs.createRectangleROI(
+            tile.roi.x, tile.roi.y, tile.roi.width, tile.roi.height, 
+            ImagePlane.getDefaultPlane())
+        
+        // Create an annotation with the tile's class
+        def tileAnnotation = new PathAnnotationObject(roi, findOrCreatePathClass(className))
+        
+        // Add a simple name with abbreviated class
+        tileAnnotation.setName(classAbbreviations[className] ?: className)
+        
+        // Add measurements as doubles to avoid casting errors
+        tileAnnotation.measurements.put("SPIDER: Confidence", confidence * 100.0)
+        
+        // Store grid coordinates as doubles to avoid casting errors
+        tileAnnotation.measurements.put("SPIDER: GridX", Double.valueOf(tile.gridX))
+        tileAnnotation.measurements.put("SPIDER: GridY", Double.valueOf(tile.gridY))
+        
+        tileAnnotations.add(tileAnnotation)
+    }
+    if (!tileAnnotations.isEmpty())
+        addObjects(tileAnnotations)
+}
+
+// Format throughput and ETA from a progress event
+def formatProgress = { event ->
+    def done = event.get("done").getAsInt()
+    // The total is null while an incrementally read input has not been counted
+    def totalElement = event.get("total")
+    def total = (totalElement == null || totalElement.isJsonNull()) ? null : totalElement.getAsInt()
+    def rate = event.get("rate").getAsDouble()
+    def eta = event.get("eta")
+    def etaStr = (eta == null || eta.isJsonNull()) ? "--" : String.format("%.0fs", eta.getAsDouble())
+    if (total == null)
+        return String.format("Progress: %d tiles - %.2f tiles/s, ETA %s", done, rate, etaStr)
+    return String.format("Progress: %d/%d tiles (%.0f%%) - %.2f tiles/s, ETA %s",
+        done, total, total > 0 ? 100.0 * done / total : 100.0, rate, etaStr)
+}
+
+// Run SPIDER classifier Python script
+def command = [pythonPath, scriptPath, tempAnnotationsPath, modelPath, outputPath]
+if (useTTA)
+    command.add("--tta")
+if (useStainNormalization)
+    command.add("--stain-normalize")
+println("Running command: " + command.join(" "))
+
+def process = new ProcessBuilder(command)
+    .redirectErrorStream(true)
+    .start()
+
+// Read the output, visualizing tile results as they arrive
+def jsonParser = new com.google.gson.JsonParser()
+def predictions = []
+def reader = new BufferedReader(new InputStreamReader(process.getInputStream()))
+def line
+while ((line = reader.readLine()) != null) {
+    if (!line.startsWith(EVENT_PREFIX)) {
+        println(line)
+        continue
+    }
+    
+    def event
+    try {
+        event = jsonParser.parse(line.substring(EVENT_PREFIX.length())).getAsJsonObject()
+    } catch (Exception e) {
+        println(line)
+        continue
+    }
+    
+    def type = event.get("type").getAsString()
+    if (type == "results") {
+        def records = event.get("records").getAsJsonArray()
+        def batch = []
+        for (int i = 0; i < records.size(); i++) {
+            try {
+                batch.add(parsePrediction(records.get(i).getAsJsonObject(), predictions.size() + i))
+            } catch (Exception e) {
+                println("Error parsing streamed prediction: ${e.getMessage()}")
+            }
+        }
+        predictions.addAll(batch)
+        if (visualizeResults)
+            visualizePredictions(batch)
+        println(formatProgress(event))
+    } else if (type == "tiles") {
+        def tiles = event.get("tiles").getAsJsonArray()
+        for (int i = 0; i < tiles.size(); i++) {
+            registerTile(tiles.get(i).getAsJsonObject())
+        }
+        println("Received ${tiles.size()} tiles from polygon tiling")
+    } else if (type == "start") {
+        def total = event.get("total")
+        if (total == null || total.isJsonNull())
+            println("SPIDER started (reading tiles incrementally)")
+        else
+            println("SPIDER started on " + total.getAsInt() + " tiles")
+    } else if (type == "error") {
+        println("ERROR: " + event.get("message").getAsString())
+    } else if (type == "finish") {
+        println(formatProgress(event))
+    }
+}
+
+def exitCode = process.waitFor()
+println("Python process finished with exit code: " + exitCode)
+
+if (exitCode != 0 && predictions.isEmpty()) {
+    Dialogs.showErrorMessage("Error", "SPIDER classification failed. Check the log for details.")
+    return
+}
+
+if (exitCode != 0) {
+    println("WARNING: Classification did not finish; keeping ${predictions.size()} tile results received so far")
+} else {
+    println("Classification completed successfully!")
+}
+
+// STEP 3: PROCESS RESULTS
+println("\n--- STEP 3: PROCESSING RESULTS ---")
+
+// Fall back to predictions.json when the classifier did not stream any results
+if (predictions.isEmpty()) {
+    def predictionsPath = buildFilePath(outputPath, "predictions.json")
+    def predictionsFile = new File(predictionsPath)
+    
+    if (!predictionsFile.exists()) {
+        Dialogs.showErrorMessage("Error", "Predictions file not found at " + predictionsPath)
+        return
+    }
+    
+    def jsonArray = jsonParser.parse(predictionsFile.text).getAsJsonArray()
+    for (int i = 0; i < jsonArray.size(); i++) {
+        try {
+            def predictionObj = jsonArray.get(i).getAsJsonObject()
+            if (predictionObj.has("roi"))
+                registerTile(predictionObj)
+            predictions.add(parsePrediction(predictionObj, i))
+        } catch (Exception e) {
+            println("Error parsing prediction ${i}: ${e.getMessage()}")
+        }
+    }
+    if (visualizeResults)
+        visualizePredictions(predictions)
+}
+
+println("Loaded ${predictions.size()} tile predictions")
+
+// STEP 4: SUMMARIZE RESULTS
+println("\n--- STEP 4: SUMMARIZING RESULTS ---")
+
+// Load class information from predictions
+def classSet = new HashSet<String>()
+predictions.each { prediction ->
+    if (prediction.prediction != null) {
+        classSet.add(prediction.prediction)
+    }
+}
+def classes = classSet.toList()
+println("Found ${classes.size()} classes")
+
+// Index predictions by tile ID
+def tileIdToPrediction = [:]
+predictions.each { prediction -> tileIdToPrediction[prediction.id] = prediction }
 
 // Process results by annotation
 selectedAnnotations.each { annotation ->
     def annotationID = annotation.getID()
     
     // Get tiles for this annotation
-    def annotationTiles = tilesByAnnotation[annotationID]
+    def annotationTiles = tilesByAnnotation[annotationID.toString()]
     if (annotationTiles == null || annotationTiles.isEmpty()) {
         println("No tiles found for annotation ${annotationID}")
         return
     }
     
-    // Get predictions for these tiles
-    def tileIdToPrediction = [:]
-    
-    predictions.each { prediction ->
-        def tileId = prediction.id
-        if (tileId.startsWith("tile_${annotationID}_")) {
-            tileIdToPrediction[tileId] = prediction
-        }
-    }
-    
-    // Class distribution for statistics
+    // Class distribution for statistics (percentages weighted by tile coverage)
     def classCount = [:]
-    classes.each { classCount[it] = 0 }
+    def classWeight = [:]
+    classes.each {
+        classCount[it] = 0
+        classWeight[it] = 0.0
+    }
     
-    // Create tile annotations if visualization is enabled
-    if (visualizeResults) {
-        // Clear any existing tile annotations for this annotation
-        def existingTiles = getAnnotationObjects().findAll { 
-            it.getName() != null && it.getName().startsWith("Tile_${annotationID}_") 
-        }
-        removeObjects(existingTiles, true)
+    annotationTiles.each { tile ->
+        def prediction = tileIdToPrediction[tile.id]
         
-        // Create new tile annotations
-        annotationTiles.each { tile ->
-            def tileId = tile.id
-            def prediction = tileIdToPrediction[tileId]
-            
-            if (prediction != null && prediction.prediction != null) {
-                // Get the classification
-                def className = prediction.prediction
-                def confidence = prediction.probabilities[className]
-                
-                // Increment class count
-                classCount[className] = (classCount[className] ?: 0) + 1
-                
-                // Create ROI for this tile
-                def roi = ROIs.createRectangleROI(
-                    tile.roi.x, tile.roi.y, tile.roi.width, tile.roi.height, 
-                    ImagePlane.getDefaultPlane())
-                
-                // Create an annotation with the tile's class
-                def pathClass = findOrCreatePathClass(className)
-                def tileAnnotation = new PathAnnotationObject(roi, pathClass)
-                
-                // Get abbreviated class name
-                def abbrevName = classAbbreviations[className] ?: className
-                
-                // Add a simple name with abbreviated class
-                tileAnnotation.setName(abbrevName)
-                
-                // Add measurements as doubles to avoid casting errors
-                tileAnnotation.measurements.put("SPIDER: Confidence", confidence * 100.0)
-                
-                // Store grid coordinates as doubles to avoid casting errors
-                tileAnnotation.measurements.put("SPIDER: GridX", Double.valueOf(tile.gridX))
-                tileAnnotation.measurements.put("SPIDER: GridY", Double.valueOf(tile.gridY))
-                
-                // Add to image data
-                addObject(tileAnnotation)
-            }
-        }
-    } else {
-        // Just count the classes
-        annotationTiles.each { tile ->
-            def tileId = tile.id
-            def prediction = tileIdToPrediction[tileId]
-            
-            if (prediction != null && prediction.prediction != null) {
-                // Increment class count
-                def className = prediction.prediction
-                classCount[className] = (classCount[className] ?: 0) + 1
-            }
+        if (prediction != null && prediction.prediction != null) {
+            // Increment class count and coverage-weighted total
+            def className = prediction.prediction
+            classCount[className] = (classCount[className] ?: 0) + 1
+            classWeight[className] = (classWeight[className] ?: 0.0) + tile.weight
         }
     }
     
     // Calculate class percentages
-    def totalPredicted = classCount.values().sum()
+    def totalPredicted = classCount.values().sum() ?: 0
+    def totalWeight = classWeight.values().sum() ?: 0.0
     def classPercentages = [:]
-    if (totalPredicted > 0) {
-        classCount.each { cls, count ->
-            classPercentages[cls] = count / totalPredicted
+    if (totalWeight > 0) {
+        classWeight.each { cls, weight ->
+            classPercentages[cls] = weight / totalWeight
         }
     }
     
@@ -422,7 +496,7 @@ selectedAnnotations.each { annotation ->
     def summaryStr = new StringBuilder("SPIDER tile summary:\n")
     
     // Find top 3 classes
-    if (totalPredicted > 0) {
+    if (totalPredicted > 0 && totalWeight > 0) {
         def sortedClasses = classCount.entrySet()
             .sort { -it.value }
             .take(3)